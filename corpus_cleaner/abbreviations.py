@@ -0,0 +1,120 @@
+import hashlib
+import io
+import re
+
+DEFAULT_ENCODING = "utf-8"
+# Lists without the final stop, such as Moses' nonbreaking prefixes, are taken to mean this one
+DEFAULT_ABBREVIATION_STOP = "."
+COMMENT_CHAR = "#"
+
+WHITESPACE_PATTERN = re.compile(r"\s")
+
+# Marks a trie node where an abbreviation starts, since nodes are otherwise keyed by single chars
+_TERMINAL = ""
+
+
+class Abbreviations(object):
+    """
+    Abbreviations which don't end a sentence, such as "Dr." or "e.g.", compiled into a trie of them written
+    backwards. Each sentence boundary is checked by walking back from it through the trie as the text is split,
+    which only takes as many steps as the longest abbreviation ending there, however long the list is.
+    Abbreviations have to start a word, i.e. they can't follow a letter or a digit, and are case-sensitive.
+    """
+
+    def __init__(self, abbreviations):
+        self.abbreviations = sorted(set(abbreviation for abbreviation in abbreviations if len(abbreviation) != 0))
+        self.fingerprint = hashlib.sha256("\n".join(self.abbreviations).encode("utf-8", "surrogatepass")).hexdigest()
+        self.max_length = max([len(abbreviation) for abbreviation in self.abbreviations] + [0])
+        self._trie = {}
+
+        for abbreviation in self.abbreviations:
+            node = self._trie
+            for char in reversed(abbreviation):
+                node = node.setdefault(char, {})
+            node[_TERMINAL] = True
+
+    def __len__(self):
+        return len(self.abbreviations)
+
+    def start_of(self, text, end, suffix):
+        """
+        Where the longest abbreviation matching text[start:end] + suffix starts, or -1 if none does.
+        """
+        node = self._trie
+        for char in reversed(suffix):
+            node = node.get(char)
+            if node is None:
+                return -1
+
+        start = end if _TERMINAL in node and (end == 0 or not text[end - 1].isalnum()) else -1
+        position = end - 1
+
+        while position >= 0:
+            node = node.get(text[position])
+            if node is None:
+                break
+            if _TERMINAL in node and (position == 0 or not text[position - 1].isalnum()):
+                start = position
+            position -= 1
+
+        return start
+
+    def _inside(self, pattern, text, match, sentence_end):
+        # Only a boundary with no space after it can be part of a longer abbreviation, like after the "e" of "e.g."
+        end = match.end()
+        if end == len(text) or len(match.group(pattern.groups)) != 0 or text[end].isspace():
+            return False
+
+        word_end = WHITESPACE_PATTERN.search(text, end, match.start() + self.max_length)
+        word_end = word_end.start() if word_end is not None else min(len(text), match.start() + self.max_length)
+
+        for later_match in pattern.finditer(text, end, word_end):
+            start = self.start_of(text, later_match.start(), sentence_end(later_match))
+            if start != -1 and start <= match.start():
+                return True
+
+        return False
+
+    def split(self, pattern, text, sentence_end):
+        """
+        Puts a line-break after every sentence boundary matched by pattern, except the ones in an abbreviation.
+        A boundary is the chars ending a sentence followed by its spaces, in the last group of the pattern, and
+        sentence_end() gives the chars as they're to be written for a match. Boundaries ending an abbreviation
+        keep their spaces instead.
+        """
+        def replace(match):
+            ending = sentence_end(match)
+
+            if self.start_of(text, match.start(), ending) != -1 or \
+                    self._inside(pattern, text, match, sentence_end):
+                return ending + match.group(pattern.groups)
+
+            return ending + "\n"
+
+        return pattern.sub(replace, text)
+
+
+def parse_abbreviations(lines, stop=DEFAULT_ABBREVIATION_STOP):
+    """
+    Reads abbreviations one per line, as they're written in text, e.g. "Dr." or "e.g.". Lines without
+    a final stop get one, blank lines are skipped and anything after the first space or a "#" is ignored.
+    """
+    abbreviations = []
+
+    for line in lines:
+        fields = line.split(COMMENT_CHAR, 1)[0].split()
+        if len(fields) == 0:
+            continue
+
+        abbreviation = fields[0]
+        abbreviations.append(abbreviation if abbreviation.endswith(stop) else abbreviation + stop)
+
+    return Abbreviations(abbreviations)
+
+
+def load_abbreviations(path, encoding=DEFAULT_ENCODING, stop=DEFAULT_ABBREVIATION_STOP):
+    """
+    Loads an abbreviation list file, as read by parse_abbreviations().
+    """
+    with io.open(path, encoding=encoding) as abbreviation_file:
+        return parse_abbreviations(abbreviation_file, stop=stop)
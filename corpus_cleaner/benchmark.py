@@ -0,0 +1,538 @@
+#!/usr/bin/env python
+
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import textwrap
+import time
+import timeit
+from argparse import ArgumentParser
+from contextlib import redirect_stdout
+from os.path import exists, join
+from tempfile import mkdtemp
+
+from corpus_cleaner import scrubber, equaliser
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+DEFAULT_REPEAT = 3
+DEFAULT_SEED = 0
+DEFAULT_COLUMN_WIDTH = 72
+# How far B's sentence lengths stray from A's, as a ratio either way
+DEFAULT_SKEW = 0.3
+# How many distinct paragraphs to draw generated corpora from
+DEFAULT_POOL_SIZE = 2000
+
+MEGABYTE = 1024 * 1024
+SIZE_TIERS = {
+    "1MB": MEGABYTE,
+    "10MB": 10 * MEGABYTE,
+    "100MB": 100 * MEGABYTE,
+    "1GB": 1024 * MEGABYTE,
+}
+DEFAULT_TIERS = ["1MB"]
+# Tiers bigger than this only get the streamed whole-file benchmarks, so they don't need the corpus in memory
+IN_MEMORY_LIMIT = 100 * MEGABYTE
+# Paragraph lengths to compare the merge planners on, either side of equaliser.NUMPY_MIN_SENTENCES
+DEFAULT_PLAN_LENGTHS = [16, 64, 128, 256, 1024, 4096]
+PLAN_SHAPES = ["even", "mixed", "merges"]
+
+WORDS = ["lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing", "elit", "sed", "do", "eiusmod",
+         "tempor", "incididunt", "ut", "labore", "et", "dolore", "magna", "aliqua", "enim", "ad", "minim",
+         "veniam", "quis", "nostrud", "exercitation", "ullamco", "laboris", "nisi", "aliquip", "ex", "ea",
+         "commodo", "consequat", "duis", "aute", "irure", "in", "reprehenderit", "voluptate", "velit", "esse"]
+
+SCRUB_STAGES = [
+    ("reorder_stop_chars", scrubber.reorder_stop_chars),
+    ("remove_columns", scrubber.remove_columns),
+    ("split_as_one_sentence_per_line", scrubber.split_as_one_sentence_per_line),
+    ("remove_excessive_whitespace", scrubber.remove_excessive_whitespace),
+]
+
+
+def merge_heavy_paragraphs(run_length, run_count, seed=DEFAULT_SEED):
+    """
+    Builds a pair of paragraphs where every sentence in B lines up with a run of run_length short
+    sentences in A, so equalising has to glue long runs together.
+    """
+    generator = random.Random(seed)
+    words = ["lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing", "elit"]
+
+    def sentence(word_count):
+        return " ".join(generator.choice(words) for _ in range(word_count)).capitalize() + "."
+
+    a_para = [sentence(2) for _ in range(run_length * run_count)]
+    b_para = [sentence(2 * run_length) for _ in range(run_count)]
+
+    return a_para, b_para
+
+
+def plan_word_counts(shape, length, seed=DEFAULT_SEED):
+    """
+    Word counts of a pair of paragraphs with at least length sentences on each side, to plan merges over.
+    even pairs sentences of about the same length, mixed pairs them at random, and merges lines up every
+    sentence in B with a run of ten in A.
+    """
+    generator = random.Random(seed)
+
+    if shape == "even":
+        a_counts = [generator.randint(5, 20) for _ in range(length)]
+        return a_counts, [max(1, count + generator.randint(-1, 1)) for count in a_counts]
+    if shape == "mixed":
+        return [generator.randint(2, 30) for _ in range(length)], [generator.randint(2, 30) for _ in range(length)]
+
+    return [2] * (10 * length), [20] * length
+
+
+def generate_sentence(generator, word_count):
+    """
+    A capitalised sentence of word_count words, ending in a stop char. Some are quoted or bracketed
+    American-style, with the closing mark after the stop char.
+    """
+    sentence = " ".join(generator.choice(WORDS) for _ in range(word_count)).capitalize()
+    stop_char = generator.choice([".", ".", ".", ".", "!", "?", ";"])
+    closing_mark = generator.choice(["", "", "", "", "\"", "'", ")"])
+
+    if closing_mark == "\"":
+        return "\"" + sentence + stop_char + "\""
+    if closing_mark == "'":
+        return "'" + sentence + stop_char + "'"
+    if closing_mark == ")":
+        return "(" + sentence + stop_char + ")"
+
+    return sentence + stop_char
+
+
+def generate_raw_paragraph(generator, column_width=DEFAULT_COLUMN_WIDTH):
+    """
+    A paragraph as scrub() expects to find it: wrapped into columns, with stray spaces and tabs.
+    """
+    sentences = [generate_sentence(generator, generator.randint(3, 25)) for _ in range(generator.randint(2, 8))]
+    lines = textwrap.wrap(" ".join(sentences), column_width)
+
+    messy_lines = []
+    for line in lines:
+        if generator.random() < 0.2:
+            line = line.replace(" ", "  ", 1)
+        if generator.random() < 0.1:
+            line = "\t" + line
+        messy_lines.append(" " * generator.randint(0, 2) + line + " " * generator.randint(0, 3))
+
+    return "\n".join(messy_lines)
+
+
+def generate_parallel_paragraphs(generator, skew=DEFAULT_SKEW):
+    """
+    A pair of paragraphs as equalise() expects to find them, one sentence per line. Each sentence in A has a
+    counterpart in B whose length is off by up to skew either way, and which is sometimes split in two.
+    """
+    a_para = []
+    b_para = []
+
+    for _ in range(generator.randint(2, 8)):
+        word_count = generator.randint(3, 25)
+        a_para.append(generate_sentence(generator, word_count))
+
+        b_word_count = max(1, int(round(word_count * generator.uniform(1 - skew, 1 + skew))))
+        if b_word_count > 1 and generator.random() < skew / 2:
+            first_word_count = generator.randint(1, b_word_count - 1)
+            b_para.append(generate_sentence(generator, first_word_count))
+            b_para.append(generate_sentence(generator, b_word_count - first_word_count))
+        else:
+            b_para.append(generate_sentence(generator, b_word_count))
+
+    return "\n".join(a_para), "\n".join(b_para)
+
+
+def generate_corpus(size, seed=DEFAULT_SEED, column_width=DEFAULT_COLUMN_WIDTH, pool_size=DEFAULT_POOL_SIZE):
+    """
+    Yields pieces of a raw corpus of roughly size chars. Paragraphs are drawn from a pool generated up front
+    so big corpora don't cost a random sentence per line, and are separated by uneven runs of line-breaks.
+    """
+    generator = random.Random(seed)
+    pool = [generate_raw_paragraph(generator, column_width) for _ in range(pool_size)]
+    breaks = ["\n\n", "\n\n", "\n\n\n", "\n \n\n", "\n\n\n\n"]
+    written = 0
+
+    while written < size:
+        piece = generator.choice(pool) + generator.choice(breaks)
+        written += len(piece)
+        yield piece
+
+
+def generate_parallel_corpus(size, seed=DEFAULT_SEED, skew=DEFAULT_SKEW, pool_size=DEFAULT_POOL_SIZE):
+    """
+    Yields pairs of pieces of parallel corpora A and B, each roughly size chars in total.
+    Paragraphs line up one to one, so they can be equalised with each other.
+    """
+    generator = random.Random(seed)
+    pool = [generate_parallel_paragraphs(generator, skew) for _ in range(pool_size)]
+    written = 0
+
+    while written < size:
+        a_para, b_para = generator.choice(pool)
+        if written != 0:
+            a_para = "\n\n" + a_para
+            b_para = "\n\n" + b_para
+
+        written += max(len(a_para), len(b_para))
+        yield a_para, b_para
+
+
+def write_corpus(path, size, seed=DEFAULT_SEED):
+    """
+    Writes a raw corpus of roughly size chars to path.
+    """
+    with io.open(path, "w", encoding="utf-8", newline="") as corpus_file:
+        for piece in generate_corpus(size, seed):
+            corpus_file.write(piece)
+
+
+def write_parallel_corpus(path_a, path_b, size, seed=DEFAULT_SEED, skew=DEFAULT_SKEW):
+    """
+    Writes a pair of parallel corpora of roughly size chars each to path_a and path_b.
+    """
+    with io.open(path_a, "w", encoding="utf-8", newline="") as file_a, \
+            io.open(path_b, "w", encoding="utf-8", newline="") as file_b:
+        for a_piece, b_piece in generate_parallel_corpus(size, seed, skew):
+            file_a.write(a_piece)
+            file_b.write(b_piece)
+
+
+def time_function(function, repeat=DEFAULT_REPEAT):
+    """
+    Best wall time of a few runs of function, in seconds.
+    """
+    return min(timeit.repeat(function, number=1, repeat=repeat))
+
+
+def time_file_function(function, prepare, repeat=DEFAULT_REPEAT):
+    """
+    Best wall time of a few runs of function, calling prepare untimed before each one to reset its files.
+    Anything the function prints is swallowed.
+    """
+    times = []
+
+    for _ in range(repeat):
+        prepare()
+        with redirect_stdout(io.StringIO()):
+            started = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - started)
+
+    return min(times)
+
+
+def peak_rss_megabytes():
+    """
+    The most memory this process has held at once so far, or None where it can't be told.
+    """
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / float(MEGABYTE if sys.platform == "darwin" else 1024)
+
+
+def benchmark_result(benchmark, name, tier, byte_count, seconds):
+    """
+    One row of results, in the form written out as JSON.
+    """
+    return {
+        "benchmark": benchmark,
+        "name": name,
+        "tier": tier,
+        "bytes": byte_count,
+        "seconds": seconds,
+        "megabytes_per_second": byte_count / float(MEGABYTE) / seconds if seconds != 0 else None,
+        "peak_rss_megabytes": peak_rss_megabytes(),
+    }
+
+
+def benchmark_merge_runs(run_lengths, run_count=10, repeat=DEFAULT_REPEAT):
+    """
+    Times equalise_paragraphs() against the reference implementation on increasingly long runs of merges.
+    Returns a list of (run length, reference seconds, python engine seconds). B only has run_count sentences,
+    so the numpy engine would plan in Python here too. benchmark_plan_merges() compares the planners.
+    """
+    results = []
+
+    for run_length in run_lengths:
+        a_para, b_para = merge_heavy_paragraphs(run_length, run_count)
+
+        reference_time = time_function(lambda: equaliser.equalise_paragraphs_reference(a_para, b_para), repeat)
+        word_count_time = time_function(lambda: equaliser.equalise_paragraphs(a_para, b_para), repeat)
+
+        results.append((run_length, reference_time, word_count_time))
+
+    return results
+
+
+def benchmark_plan_merges(lengths=DEFAULT_PLAN_LENGTHS, repeat=DEFAULT_REPEAT):
+    """
+    Times plan_merges() against plan_merges_numpy() on paragraphs of each length and shape, planning each
+    one as many times as it takes to cover the same number of sentences. This is where
+    equaliser.NUMPY_MIN_SENTENCES comes from. Returns a list of (shape, length, python seconds, numpy seconds),
+    with None for NumPy if it isn't installed.
+    """
+    results = []
+
+    for shape in PLAN_SHAPES:
+        for length in lengths:
+            a_counts, b_counts = plan_word_counts(shape, length)
+            plan_count = max(1, max(lengths) // length)
+
+            def plan_all(plan_function):
+                for _ in range(plan_count):
+                    plan_function(a_counts, b_counts)
+
+            python_time = time_function(lambda: plan_all(equaliser.plan_merges), repeat)
+            numpy_time = None
+            if equaliser.numpy is not None:
+                numpy_time = time_function(lambda: plan_all(equaliser.plan_merges_numpy), repeat)
+
+            results.append((shape, length, python_time, numpy_time))
+
+    return results
+
+
+def benchmark_scrub_stages(text, tier, repeat=DEFAULT_REPEAT):
+    """
+    Times each scrub() stage on the output of the one before, in the order scrub() runs them.
+    """
+    results = []
+
+    for stage_name, stage in SCRUB_STAGES:
+        byte_count = len(text.encode("utf-8"))
+        results.append(benchmark_result("scrub_stage", stage_name, tier, byte_count,
+                                        time_function(lambda: stage(text), repeat)))
+        text = stage(text)
+
+    return results
+
+
+def benchmark_scrub(text, tier, repeat=DEFAULT_REPEAT):
+    """
+    Times scrub() as a whole with each engine.
+    """
+    byte_count = len(text.encode("utf-8"))
+
+    return [benchmark_result("scrub", engine, tier, byte_count,
+                             time_function(lambda: scrubber.scrub(text, engine=engine), repeat))
+            for engine in scrubber.ENGINES]
+
+
+def join_paragraph_pairs(paragraph_pairs, min_sentences):
+    """
+    Joins consecutive pairs of paragraphs until both sides have at least min_sentences, apart from what's
+    left at the end.
+    """
+    a_para, b_para = [], []
+
+    for next_a_para, next_b_para in paragraph_pairs:
+        a_para += next_a_para
+        b_para += next_b_para
+
+        if min(len(a_para), len(b_para)) >= min_sentences:
+            yield a_para, b_para
+            a_para, b_para = [], []
+
+    if len(a_para) != 0 or len(b_para) != 0:
+        yield a_para, b_para
+
+
+def benchmark_equalise_paragraphs(text_a, text_b, tier, repeat=DEFAULT_REPEAT):
+    """
+    Times equalise_paragraphs() over every paragraph pair of a parallel corpus, with each engine. The
+    corpus's own paragraphs are too short for the numpy engine to use NumPy, so it's also timed on them joined
+    into paragraphs of at least equaliser.NUMPY_MIN_SENTENCES, named with " long" on the end.
+    """
+    paragraph_pairs = list(zip(equaliser.split(text_a), equaliser.split(text_b)))
+    long_paragraph_pairs = list(join_paragraph_pairs(paragraph_pairs, equaliser.NUMPY_MIN_SENTENCES))
+    byte_count = len(text_a.encode("utf-8")) + len(text_b.encode("utf-8"))
+    results = []
+
+    for name_suffix, pairs in [("", paragraph_pairs), (" long", long_paragraph_pairs)]:
+        for engine in equaliser.ENGINES:
+            if engine == equaliser.ENGINE_NUMPY and equaliser.numpy is None:
+                continue
+
+            def equalise_all():
+                for a_para, b_para in pairs:
+                    equaliser.equalise_paragraphs(a_para, b_para, engine=engine)
+
+            results.append(benchmark_result("equalise_paragraphs", engine + name_suffix, tier, byte_count,
+                                            time_function(equalise_all, repeat)))
+
+    return results
+
+
+def benchmark_scrub_file(corpus_path, directory, tier, streams, repeat=DEFAULT_REPEAT):
+    """
+    Times scrub_file() on a corpus file, reading it whole or streamed.
+    """
+    output_path = join(directory, "scrubbed.txt")
+    byte_count = os.path.getsize(corpus_path)
+
+    return [benchmark_result("scrub_file", "stream" if stream else "whole", tier, byte_count,
+                             time_file_function(lambda: scrubber.scrub_file(corpus_path, output_path, stream=stream),
+                                                lambda: None, repeat))
+            for stream in streams]
+
+
+def benchmark_equalise_file(path_a, path_b, directory, tier, streams, repeat=DEFAULT_REPEAT):
+    """
+    Times equalise_file() on copies of a parallel pair of corpus files, reading them whole or streamed.
+    """
+    work_a = join(directory, "work_a.txt")
+    work_b = join(directory, "work_b.txt")
+    byte_count = os.path.getsize(path_a) + os.path.getsize(path_b)
+
+    def copy_files():
+        shutil.copyfile(path_a, work_a)
+        shutil.copyfile(path_b, work_b)
+
+    return [benchmark_result("equalise_file", "stream" if stream else "whole", tier, byte_count,
+                             time_file_function(lambda: equaliser.equalise_file(work_a, work_b, stream=stream),
+                                                copy_files, repeat))
+            for stream in streams]
+
+
+def benchmark_tier(tier, directory, seed=DEFAULT_SEED, repeat=DEFAULT_REPEAT):
+    """
+    Runs every benchmark on generated corpora of one size tier, written into directory.
+    """
+    size = SIZE_TIERS[tier]
+    in_memory = size <= IN_MEMORY_LIMIT
+
+    corpus_path = join(directory, "corpus_{}.txt".format(tier))
+    path_a = join(directory, "corpus_{}_a.txt".format(tier))
+    path_b = join(directory, "corpus_{}_b.txt".format(tier))
+    write_corpus(corpus_path, size, seed)
+    write_parallel_corpus(path_a, path_b, size, seed)
+
+    results = []
+
+    if in_memory:
+        with io.open(corpus_path, encoding="utf-8", newline="") as corpus_file:
+            text = corpus_file.read()
+        results += benchmark_scrub_stages(text, tier, repeat)
+        results += benchmark_scrub(text, tier, repeat)
+        del text
+
+        with io.open(path_a, encoding="utf-8") as file_a, io.open(path_b, encoding="utf-8") as file_b:
+            results += benchmark_equalise_paragraphs(file_a.read(), file_b.read(), tier, repeat)
+
+    streams = [False, True] if in_memory else [True]
+    results += benchmark_scrub_file(corpus_path, directory, tier, streams, repeat)
+    results += benchmark_equalise_file(path_a, path_b, directory, tier, streams, repeat)
+
+    return results
+
+
+def result_key(result):
+    return result["benchmark"], result["name"], result["tier"]
+
+
+def compare_results(previous_results, results):
+    """
+    Pairs up results with the same benchmark, name and tier from an earlier run. Returns a list of
+    (result, speed-up) where the speed-up is the ratio of the earlier time to the new one.
+    """
+    previous_seconds = {result_key(result): result["seconds"] for result in previous_results}
+
+    return [(result, previous_seconds[result_key(result)] / result["seconds"])
+            for result in results if result_key(result) in previous_seconds and result["seconds"] != 0]
+
+
+def create_arg_parser():
+    description = "Times the corpus cleaning functions on generated text."
+    parser = ArgumentParser(description=description)
+
+    parser.add_argument("--repeat", dest="repeat", type=int, default=DEFAULT_REPEAT,
+                        help="How many times to run each benchmark, keeping the best. Default: {}".format(
+                            DEFAULT_REPEAT))
+
+    parser.add_argument("--tiers", dest="tiers", type=str, nargs="+", choices=sorted(SIZE_TIERS),
+                        default=DEFAULT_TIERS,
+                        help="Sizes of generated corpora to benchmark on. Default: {}".format(" ".join(DEFAULT_TIERS)))
+
+    parser.add_argument("--seed", dest="seed", type=int, default=DEFAULT_SEED,
+                        help="Seed for generating the corpora. Default: {}".format(DEFAULT_SEED))
+
+    parser.add_argument("--directory", dest="directory", type=str,
+                        help="Where to write the generated corpora. Default: a temporary directory")
+
+    parser.add_argument("-o, --output", metavar="output-path", type=str, dest="output",
+                        help="Write the results to this file as JSON.")
+
+    parser.add_argument("--compare", metavar="results-path", type=str, dest="compare",
+                        help="JSON results of an earlier run to compare against.")
+
+    return parser
+
+
+def main(arguments=None):
+    arg_parser = create_arg_parser()
+    args = arg_parser.parse_args(arguments)
+
+    print("Equalising runs of merges (reference, python engine):")
+    for merged_run_length, reference_seconds, python_seconds in benchmark_merge_runs([10, 100, 1000],
+                                                                                     repeat=args.repeat):
+        print("  runs of {:>5}: {:8.4f}s {:8.4f}s".format(merged_run_length, reference_seconds, python_seconds))
+
+    print("Planning merges, {} sentences in paragraphs of each length (python, numpy):".format(
+        max(DEFAULT_PLAN_LENGTHS)))
+    for shape, paragraph_length, python_seconds, numpy_seconds in benchmark_plan_merges(repeat=args.repeat):
+        print("  {:<6} {:>5}: {:8.4f}s {}".format(
+            shape, paragraph_length, python_seconds,
+            "{:8.4f}s".format(numpy_seconds) if numpy_seconds is not None else "no NumPy"))
+
+    corpus_directory = args.directory if args.directory is not None else mkdtemp()
+    all_results = []
+
+    try:
+        # Smallest first, since peak memory only ever goes up
+        for size_tier in sorted(args.tiers, key=lambda tier: SIZE_TIERS[tier]):
+            print("Benchmarking {} corpora:".format(size_tier))
+            for tier_result in benchmark_tier(size_tier, corpus_directory, seed=args.seed, repeat=args.repeat):
+                all_results.append(tier_result)
+                peak_rss = tier_result["peak_rss_megabytes"]
+                print("  {:<20} {:<31} {:8.3f}s {:8.1f} MB/s, peak RSS {} MB".format(
+                    tier_result["benchmark"], tier_result["name"], tier_result["seconds"],
+                    tier_result["megabytes_per_second"] or 0,
+                    "{:.1f}".format(peak_rss) if peak_rss is not None else "unknown"))
+    finally:
+        if args.directory is None:
+            shutil.rmtree(corpus_directory)
+
+    if args.compare is not None and exists(args.compare):
+        with io.open(args.compare, encoding="utf-8") as compare_file:
+            earlier_results = json.load(compare_file)["results"]
+
+        print("Compared to {}:".format(args.compare))
+        for compared_result, speed_up in compare_results(earlier_results, all_results):
+            print("  {:<20} {:<31} {:<6} {:6.2f}x".format(
+                compared_result["benchmark"], compared_result["name"], compared_result["tier"], speed_up))
+
+    if args.output is not None:
+        with io.open(args.output, "w", encoding="utf-8") as output_file:
+            json.dump({
+                "seed": args.seed,
+                "repeat": args.repeat,
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "results": all_results,
+            }, output_file, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
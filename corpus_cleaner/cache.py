@@ -0,0 +1,202 @@
+import hashlib
+import io
+import json
+import os
+import zlib
+from os.path import abspath, exists, getsize, isdir, join
+
+from corpus_cleaner import __version__
+from corpus_cleaner.shared import AtomicWriter
+
+DEFAULT_CACHE_SIZE = 1024 * 1024 * 1024
+# Chunks are cut at paragraph breaks chosen by their content, so an edit only moves the cuts around it
+DEFAULT_MIN_CHUNK_SIZE = 64 * 1024
+DEFAULT_MAX_CHUNK_SIZE = 4 * 1024 * 1024
+# Roughly one in this many paragraphs past the minimum size ends a chunk
+CHUNK_BOUNDARY_DIVISOR = 64
+# A cache that outgrows its size is cut down to this fraction of it, so it isn't walked again on the next put
+EVICTION_TARGET = 0.9
+
+OBJECTS_DIRECTORY = "objects"
+MANIFEST_DIRECTORY = "manifest"
+
+
+def cache_settings(**settings):
+    """
+    Fingerprint of the settings that affect an output, along with the version of the tools that made it.
+    """
+    return json.dumps(dict(settings, version=__version__), sort_keys=True)
+
+
+def chunk_blocks(blocks, min_size=DEFAULT_MIN_CHUNK_SIZE, max_size=DEFAULT_MAX_CHUNK_SIZE):
+    """
+    Joins paragraph blocks as produced by read_paragraph_blocks() into bigger chunks for caching. A chunk ends
+    after a block whose checksum says so once it's past min_size, or at max_size, so the same text gets cut in
+    the same places wherever it turns up in a file.
+    """
+    chunk = []
+    chunk_size = 0
+
+    for block in blocks:
+        chunk.append(block)
+        chunk_size += len(block)
+
+        if chunk_size >= max_size or (chunk_size >= min_size and
+                                      zlib.crc32(block.encode("utf-8", "surrogatepass")) %
+                                      CHUNK_BOUNDARY_DIVISOR == 0):
+            yield "".join(chunk)
+            chunk = []
+            chunk_size = 0
+
+    if len(chunk) != 0:
+        yield "".join(chunk)
+
+
+class ScrubCache(object):
+    """
+    On-disk cache of scrubbed chunks, keyed by a hash of their text and the settings they were scrubbed with,
+    along with a manifest of the files scrubbed so unchanged ones can be skipped altogether. Every entry is
+    its own file, so worker processes can share a cache without locking. Once a put() takes the cache past
+    max_size bytes, the least recently used chunks are removed until it fits again. Each process counts what it
+    puts from when it last looked at the whole cache, so a cache shared by several can go over by a little
+    until one of them looks again, or evict() is called at the end of a run.
+    """
+
+    def __init__(self, directory, max_size=DEFAULT_CACHE_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        # Size of the cache when this process last looked, plus what it has put since. None until it has looked
+        self._size = None
+
+    def chunk_key(self, settings, text, document_start=True, document_end=True):
+        digest = hashlib.sha256(settings.encode("utf-8"))
+        digest.update("{:d}{:d}".format(document_start, document_end).encode("ascii"))
+        digest.update(text.encode("utf-8", "surrogatepass"))
+
+        return digest.hexdigest()
+
+    def _object_path(self, key):
+        return join(self.directory, OBJECTS_DIRECTORY, key[:2], key)
+
+    def _manifest_path(self, input_path):
+        return join(self.directory, MANIFEST_DIRECTORY,
+                    hashlib.sha256(abspath(input_path).encode("utf-8", "surrogatepass")).hexdigest() + ".json")
+
+    def get(self, key):
+        """
+        Returns the scrubbed text cached under key, or None if there isn't any.
+        """
+        object_path = self._object_path(key)
+
+        try:
+            with io.open(object_path, encoding="utf-8", errors="surrogatepass", newline="") as object_file:
+                text = object_file.read()
+        except (IOError, OSError):
+            return None
+
+        try:
+            # Eviction goes by modification time, so a hit counts as a use
+            os.utime(object_path, None)
+        except OSError:
+            pass
+
+        return text
+
+    def put(self, key, text):
+        object_path = self._object_path(key)
+        os.makedirs(join(self.directory, OBJECTS_DIRECTORY, key[:2]), exist_ok=True)
+
+        with AtomicWriter(object_path, errors="surrogatepass") as object_file:
+            object_file.write(text)
+
+        if self._size is None:
+            self._size = sum(size for _, size, _ in self._cached_objects())
+        else:
+            self._size += object_file.stats.byte_count
+
+        if self._size > self.max_size:
+            self.evict(int(self.max_size * EVICTION_TARGET))
+
+    @staticmethod
+    def _file_state(path):
+        file_stat = os.stat(path)
+        return {"path": abspath(path), "size": file_stat.st_size, "mtime_ns": file_stat.st_mtime_ns}
+
+    def file_is_unchanged(self, input_path, output_path, settings):
+        """
+        Whether output_path is still what scrubbing input_path with these settings gave last time, and neither
+        has been touched since. Files scrubbed in place are never considered unchanged.
+        """
+        if abspath(input_path) == abspath(output_path) or not exists(output_path):
+            return False
+
+        try:
+            with io.open(self._manifest_path(input_path), encoding="utf-8") as manifest_file:
+                entry = json.load(manifest_file)
+        except (IOError, OSError, ValueError):
+            return False
+
+        return entry == {"settings": settings, "input": self._file_state(input_path),
+                         "output": self._file_state(output_path)}
+
+    def remember_file(self, input_path, output_path, settings):
+        """
+        Records that output_path was just scrubbed from input_path with these settings.
+        """
+        if abspath(input_path) == abspath(output_path):
+            return
+
+        os.makedirs(join(self.directory, MANIFEST_DIRECTORY), exist_ok=True)
+        entry = {"settings": settings, "input": self._file_state(input_path), "output": self._file_state(output_path)}
+
+        with AtomicWriter(self._manifest_path(input_path)) as manifest_file:
+            manifest_file.write(json.dumps(entry, sort_keys=True))
+
+    def _cached_objects(self):
+        """
+        (modification time, size, path) of every chunk in the cache.
+        """
+        objects_directory = join(self.directory, OBJECTS_DIRECTORY)
+        if not isdir(objects_directory):
+            return []
+
+        cached_objects = []
+        for directory, _, file_names in os.walk(objects_directory):
+            for file_name in file_names:
+                if file_name.startswith("."):
+                    # Still being written
+                    continue
+
+                object_path = join(directory, file_name)
+                try:
+                    cached_objects.append((os.stat(object_path).st_mtime, getsize(object_path), object_path))
+                except OSError:
+                    # Another process got to it first
+                    continue
+
+        return cached_objects
+
+    def evict(self, target_size=None):
+        """
+        Removes the least recently used chunks until the cache fits in target_size, or max_size if not given.
+        Returns how many were removed.
+        """
+        target_size = target_size if target_size is not None else self.max_size
+        cached_objects = self._cached_objects()
+        total_size = sum(size for _, size, _ in cached_objects)
+        removed = 0
+
+        for _, size, object_path in sorted(cached_objects):
+            if total_size <= target_size:
+                break
+
+            try:
+                os.remove(object_path)
+            except OSError:
+                continue
+
+            total_size -= size
+            removed += 1
+
+        self._size = total_size
+        return removed
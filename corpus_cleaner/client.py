@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+# Only the standard library bits needed to talk to the service, so the client starts in next to no time
+import json
+import os
+import socket
+import sys
+
+SOCKET_ENVIRONMENT_VARIABLE = "CORPUS_CLEANER_SOCKET"
+DEFAULT_SOCKET_PATH = os.environ.get(SOCKET_ENVIRONMENT_VARIABLE) or os.path.join(
+    os.environ.get("TMPDIR", "/tmp"), "corpus-cleaner-{}.sock".format(os.getuid()))
+
+COMMAND_SCRUB = "scrub"
+COMMAND_EQUALISE = "equalise"
+COMMAND_CLEAN = "clean"
+COMMAND_PING = "ping"
+COMMAND_SHUTDOWN = "shutdown"
+COMMANDS = [COMMAND_SCRUB, COMMAND_EQUALISE, COMMAND_CLEAN, COMMAND_PING, COMMAND_SHUTDOWN]
+
+USAGE = """usage: client.py [--socket path] {{{}}} [arguments ...]
+
+Sends a job to a running service.py and waits for it to finish. Arguments are the same as those of
+scrubber.py, equaliser.py or corpus-clean. "scrub -" scrubs stdin to stdout.""".format(",".join(COMMANDS))
+
+
+class ServiceError(Exception):
+    """
+    Raised when a job sent to the service fails.
+    """
+
+
+def request(job, socket_path=DEFAULT_SOCKET_PATH):
+    """
+    Sends a job to the service as a dict, e.g. {"command": "scrub", "arguments": ["corpus.txt"]}, and returns
+    the response once it's done. Responses hold the exit code and output the command-line tool would have given.
+    Relative paths are taken from the current directory, as they would be by the tool.
+    """
+    job = dict(job, cwd=job.get("cwd", os.getcwd()))
+
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_path)
+        connection.sendall(json.dumps(job).encode("utf-8") + b"\n")
+
+        with connection.makefile("rb") as response_file:
+            response_line = response_file.readline()
+    finally:
+        connection.close()
+
+    if len(response_line) == 0:
+        raise ServiceError("The service closed the connection without responding")
+
+    return json.loads(response_line.decode("utf-8"))
+
+
+def _checked_request(job, socket_path):
+    response = request(job, socket_path)
+    if response.get("error") is not None:
+        raise ServiceError(response["error"])
+
+    return response
+
+
+def scrub_text(text, arguments=(), socket_path=DEFAULT_SOCKET_PATH):
+    """
+    Scrubs text in the service with the options of scrubber.py, e.g. ["-s", ".!?"], returning the result.
+    """
+    return _checked_request({"command": COMMAND_SCRUB, "text": text, "arguments": list(arguments)},
+                            socket_path)["text"]
+
+
+def equalise_texts(text_a, text_b, arguments=(), socket_path=DEFAULT_SOCKET_PATH):
+    """
+    Equalises two texts in the service with the options of equaliser.py, returning the two results.
+    """
+    return _checked_request({"command": COMMAND_EQUALISE, "texts": [text_a, text_b], "arguments": list(arguments)},
+                            socket_path)["texts"]
+
+
+def main(arguments=None):
+    arguments = list(sys.argv[1:] if arguments is None else arguments)
+    socket_path = DEFAULT_SOCKET_PATH
+
+    if len(arguments) >= 2 and arguments[0] == "--socket":
+        socket_path = arguments[1]
+        arguments = arguments[2:]
+
+    if len(arguments) == 0 or arguments[0] not in COMMANDS:
+        print(USAGE, file=sys.stderr)
+        sys.exit(2)
+
+    command, arguments = arguments[0], arguments[1:]
+
+    if command == COMMAND_SCRUB and len(arguments) != 0 and arguments[0] == "-":
+        job = {"command": command, "text": sys.stdin.read(), "arguments": arguments[1:]}
+    else:
+        job = {"command": command, "arguments": arguments}
+
+    try:
+        response = request(job, socket_path)
+    except (OSError, ValueError, ServiceError) as error:
+        print("Couldn't reach the service at {}: {}".format(socket_path, error), file=sys.stderr)
+        sys.exit(1)
+
+    sys.stdout.write(response.get("output", ""))
+    if response.get("text") is not None:
+        sys.stdout.write(response["text"])
+    if response.get("error") is not None:
+        print(response["error"], file=sys.stderr)
+
+    sys.exit(response.get("exit_code") or 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,400 @@
+#!/usr/bin/env python
+
+import hashlib
+import math
+import random
+import re
+import struct
+import time
+import zlib
+from argparse import ArgumentParser
+from os.path import basename, exists
+
+from corpus_cleaner.shards import ParagraphWriter, read_paragraphs, split_paragraphs
+from corpus_cleaner.shared import COMPRESSION_AUTO, COMPRESSIONS, ensure_arg, detect_compression, open_reader, \
+    AtomicWriter, format_throughput, RunStats
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+DEFAULT_ENCODING = "utf-8"
+# Sizes the filters: 10 million sentences at a one in a million false positive rate take about 36MB for exact
+# duplicates, and about 8 times that again with near-duplicates
+DEFAULT_EXPECTED_SENTENCES = 10 * 1000 * 1000
+DEFAULT_FALSE_POSITIVE_RATE = 1e-6
+
+# Sentences are compared for near-duplicates by the char n-grams they have in common
+DEFAULT_SHINGLE_SIZE = 5
+# Signatures are cut into bands of rows, and sentences with any band in common count as near-duplicates.
+# 8 bands of 8 catch most pairs that share more than roughly 3/4 of their shingles.
+DEFAULT_BANDS = 8
+DEFAULT_ROWS = 8
+DEFAULT_SEED = 1
+
+ENGINE_PYTHON = "python"
+ENGINE_NUMPY = "numpy"
+ENGINES = [ENGINE_PYTHON, ENGINE_NUMPY]
+DEFAULT_ENGINE = ENGINE_PYTHON
+
+# Shingles hash to 32 bits, and a prime just over that keeps every permutation of them one-to-one
+MINHASH_PRIME = 4294967311
+# Parallel sentences are fingerprinted together, joined by a char neither can contain
+PAIR_SEPARATOR = "\n"
+
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
+DUPLICATE_EXACT = "exact"
+DUPLICATE_NEAR = "near"
+
+
+class BloomFilter(object):
+    """
+    Fixed-size set of byte strings which can say for certain that it hasn't seen one, but only that it probably
+    has. Sized for capacity items at the given false positive rate, after which false positives get more likely
+    but memory use stays the same.
+    """
+
+    def __init__(self, capacity, false_positive_rate=DEFAULT_FALSE_POSITIVE_RATE):
+        self.bit_count = max(8, int(math.ceil(-capacity * math.log(false_positive_rate) / math.log(2) ** 2)))
+        self.hash_count = max(1, int(round(float(self.bit_count) / capacity * math.log(2))))
+        self.bits = bytearray((self.bit_count + 7) // 8)
+
+    def _positions(self, key):
+        # Every bit position comes from two hashes of the key, combined differently for each one
+        first_hash, second_hash = struct.unpack("<QQ", hashlib.sha256(key).digest()[:16])
+        second_hash |= 1
+
+        return [(first_hash + hash_index * second_hash) % self.bit_count for hash_index in range(self.hash_count)]
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+    def add(self, key):
+        """
+        Adds key, returning whether it was probably there already.
+        """
+        present = True
+
+        for position in self._positions(key):
+            mask = 1 << (position & 7)
+            if not self.bits[position >> 3] & mask:
+                present = False
+                self.bits[position >> 3] |= mask
+
+        return present
+
+
+def shingle_hashes(text, shingle_size=DEFAULT_SHINGLE_SIZE):
+    """
+    32-bit hashes of the distinct char n-grams of text, lowercased and with whitespace runs as single spaces.
+    Text shorter than shingle_size is one shingle.
+    """
+    text = WHITESPACE_PATTERN.sub(" ", text.lower()).strip().encode("utf-8", "surrogatepass")
+    if len(text) <= shingle_size:
+        return [zlib.crc32(text)]
+
+    return list({zlib.crc32(text[start:start + shingle_size]) for start in range(len(text) - shingle_size + 1)})
+
+
+def minhash_permutations(count, seed=DEFAULT_SEED):
+    """
+    The (a, b) pairs of count random hash permutations, x -> (a * x + b) % MINHASH_PRIME.
+    """
+    generator = random.Random(seed)
+    # Kept under 2 ** 32 so the NumPy engine can work them out in 64 bits
+    return [(generator.randint(1, 2 ** 32 - 1), generator.randint(0, 2 ** 32 - 1)) for _ in range(count)]
+
+
+def minhash_signature(hashes, permutations):
+    """
+    Smallest value of each permutation over the shingle hashes. Two texts agree on any one of them with
+    a probability of the Jaccard similarity of their shingles.
+    """
+    return [min((a * value + b) % MINHASH_PRIME for value in hashes) for a, b in permutations]
+
+
+def minhash_signature_numpy(hashes, permutations):
+    """
+    Same as minhash_signature(), working out every permutation of every hash at once with NumPy.
+    """
+    values = numpy.asarray(hashes, dtype=numpy.uint64)
+    a_values = numpy.asarray([a for a, _ in permutations], dtype=numpy.uint64)[:, None]
+    b_values = numpy.asarray([b for _, b in permutations], dtype=numpy.uint64)[:, None]
+
+    return [int(value) for value in ((a_values * values + b_values) % numpy.uint64(MINHASH_PRIME)).min(axis=1)]
+
+
+class Deduplicator(object):
+    """
+    Spots sentences, or aligned pairs of sentences, seen before in a run. Exact duplicates are found with
+    a Bloom filter of everything seen. Near-duplicates, if asked for, are found with MinHash locality sensitive
+    hashing, keeping the bands of every signature in a second Bloom filter. Memory use is fixed up front by
+    expected_sentences and false_positive_rate, however much text goes through. A false positive drops a
+    sentence which wasn't really a duplicate.
+    """
+
+    def __init__(self, expected_sentences=DEFAULT_EXPECTED_SENTENCES, false_positive_rate=DEFAULT_FALSE_POSITIVE_RATE,
+                 near_duplicates=False, shingle_size=DEFAULT_SHINGLE_SIZE, bands=DEFAULT_BANDS, rows=DEFAULT_ROWS,
+                 seed=DEFAULT_SEED, engine=DEFAULT_ENGINE):
+        self.exact_filter = BloomFilter(expected_sentences, false_positive_rate)
+        self.near_filter = None
+        self.shingle_size = shingle_size
+        self.bands = bands
+        self.rows = rows
+
+        if near_duplicates:
+            # A sentence goes in once per band, and any band being a false positive makes the sentence one
+            self.near_filter = BloomFilter(expected_sentences * bands, false_positive_rate / bands)
+            self.permutations = minhash_permutations(bands * rows, seed=seed)
+            self.signature_function = minhash_signature_numpy if engine == ENGINE_NUMPY and numpy is not None \
+                else minhash_signature
+
+    def check(self, text):
+        """
+        Records text as seen, returning DUPLICATE_EXACT or DUPLICATE_NEAR if it was seen before, or else None.
+        Empty text is never a duplicate.
+        """
+        if len(text) == 0:
+            return None
+
+        if self.exact_filter.add(text.encode("utf-8", "surrogatepass")):
+            return DUPLICATE_EXACT
+
+        if self.near_filter is None:
+            return None
+
+        signature = self.signature_function(shingle_hashes(text, self.shingle_size), self.permutations)
+        seen_band = False
+        for band in range(self.bands):
+            band_key = struct.pack("<I{}Q".format(self.rows), band, *signature[band * self.rows:(band + 1) * self.rows])
+            # Add every band, so later near-duplicates of this one get caught too
+            seen_band = self.near_filter.add(band_key) or seen_band
+
+        return DUPLICATE_NEAR if seen_band else None
+
+    def check_pair(self, a_sentence, b_sentence):
+        """
+        Same as check(), for an aligned pair of sentences, which is only a duplicate as a pair.
+        """
+        if len(a_sentence) == 0 and len(b_sentence) == 0:
+            return None
+
+        return self.check(a_sentence + PAIR_SEPARATOR + b_sentence)
+
+
+def record_duplicate(stats, duplicate):
+    if stats is not None and duplicate is not None:
+        stats.increment("{}_duplicates_removed".format(duplicate))
+
+
+def deduplicate_paragraph(sentences, deduplicator, stats=None):
+    """
+    The sentences of a paragraph which haven't been seen before.
+    """
+    kept_sentences = []
+
+    for sentence in sentences:
+        duplicate = deduplicator.check(sentence)
+        record_duplicate(stats, duplicate)
+        if duplicate is None:
+            kept_sentences.append(sentence)
+
+    return kept_sentences
+
+
+def deduplicate_text(pieces, deduplicator, stats=None):
+    """
+    Removes duplicate sentences from one-sentence-per-line text, e.g. as it's scrubbed, yielding what's left
+    a paragraph at a time. Paragraphs left with no sentences are removed along with their line-breaks.
+    With nothing to remove, the text comes out as it went in.
+    """
+    first_paragraph = True
+
+    for paragraph in split_paragraphs(pieces):
+        sentences = paragraph.split("\n")
+        kept_sentences = deduplicate_paragraph(sentences, deduplicator, stats=stats)
+
+        if len(kept_sentences) == 0:
+            continue
+
+        yield ("" if first_paragraph else "\n\n") + "\n".join(kept_sentences)
+        first_paragraph = False
+
+
+def deduplicate_paragraph_pairs(paragraph_pairs, deduplicator, stats=None):
+    """
+    Removes duplicate pairs of sentences from equalised (a sentences, b sentences) paragraph pairs, taking
+    both sentences of a pair out together so the two sides stay aligned.
+    """
+    for a_para, b_para in paragraph_pairs:
+        kept_a_para = []
+        kept_b_para = []
+
+        for a_sentence, b_sentence in zip(a_para, b_para):
+            duplicate = deduplicator.check_pair(a_sentence, b_sentence)
+            record_duplicate(stats, duplicate)
+            if duplicate is None:
+                kept_a_para.append(a_sentence)
+                kept_b_para.append(b_sentence)
+
+        yield kept_a_para, kept_b_para
+
+
+def removed_count(stats):
+    """
+    How many duplicates have been removed in all, going by the counters in stats.
+    """
+    return sum(stats.counters.get(name, 0) for name in ["exact_duplicates_removed", "near_duplicates_removed"])
+
+
+def deduplicate_file(path, deduplicator, buffer_size=1024 * 1024, compression=COMPRESSION_AUTO,
+                     encoding=DEFAULT_ENCODING, stats=None):
+    """
+    Removes duplicate sentences from a scrubbed file in place, reading and writing it a paragraph at a time.
+    Sentences seen in earlier files given the same deduplicator count as duplicates too.
+    """
+    started = time.perf_counter()
+    file_compression = detect_compression(path, compression)
+    # Counts are needed for the report even when stats aren't being kept
+    file_stats = RunStats()
+
+    with AtomicWriter(path, encoding, compression=file_compression) as output_file:
+        with open_reader(path, encoding, compression=file_compression, translate_newlines=True) as input_file:
+            pieces = iter(lambda: input_file.read(buffer_size), "")
+            for deduplicated_piece in deduplicate_text(pieces, deduplicator, stats=file_stats):
+                output_file.write(deduplicated_piece)
+
+    if stats is not None:
+        stats.merge(file_stats.as_dict())
+        stats.record_file(path, seconds=time.perf_counter() - started, bytes_read=input_file.stats.byte_count,
+                          read_seconds=input_file.stats.seconds, bytes_written=output_file.stats.byte_count,
+                          write_seconds=output_file.stats.seconds)
+
+    print("Deduplicated {}. Sentences removed: {}".format(basename(path), removed_count(file_stats)))
+    print(format_throughput(input_file.stats, output_file.stats))
+
+
+def deduplicate_file_pair(file_a, file_b, deduplicator, buffer_size=1024 * 1024, compression=COMPRESSION_AUTO,
+                          encoding=DEFAULT_ENCODING, stats=None):
+    """
+    Removes duplicate sentence pairs from two equalised files in place, keeping them aligned. Neither file is
+    replaced until both have been written.
+    """
+    started = time.perf_counter()
+    a_compression = detect_compression(file_a, compression)
+    b_compression = detect_compression(file_b, compression)
+    file_stats = RunStats()
+
+    with AtomicWriter(file_a, encoding, compression=a_compression) as a_output, \
+            AtomicWriter(file_b, encoding, compression=b_compression) as b_output:
+        with open_reader(file_a, encoding, compression=a_compression, translate_newlines=True) as a_input, \
+                open_reader(file_b, encoding, compression=b_compression, translate_newlines=True) as b_input:
+            paragraph_pairs = ((a_paragraph.split("\n"), b_paragraph.split("\n"))
+                               for a_paragraph, b_paragraph in zip(read_paragraphs(a_input, buffer_size),
+                                                                   read_paragraphs(b_input, buffer_size)))
+
+            a_writer = ParagraphWriter(a_output)
+            b_writer = ParagraphWriter(b_output)
+            for a_para, b_para in deduplicate_paragraph_pairs(paragraph_pairs, deduplicator, stats=file_stats):
+                a_writer.write(a_para)
+                b_writer.write(b_para)
+
+    if stats is not None:
+        stats.merge(file_stats.as_dict())
+        for path, reader, writer in [(file_a, a_input, a_output), (file_b, b_input, b_output)]:
+            stats.record_file(path, seconds=time.perf_counter() - started, bytes_read=reader.stats.byte_count,
+                              read_seconds=reader.stats.seconds, bytes_written=writer.stats.byte_count,
+                              write_seconds=writer.stats.seconds)
+
+    print("Deduplicated {} & {}. Pairs removed: {}".format(basename(file_a), basename(file_b),
+                                                          removed_count(file_stats)))
+    print(format_throughput(a_input.stats + b_input.stats, a_output.stats + b_output.stats))
+
+
+def add_dedup_arguments(parser):
+    """
+    Adds the options for sizing and tuning a Deduplicator to a parser.
+    """
+    parser.add_argument("--near-duplicates", dest="near_duplicates", default=False, action="store_true",
+                        help="Also remove sentences which are nearly the same as one seen before.")
+
+    parser.add_argument("--expected-sentences", metavar="count", dest="expected_sentences", type=int,
+                        default=DEFAULT_EXPECTED_SENTENCES,
+                        help="How many sentences to size the duplicate filters for. Default: {}".format(
+                            DEFAULT_EXPECTED_SENTENCES))
+
+    parser.add_argument("--false-positive-rate", metavar="rate", dest="false_positive_rate", type=float,
+                        default=DEFAULT_FALSE_POSITIVE_RATE,
+                        help="How often a new sentence can be mistaken for a duplicate. Default: {}".format(
+                            DEFAULT_FALSE_POSITIVE_RATE))
+
+    parser.add_argument("--dedup-engine", dest="dedup_engine", type=str, choices=ENGINES, default=DEFAULT_ENGINE,
+                        help="How to work out near-duplicate signatures. Default: {}".format(DEFAULT_ENGINE))
+
+
+def check_dedup_arguments(args, parser):
+    ensure_arg(args.expected_sentences > 0, "Expected sentence count must be positive.", parser)
+    ensure_arg(0 < args.false_positive_rate < 1, "False positive rate must be between 0 and 1.", parser)
+
+
+def create_deduplicator(args):
+    """
+    Makes a Deduplicator from the options added by add_dedup_arguments().
+    """
+    return Deduplicator(args.expected_sentences, args.false_positive_rate, near_duplicates=args.near_duplicates,
+                        engine=args.dedup_engine)
+
+
+def create_arg_parser():
+    description = "Removes sentences, or aligned pairs of them, which have been seen before."
+    parser = ArgumentParser(description=description)
+
+    parser.add_argument("files", metavar="file", type=str, nargs="+",
+                        help="Scrubbed or equalised files to deduplicate in place, as one corpus.")
+
+    parser.add_argument("--parallel", dest="parallel", default=False, action="store_true",
+                        help="Treat two files as an equalised pair, removing duplicate pairs of sentences together.")
+
+    parser.add_argument("--compression", dest="compression", type=str, choices=COMPRESSIONS, default=COMPRESSION_AUTO,
+                        help="How the files are compressed. Default: {}, going by file extension".format(
+                            COMPRESSION_AUTO))
+
+    parser.add_argument("--encoding", metavar="encoding", type=str, dest="encoding", default=DEFAULT_ENCODING,
+                        help="What encoding the files are in. Default: {}".format(DEFAULT_ENCODING))
+
+    parser.add_argument("--stats", metavar="stats-path", type=str, dest="stats",
+                        help="Write how many duplicates were removed, and per-file figures, as JSON.")
+
+    add_dedup_arguments(parser)
+
+    return parser
+
+
+def main(arguments=None):
+    arg_parser = create_arg_parser()
+    args = arg_parser.parse_args(arguments)
+
+    for path in args.files:
+        ensure_arg(exists(path), "File {} doesn't exist.".format(path), arg_parser)
+    ensure_arg(not args.parallel or len(args.files) == 2, "Only a pair of files can be parallel.", arg_parser)
+    check_dedup_arguments(args, arg_parser)
+
+    run_stats = RunStats() if args.stats is not None else None
+    deduplicator = create_deduplicator(args)
+
+    if args.parallel:
+        deduplicate_file_pair(args.files[0], args.files[1], deduplicator, compression=args.compression,
+                              encoding=args.encoding, stats=run_stats)
+    else:
+        for path in args.files:
+            deduplicate_file(path, deduplicator, compression=args.compression, encoding=args.encoding,
+                             stats=run_stats)
+
+    if run_stats is not None:
+        run_stats.write_json(args.stats)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,48 @@
 #!/usr/bin/env python
 
+import math
+import os
 import re
+import time
 from argparse import ArgumentParser
-from os.path import exists, basename
+from contextlib import ExitStack
+from functools import partial
+from itertools import zip_longest
+from multiprocessing import Pool
+from os.path import abspath, exists, basename, isdir, isfile, join, relpath
 
-from corpus_cleaner.shared import DEFAULT_STOP_CHARS, join_regex, ensure_arg
+from corpus_cleaner.cache import cache_settings
+from corpus_cleaner.index import check_indexable, index_path
+from corpus_cleaner.shards import ParagraphWriter, ShardWriter, add_shard_arguments, check_shard_arguments, \
+    create_shard_size, read_paragraphs, split_paragraphs
+from corpus_cleaner.shared import DEFAULT_STOP_CHARS, COMPRESSION_AUTO, COMPRESSIONS, join_regex, ensure_arg, \
+    imap_bounded, detect_compression, open_reader, AtomicWriter, format_throughput, RunStats
+from corpus_cleaner.workqueue import add_queue_arguments, check_queue_arguments, create_work_queue
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 DEFAULT_SENTENCE_RATIO = 0.6
 DEFAULT_LOWERCASE_GLUED = True
+DEFAULT_ENCODING = "utf-8"
+DEFAULT_BUFFER_SIZE = 1024 * 1024
+DEFAULT_WORKERS = 1
+# Roughly how many chars of paragraphs to send to a worker at once
+DEFAULT_BATCH_SIZE = 256 * 1024
+
+ENGINE_PYTHON = "python"
+ENGINE_NUMPY = "numpy"
+ENGINES = [ENGINE_PYTHON, ENGINE_NUMPY]
+DEFAULT_ENGINE = ENGINE_PYTHON
+
+# How many sentences the NumPy engine compares at once when looking for the end of a run of equivalent pairs
+NUMPY_WINDOW_SIZES = [16, 256, 4096]
+# Below this many sentences on either side, setting up the arrays costs more than NumPy saves, so the numpy
+# engine plans in plain Python. benchmark.py's planner comparison only has NumPy ahead on evenly matched
+# paragraphs of 128 sentences or more
+NUMPY_MIN_SENTENCES = 256
 
 A_IS_LONGER = -1
 BOTH_EQUIVALENT = 0
@@ -32,13 +67,17 @@ def merge(paragraphs):
     return "\n\n".join(filter(lambda paragraph: len(paragraph) != 0, paragraphs))
 
 
-def compare_sentences(sentence_a, sentence_b, sentence_ratio=DEFAULT_SENTENCE_RATIO):
+def count_words(sentence):
     """
-    Returns (A_IS_HIGHER | SENTENCES_EQUIVALENT | B_IS_HIGHER) while keeping into account sentence ratio.
+    Word count as used when comparing sentences, i.e. the number of space-separated chunks.
     """
-    a_word_count = len(sentence_a.split(" "))
-    b_word_count = len(sentence_b.split(" "))
+    return sentence.count(" ") + 1
+
 
+def compare_word_counts(a_word_count, b_word_count, sentence_ratio=DEFAULT_SENTENCE_RATIO):
+    """
+    Same as compare_sentences(), but for sentences whose word counts are already known.
+    """
     a_higher = a_word_count * sentence_ratio > b_word_count
     b_higher = b_word_count * sentence_ratio > a_word_count
 
@@ -48,6 +87,13 @@ def compare_sentences(sentence_a, sentence_b, sentence_ratio=DEFAULT_SENTENCE_RA
     return A_IS_LONGER if a_higher else B_IS_LONGER
 
 
+def compare_sentences(sentence_a, sentence_b, sentence_ratio=DEFAULT_SENTENCE_RATIO):
+    """
+    Returns (A_IS_HIGHER | SENTENCES_EQUIVALENT | B_IS_HIGHER) while keeping into account sentence ratio.
+    """
+    return compare_word_counts(count_words(sentence_a), count_words(sentence_b), sentence_ratio=sentence_ratio)
+
+
 def glue_sentences(first, second, lowercase_glued=DEFAULT_LOWERCASE_GLUED, stop_chars=DEFAULT_STOP_CHARS):
     """
     Attached two sentences together, removing punctuation
@@ -61,17 +107,329 @@ def glue_sentences(first, second, lowercase_glued=DEFAULT_LOWERCASE_GLUED, stop_
     return "{} {}".format(first, second)
 
 
+def glue_run(sentences, lowercase_glued=DEFAULT_LOWERCASE_GLUED, stop_chars=DEFAULT_STOP_CHARS):
+    """
+    Glues a run of sentences together in one go. Same as gluing each one onto the result of the last,
+    without copying the growing sentence every time.
+    """
+    if len(sentences) == 1:
+        return sentences[0]
+
+    stop_char_pattern = re.compile(r"({})$".format(join_regex(stop_chars)))
+    pieces = [sentences[0]]
+
+    for sentence in sentences[1:]:
+        if lowercase_glued and len(sentence) != 0:
+            sentence = sentence[0].lower() + sentence[1:]
+        pieces.append(sentence)
+
+    # Gluing only ever strips the end of what came before, i.e. the end of each piece but the last
+    pieces = [stop_char_pattern.sub("", piece) for piece in pieces[:-1]] + pieces[-1:]
+
+    return " ".join(pieces)
+
+
+def plan_merges(a_word_counts, b_word_counts, sentence_ratio=DEFAULT_SENTENCE_RATIO):
+    """
+    Works out which runs of sentences equalise_paragraphs() glues together, going by word counts alone.
+    Returns a list of ((a start, a end), (b start, b end)) pairs of index ranges, one per equalised pair.
+    """
+    merge_plan = []
+
+    a_length = len(a_word_counts)
+    b_length = len(b_word_counts)
+
+    a_start = a_index = 0
+    b_start = b_index = 0
+
+    # Word counts of the sentences we're building up, i.e. the runs glued together so far
+    a_word_count = a_word_counts[0] if a_length != 0 else 0
+    b_word_count = b_word_counts[0] if b_length != 0 else 0
+
+    while a_index < a_length and b_index < b_length:
+        comparison_result = compare_word_counts(a_word_count, b_word_count, sentence_ratio=sentence_ratio)
+
+        if comparison_result == B_IS_LONGER:
+            if a_index + 1 == a_length:
+                # Nothing left to glue on
+                break
+
+            # Gluing adds a space but takes nothing away, so the word counts just add up
+            glued_word_count = a_word_count + a_word_counts[a_index + 1]
+
+            if compare_word_counts(glued_word_count, b_word_count, sentence_ratio=sentence_ratio) != A_IS_LONGER:
+                a_word_count = glued_word_count
+                a_index += 1
+            else:
+                # Force a push
+                comparison_result = BOTH_EQUIVALENT
+        elif comparison_result == A_IS_LONGER:
+            if b_index + 1 == b_length:
+                break
+
+            glued_word_count = b_word_count + b_word_counts[b_index + 1]
+
+            if compare_word_counts(a_word_count, glued_word_count, sentence_ratio=sentence_ratio) != B_IS_LONGER:
+                b_word_count = glued_word_count
+                b_index += 1
+            else:
+                comparison_result = BOTH_EQUIVALENT
+
+        if comparison_result == BOTH_EQUIVALENT:
+            # Sentences are close enough to being equal. Keep going.
+            merge_plan.append(((a_start, a_index + 1), (b_start, b_index + 1)))
+
+            a_start = a_index = a_index + 1
+            b_start = b_index = b_index + 1
+
+            if a_index < a_length and b_index < b_length:
+                a_word_count = a_word_counts[a_index]
+                b_word_count = b_word_counts[b_index]
+
+    return merge_plan
+
+
+def _word_count_thresholds(word_count, sentence_ratio):
+    """
+    For a sentence of word_count words on one side, returns the largest word count the other side can have
+    while still being shorter, and the smallest one it can have while being longer, as compare_word_counts()
+    sees them.
+    """
+    # compare_word_counts() checks word_count * sentence_ratio > other
+    shorter_limit = int(math.ceil(word_count * sentence_ratio)) - 1
+
+    # ...and other * sentence_ratio > word_count, which goes up with other, so step to where it flips
+    longer_limit = int(word_count / sentence_ratio)
+    while longer_limit > 0 and (longer_limit - 1) * sentence_ratio > word_count:
+        longer_limit -= 1
+    while not longer_limit * sentence_ratio > word_count:
+        longer_limit += 1
+
+    return shorter_limit, longer_limit
+
+
+def _find_run_end(cumulative_counts, start, length, shorter_limit, glue_limit):
+    """
+    Finds where a run of sentences starting at start stops being glued onto. The run keeps growing while
+    its word count is at most shorter_limit, as long as gluing on the next sentence keeps it under
+    glue_limit. Returns (end, exhausted), where exhausted means it ran out of sentences while still too short.
+    """
+    base = cumulative_counts[start]
+
+    equivalent_end = max(start + 1, int(numpy.searchsorted(cumulative_counts, base + shorter_limit, "right")))
+    too_long_end = max(start + 1, int(numpy.searchsorted(cumulative_counts, base + glue_limit, "left")) - 1)
+
+    if equivalent_end <= min(too_long_end, length):
+        return equivalent_end, False
+    if length <= too_long_end:
+        return length, True
+
+    return too_long_end, False
+
+
+def plan_merges_numpy(a_word_counts, b_word_counts, sentence_ratio=DEFAULT_SENTENCE_RATIO):
+    """
+    Same as plan_merges(), using NumPy. Stretches of one-to-one pairs are compared a window at a time,
+    and runs of merges are found with binary searches over cumulative word counts, rather than stepping
+    through one sentence at a time.
+    """
+    a_length = len(a_word_counts)
+    b_length = len(b_word_counts)
+
+    if sentence_ratio <= 0:
+        # Neither side can ever be longer than the other
+        return [((index, index + 1), (index, index + 1)) for index in range(min(a_length, b_length))]
+
+    a_counts = numpy.asarray(a_word_counts, dtype=numpy.int64)
+    b_counts = numpy.asarray(b_word_counts, dtype=numpy.int64)
+    a_cumulative = numpy.concatenate([[0], numpy.cumsum(a_counts)])
+    b_cumulative = numpy.concatenate([[0], numpy.cumsum(b_counts)])
+
+    merge_plan = []
+    a_index = 0
+    b_index = 0
+
+    while a_index < a_length and b_index < b_length:
+        # Take as many one-to-one pairs as possible, widening the window while they keep coming
+        for window_size in NUMPY_WINDOW_SIZES:
+            window_length = min(window_size, a_length - a_index, b_length - b_index)
+            a_window = a_counts[a_index:a_index + window_length]
+            b_window = b_counts[b_index:b_index + window_length]
+
+            uneven = (a_window * sentence_ratio > b_window) | (b_window * sentence_ratio > a_window)
+            equivalent_count = int(numpy.argmax(uneven)) if uneven.any() else window_length
+
+            merge_plan.extend(((a_index + offset, a_index + offset + 1), (b_index + offset, b_index + offset + 1))
+                              for offset in range(equivalent_count))
+            a_index += equivalent_count
+            b_index += equivalent_count
+
+            if equivalent_count < window_length or a_index == a_length or b_index == b_length:
+                break
+
+        if a_index == a_length or b_index == b_length:
+            break
+        if compare_word_counts(a_word_counts[a_index], b_word_counts[b_index], sentence_ratio) == BOTH_EQUIVALENT:
+            # The widest window was all equivalent pairs, so go round again
+            continue
+
+        if compare_word_counts(a_word_counts[a_index], b_word_counts[b_index], sentence_ratio) == B_IS_LONGER:
+            shorter_limit, longer_limit = _word_count_thresholds(b_word_counts[b_index], sentence_ratio)
+            a_end, exhausted = _find_run_end(a_cumulative, a_index, a_length, shorter_limit, longer_limit)
+            b_end = b_index + 1
+        else:
+            shorter_limit, longer_limit = _word_count_thresholds(a_word_counts[a_index], sentence_ratio)
+            # compare_word_counts() favours A when both count as longer, which only matters for ratios over 1
+            glue_limit = max(longer_limit, shorter_limit + 1)
+            b_end, exhausted = _find_run_end(b_cumulative, b_index, b_length, shorter_limit, glue_limit)
+            a_end = a_index + 1
+
+        if exhausted:
+            break
+
+        merge_plan.append(((a_index, a_end), (b_index, b_end)))
+        a_index = a_end
+        b_index = b_end
+
+    return merge_plan
+
+
+def _plan_merges_n(lengths, run_word_count, sentence_ratio):
+    """
+    Does the planning for plan_merges_n(), given how many sentences each side has and a function
+    giving the word count of the run of sentences from start to end on a side once glued.
+    """
+    side_count = len(lengths)
+    merge_plan = []
+
+    if side_count == 0 or 0 in lengths:
+        return merge_plan
+
+    starts = [0] * side_count
+    ends = [1] * side_count
+    word_counts = [run_word_count(side, 0, 1) for side in range(side_count)]
+
+    while True:
+        # Everything is measured against whichever side is longest so far, favouring the first on a tie
+        longest = max(range(side_count), key=lambda side: word_counts[side])
+        longest_word_count = word_counts[longest]
+        glued_any = False
+
+        for side in range(side_count):
+            if compare_word_counts(word_counts[side], longest_word_count, sentence_ratio) != B_IS_LONGER:
+                continue
+            if ends[side] == lengths[side]:
+                # Nothing left to glue on
+                return merge_plan
+
+            glued_word_count = run_word_count(side, starts[side], ends[side] + 1)
+            if compare_word_counts(glued_word_count, longest_word_count, sentence_ratio) != A_IS_LONGER:
+                word_counts[side] = glued_word_count
+                ends[side] += 1
+                glued_any = True
+
+        if glued_any:
+            # The longest side may have changed, so look again
+            continue
+
+        # Every side is either close enough to the longest, or would overshoot it if glued onto any further
+        merge_plan.append(tuple(zip(starts, ends)))
+
+        if any(end == length for end, length in zip(ends, lengths)):
+            return merge_plan
+
+        starts = ends
+        ends = [end + 1 for end in ends]
+        word_counts = [run_word_count(side, starts[side], ends[side]) for side in range(side_count)]
+
+
+def plan_merges_n(word_counts, sentence_ratio=DEFAULT_SENTENCE_RATIO):
+    """
+    Same as plan_merges(), for any number of sides given as a list of word count lists. Returns a list of
+    tuples holding a (start, end) index range per side, one per equalised row. Sides shorter than the longest
+    one are glued onto until they're equivalent to it, so every side keeps the same number of sentences.
+    """
+    cumulative_counts = []
+    for side_word_counts in word_counts:
+        side_cumulative_counts = [0]
+        for word_count in side_word_counts:
+            side_cumulative_counts.append(side_cumulative_counts[-1] + word_count)
+        cumulative_counts.append(side_cumulative_counts)
+
+    return _plan_merges_n([len(side_word_counts) for side_word_counts in word_counts],
+                          lambda side, start, end: cumulative_counts[side][end] - cumulative_counts[side][start],
+                          sentence_ratio)
+
+
+def record_equalised_group(stats, lengths, used, row_count):
+    """
+    Counts what happened to the sentences of a group of parallel paragraphs, given how many sentences each side
+    had, how many made it into the output and how many rows they made. The rest were dropped at the end of the
+    paragraph.
+    """
+    stats.increment("pairs_emitted", row_count)
+    stats.increment("sentences_glued", sum(used) - len(used) * row_count)
+    stats.increment("sentences_dropped", sum(lengths) - sum(used))
+
+
+def record_equalised_paragraph(stats, a_length, b_length, a_used, b_used, pair_count):
+    """
+    Counts what happened to the sentences of a paragraph pair, given how many sentences each side had, how many
+    made it into the output and how many pairs they made. The rest were dropped at the end of the paragraph.
+    """
+    record_equalised_group(stats, [a_length, b_length], [a_used, b_used], pair_count)
+
+
 def equalise_paragraphs(a_para, b_para, sentence_ratio=DEFAULT_SENTENCE_RATIO, lowercase_glued=DEFAULT_LOWERCASE_GLUED,
-                        stop_chars=DEFAULT_STOP_CHARS):
+                        stop_chars=DEFAULT_STOP_CHARS, engine=DEFAULT_ENGINE, stats=None):
     """
     Glues together two collections of sentences so that they're of similar
     word-length. Discards sentences it cannot make parallel.
+    The numpy engine plans the merges with NumPy, falling back to plain Python if it isn't installed or the
+    paragraphs are shorter than NUMPY_MIN_SENTENCES.
+    """
+    if any(" " in stop_char for stop_char in stop_chars):
+        # Stripping a stop char could take a word with it, so word counts can't simply be added up
+        return equalise_paragraphs_reference(a_para, b_para, sentence_ratio=sentence_ratio,
+                                             lowercase_glued=lowercase_glued, stop_chars=stop_chars, stats=stats)
+
+    plan_function = plan_merges
+    if engine == ENGINE_NUMPY and numpy is not None and min(len(a_para), len(b_para)) >= NUMPY_MIN_SENTENCES:
+        plan_function = plan_merges_numpy
+
+    merge_plan = plan_function([count_words(sentence) for sentence in a_para],
+                               [count_words(sentence) for sentence in b_para], sentence_ratio=sentence_ratio)
+
+    if stats is not None:
+        # Runs are planned back to back from the start, so the last one ends where the sentences ran out
+        (_, a_used), (_, b_used) = merge_plan[-1] if len(merge_plan) != 0 else ((0, 0), (0, 0))
+        record_equalised_paragraph(stats, len(a_para), len(b_para), a_used, b_used, len(merge_plan))
+
+    # Only now build the sentences that actually make it into the output
+    equalised_a_para = [glue_run(a_para[a_start:a_end], lowercase_glued=lowercase_glued, stop_chars=stop_chars)
+                        for (a_start, a_end), _ in merge_plan]
+    equalised_b_para = [glue_run(b_para[b_start:b_end], lowercase_glued=lowercase_glued, stop_chars=stop_chars)
+                        for _, (b_start, b_end) in merge_plan]
+
+    return equalised_a_para, equalised_b_para
+
+
+def equalise_paragraphs_reference(a_para, b_para, sentence_ratio=DEFAULT_SENTENCE_RATIO,
+                                  lowercase_glued=DEFAULT_LOWERCASE_GLUED, stop_chars=DEFAULT_STOP_CHARS, stats=None):
+    """
+    Straightforward version of equalise_paragraphs() which glues sentences together as it goes.
+    Slower on long runs of merges, but kept as the reference the faster version is checked against.
     """
+    a_para = list(a_para)
+    b_para = list(b_para)
     equalised_a_para = []
     equalised_b_para = []
 
     a_index = 0
     b_index = 0
+    # Glued sentences take the place of the last one in them, so these are how many made it into the output
+    a_used = 0
+    b_used = 0
 
     # Keep merging while we still have sentences to draw from
     while a_index < len(a_para) and b_index < len(b_para):
@@ -112,15 +470,148 @@ def equalise_paragraphs(a_para, b_para, sentence_ratio=DEFAULT_SENTENCE_RATIO, l
                 equalised_b_para.append(b_sentence)
                 a_index += 1
                 b_index += 1
+                a_used = a_index
+                b_used = b_index
         except IndexError:
             # Hit if we try to access any next_sentence that doesn't exist. We're done if that happens.
             break
 
+    if stats is not None:
+        record_equalised_paragraph(stats, len(a_para), len(b_para), a_used, b_used, len(equalised_a_para))
+
     return equalised_a_para, equalised_b_para
 
 
+def equalise_paragraphs_n(paragraphs, sentence_ratio=DEFAULT_SENTENCE_RATIO,
+                          lowercase_glued=DEFAULT_LOWERCASE_GLUED, stop_chars=DEFAULT_STOP_CHARS,
+                          engine=DEFAULT_ENGINE, stats=None):
+    """
+    Same as equalise_paragraphs(), for a tuple of any number of parallel paragraphs, each a list of sentences.
+    Returns a tuple of equalised paragraphs which all have the same number of sentences.
+    Two paragraphs are equalised exactly as equalise_paragraphs() would, engine and all. Any more are always
+    planned in plain Python.
+    """
+    if len(paragraphs) == 2:
+        return equalise_paragraphs(paragraphs[0], paragraphs[1], sentence_ratio=sentence_ratio,
+                                   lowercase_glued=lowercase_glued, stop_chars=stop_chars, engine=engine,
+                                   stats=stats)
+
+    paragraphs = [list(para) for para in paragraphs]
+    lengths = [len(para) for para in paragraphs]
+
+    if any(" " in stop_char for stop_char in stop_chars):
+        # Stripping a stop char could take a word with it, so count the words of each run once it's glued
+        merge_plan = _plan_merges_n(lengths, lambda side, start, end: count_words(
+            glue_run(paragraphs[side][start:end], lowercase_glued=lowercase_glued, stop_chars=stop_chars)),
+                                    sentence_ratio)
+    else:
+        merge_plan = plan_merges_n([[count_words(sentence) for sentence in para] for para in paragraphs],
+                                   sentence_ratio=sentence_ratio)
+
+    if stats is not None:
+        used = [end for _, end in merge_plan[-1]] if len(merge_plan) != 0 else [0] * len(paragraphs)
+        record_equalised_group(stats, lengths, used, len(merge_plan))
+
+    # Only now build the sentences that actually make it into the output
+    return tuple([glue_run(para[row[side][0]:row[side][1]], lowercase_glued=lowercase_glued, stop_chars=stop_chars)
+                  for row in merge_plan]
+                 for side, para in enumerate(paragraphs))
+
+
+def batch_paragraph_pairs(paragraph_pairs, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Groups (a sentences, b sentences) paragraph pairs, or tuples of any more parallel paragraphs,
+    into lists holding about batch_size chars each.
+    """
+    batch = []
+    batch_chars = 0
+
+    for paragraph_group in paragraph_pairs:
+        batch.append(paragraph_group)
+        batch_chars += sum(sum(map(len, para)) for para in paragraph_group)
+
+        if batch_chars >= batch_size:
+            yield batch
+            batch = []
+            batch_chars = 0
+
+    if len(batch) != 0:
+        yield batch
+
+
+def _equalise_paragraph_batch(paragraph_pairs, collect_stats=False, **equalise_options):
+    """
+    Equalises a batch of paragraph pairs in a worker process, also returning the stats for them
+    if they're being collected.
+    """
+    stats = RunStats() if collect_stats else None
+    equalised_batch = [equalise_paragraphs_n(paragraph_group, stats=stats, **equalise_options)
+                       for paragraph_group in paragraph_pairs]
+
+    return equalised_batch, stats.as_dict() if stats is not None else None
+
+
+def equalise_paragraph_pairs(paragraph_pairs, sentence_ratio=DEFAULT_SENTENCE_RATIO,
+                             lowercase_glued=DEFAULT_LOWERCASE_GLUED, stop_chars=DEFAULT_STOP_CHARS,
+                             workers=DEFAULT_WORKERS, batch_size=DEFAULT_BATCH_SIZE, engine=DEFAULT_ENGINE,
+                             stats=None):
+    """
+    Lazily equalises (a sentences, b sentences) paragraph pairs, or tuples of any more parallel paragraphs,
+    yielding the results in order. With more than one worker, they're batched up and spread across a pool
+    of processes.
+    """
+    equalise_options = dict(sentence_ratio=sentence_ratio, lowercase_glued=lowercase_glued, stop_chars=stop_chars,
+                            engine=engine)
+
+    if workers <= 1:
+        for paragraph_group in paragraph_pairs:
+            yield equalise_paragraphs_n(paragraph_group, stats=stats, **equalise_options)
+        return
+
+    pool = Pool(workers)
+    try:
+        batches = batch_paragraph_pairs(paragraph_pairs, batch_size=batch_size)
+        batch_function = partial(_equalise_paragraph_batch, collect_stats=stats is not None, **equalise_options)
+        for equalised_batch, batch_stats in imap_bounded(pool, batch_function, batches, workers * 2):
+            if batch_stats is not None:
+                stats.merge(batch_stats)
+            for equalised_pair in equalised_batch:
+                yield equalised_pair
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def pair_paragraphs(a_paragraphs, b_paragraphs, stats=None):
+    """
+    Pairs up paragraphs like zip(), stopping at the end of whichever side has fewer. With stats, carries on
+    to the end of the other side to count the paragraphs skipped for having nothing to pair up with.
+    """
+    return group_paragraphs([a_paragraphs, b_paragraphs], stats)
+
+
+def group_paragraphs(paragraph_streams, stats=None):
+    """
+    Same as pair_paragraphs(), for a list of any number of paragraph iterables, yielding tuples of
+    paragraph i from each.
+    """
+    if stats is None:
+        return zip(*paragraph_streams)
+
+    return _group_paragraphs_counted(paragraph_streams, stats)
+
+
+def _group_paragraphs_counted(paragraph_streams, stats):
+    for paragraph_group in zip_longest(*paragraph_streams):
+        if None in paragraph_group:
+            stats.increment("paragraphs_skipped", len(paragraph_group) - paragraph_group.count(None))
+        else:
+            stats.increment("paragraphs_paired")
+            yield paragraph_group
+
+
 def equalise(text_a, text_b, sentence_ratio=DEFAULT_SENTENCE_RATIO, lowercase_glued=DEFAULT_LOWERCASE_GLUED,
-             stop_chars=DEFAULT_STOP_CHARS):
+             stop_chars=DEFAULT_STOP_CHARS, workers=DEFAULT_WORKERS, engine=DEFAULT_ENGINE, stats=None):
     """
     Assuming that paragraphs are equivalent, compact the 2 texts into
     equal-paragraph-count and equal-sentence-count versions of themselves.
@@ -131,47 +622,383 @@ def equalise(text_a, text_b, sentence_ratio=DEFAULT_SENTENCE_RATIO, lowercase_gl
     equalised_a_paragraphs = []
     equalised_b_paragraphs = []
 
-    fewest_paragraph_count = min(len(a_paragraphs), len(b_paragraphs))
+    # Stops at the end of whichever text has fewer paragraphs
+    equalised_paragraphs = equalise_paragraph_pairs(pair_paragraphs(a_paragraphs, b_paragraphs, stats),
+                                                    sentence_ratio=sentence_ratio, lowercase_glued=lowercase_glued,
+                                                    stop_chars=stop_chars, workers=workers, engine=engine,
+                                                    stats=stats)
 
-    for paragraph_index in range(0, fewest_paragraph_count):
-        a_para = a_paragraphs[paragraph_index]
-        b_para = b_paragraphs[paragraph_index]
-
-        equalised_a_para, equalised_b_para = equalise_paragraphs(a_para, b_para, sentence_ratio=sentence_ratio,
-                                                                 lowercase_glued=lowercase_glued, stop_chars=stop_chars)
+    for equalised_a_para, equalised_b_para in equalised_paragraphs:
         equalised_a_paragraphs.append(equalised_a_para)
         equalised_b_paragraphs.append(equalised_b_para)
 
     return equalised_a_paragraphs, equalised_b_paragraphs
 
 
+def equalise_stream(a_paragraphs, b_paragraphs, sentence_ratio=DEFAULT_SENTENCE_RATIO,
+                    lowercase_glued=DEFAULT_LOWERCASE_GLUED, stop_chars=DEFAULT_STOP_CHARS, workers=DEFAULT_WORKERS,
+                    engine=DEFAULT_ENGINE, stats=None):
+    """
+    Lazy version of equalise() working on iterables of paragraph strings, e.g. from read_paragraphs().
+    Yields each pair of equalised paragraphs as soon as it's done.
+    """
+    paragraph_pairs = ((a_paragraph.split("\n"), b_paragraph.split("\n"))
+                       for a_paragraph, b_paragraph in pair_paragraphs(a_paragraphs, b_paragraphs, stats))
+
+    return equalise_paragraph_pairs(paragraph_pairs, sentence_ratio=sentence_ratio, lowercase_glued=lowercase_glued,
+                                    stop_chars=stop_chars, workers=workers, engine=engine, stats=stats)
+
+
+def equalise_n(texts, sentence_ratio=DEFAULT_SENTENCE_RATIO, lowercase_glued=DEFAULT_LOWERCASE_GLUED,
+               stop_chars=DEFAULT_STOP_CHARS, workers=DEFAULT_WORKERS, engine=DEFAULT_ENGINE, stats=None):
+    """
+    Same as equalise(), for a list of any number of parallel texts. Returns a list of equalised paragraphs per
+    text, where every text has the same number of paragraphs and paragraph i the same number of sentences.
+    """
+    equalised_paragraphs = equalise_paragraph_pairs(group_paragraphs([split(text) for text in texts], stats),
+                                                    sentence_ratio=sentence_ratio, lowercase_glued=lowercase_glued,
+                                                    stop_chars=stop_chars, workers=workers, engine=engine,
+                                                    stats=stats)
+
+    equalised_texts = [[] for _ in texts]
+    for equalised_group in equalised_paragraphs:
+        for equalised_text, equalised_para in zip(equalised_texts, equalised_group):
+            equalised_text.append(equalised_para)
+
+    return equalised_texts
+
+
+def equalise_stream_n(paragraph_streams, sentence_ratio=DEFAULT_SENTENCE_RATIO,
+                      lowercase_glued=DEFAULT_LOWERCASE_GLUED, stop_chars=DEFAULT_STOP_CHARS,
+                      workers=DEFAULT_WORKERS, engine=DEFAULT_ENGINE, stats=None):
+    """
+    Same as equalise_stream(), for a list of any number of paragraph iterables walked in lockstep.
+    Yields a tuple of equalised paragraphs at a time.
+    """
+    paragraph_groups = (tuple(paragraph.split("\n") for paragraph in paragraph_group)
+                        for paragraph_group in group_paragraphs(paragraph_streams, stats))
+
+    return equalise_paragraph_pairs(paragraph_groups, sentence_ratio=sentence_ratio, lowercase_glued=lowercase_glued,
+                                    stop_chars=stop_chars, workers=workers, engine=engine, stats=stats)
+
+
+def corpus_lost_percentage(original_size, equalised_size):
+    """
+    How much of the corpus was discarded, as a whole percentage.
+    """
+    if original_size == 0:
+        return 0
+
+    return int((1.0 - float(equalised_size) / original_size) * 100)
+
+
+class _CountingReader(object):
+    """
+    Wraps a file to keep a running total of the characters read from it.
+    """
+
+    def __init__(self, wrapped_file):
+        self.wrapped_file = wrapped_file
+        self.chars_read = 0
+
+    def read(self, size=-1):
+        data = self.wrapped_file.read(size)
+        self.chars_read += len(data)
+        return data
+
+
+def record_equalised_files(stats, seconds, files):
+    """
+    Records the figures for each of a set of equalised files, given as (path, read IOStats, write IOStats) triples.
+    """
+    for path, read_stats, write_stats in files:
+        stats.record_file(path, seconds=seconds, bytes_read=read_stats.byte_count, read_seconds=read_stats.seconds,
+                          bytes_written=write_stats.byte_count, write_seconds=write_stats.seconds)
+
+
+def equalise_file_stream(file_a, file_b, sentence_ratio=DEFAULT_SENTENCE_RATIO,
+                         lowercase_glued=DEFAULT_LOWERCASE_GLUED, stop_chars=DEFAULT_STOP_CHARS,
+                         buffer_size=DEFAULT_BUFFER_SIZE, workers=DEFAULT_WORKERS, engine=DEFAULT_ENGINE,
+                         compression=COMPRESSION_AUTO, encoding=DEFAULT_ENCODING, index=False, stats=None):
+    """
+    Performs equalisation process on two files, reading them paragraph by paragraph in lockstep and
+    writing each equalised pair straight away. Memory use is bounded by the largest paragraph pair.
+    """
+    started = time.perf_counter()
+    a_compression = detect_compression(file_a, compression)
+    b_compression = detect_compression(file_b, compression)
+    if index:
+        check_indexable(encoding, a_compression)
+        check_indexable(encoding, b_compression)
+
+    # Write next to the inputs, and only replace them once both are done
+    with AtomicWriter(file_a, encoding, compression=a_compression) as a_output, \
+            AtomicWriter(file_b, encoding, compression=b_compression) as b_output:
+        with open_reader(file_a, encoding, compression=a_compression, translate_newlines=True) as a_input, \
+                open_reader(file_b, encoding, compression=b_compression, translate_newlines=True) as b_input:
+            a_reader = _CountingReader(a_input)
+            b_reader = _CountingReader(b_input)
+            a_writer = ParagraphWriter(a_output, index=index)
+            b_writer = ParagraphWriter(b_output, index=index)
+
+            equalised_paragraphs = equalise_stream(read_paragraphs(a_reader, buffer_size=buffer_size),
+                                                   read_paragraphs(b_reader, buffer_size=buffer_size),
+                                                   sentence_ratio=sentence_ratio, lowercase_glued=lowercase_glued,
+                                                   stop_chars=stop_chars, workers=workers, engine=engine,
+                                                   stats=stats)
+
+            for equalised_a_para, equalised_b_para in equalised_paragraphs:
+                a_writer.write(equalised_a_para)
+                b_writer.write(equalised_b_para)
+
+            # Whatever is left of the longer file still counts towards the original size
+            while a_reader.read(buffer_size):
+                pass
+            while b_reader.read(buffer_size):
+                pass
+
+    if index:
+        a_writer.index.write(index_path(file_a))
+        b_writer.index.write(index_path(file_b))
+
+    original_corpus_size = (a_reader.chars_read + b_reader.chars_read) / 2
+    equalised_corpus_size = (a_writer.chars_written + b_writer.chars_written) / 2
+    corpus_lost = corpus_lost_percentage(original_corpus_size, equalised_corpus_size)
+
+    if stats is not None:
+        record_equalised_files(stats, time.perf_counter() - started, [(file_a, a_input.stats, a_output.stats),
+                                                                      (file_b, b_input.stats, b_output.stats)])
+
+    print("Scrubbed {} & {}. Corpus lost: {}%".format(basename(file_a), basename(file_b), corpus_lost))
+    print(format_throughput(a_input.stats + b_input.stats, a_output.stats + b_output.stats))
+
+
+def equalise_files(paths, sentence_ratio=DEFAULT_SENTENCE_RATIO, lowercase_glued=DEFAULT_LOWERCASE_GLUED,
+                   stop_chars=DEFAULT_STOP_CHARS, buffer_size=DEFAULT_BUFFER_SIZE, workers=DEFAULT_WORKERS,
+                   engine=DEFAULT_ENGINE, compression=COMPRESSION_AUTO, encoding=DEFAULT_ENCODING, index=False,
+                   stats=None, shard_size=None):
+    """
+    Performs equalisation process on any number of parallel files, e.g. one per language, in one pass.
+    Paragraph i of every file is read in lockstep and written out straight away, so each file is read and
+    written exactly once. No file is replaced until all of them have been written out in full.
+    With index set, each file gets a sentence index alongside it, whose entries line up across the files.
+    With a ShardSize, the files are left as they are and the output goes to aligned shards next to each,
+    along with a manifest of them.
+    """
+    started = time.perf_counter()
+    compressions = [detect_compression(path, compression) for path in paths]
+    if index:
+        for path_compression in compressions:
+            check_indexable(encoding, path_compression)
+
+    with ExitStack() as output_stack:
+        if shard_size is not None:
+            shard_writer = output_stack.enter_context(ShardWriter(paths, shard_size, encoding,
+                                                                  compressions=compressions, mode_paths=paths,
+                                                                  index=index))
+        else:
+            outputs = [output_stack.enter_context(AtomicWriter(path, encoding, compression=path_compression))
+                       for path, path_compression in zip(paths, compressions)]
+            writers = [ParagraphWriter(output, index=index) for output in outputs]
+
+        with ExitStack() as input_stack:
+            inputs = [input_stack.enter_context(open_reader(path, encoding, compression=path_compression,
+                                                            translate_newlines=True))
+                      for path, path_compression in zip(paths, compressions)]
+            readers = [_CountingReader(path_input) for path_input in inputs]
+
+            equalised_paragraphs = equalise_stream_n([read_paragraphs(reader, buffer_size=buffer_size)
+                                                      for reader in readers],
+                                                     sentence_ratio=sentence_ratio, lowercase_glued=lowercase_glued,
+                                                     stop_chars=stop_chars, workers=workers, engine=engine,
+                                                     stats=stats)
+
+            for equalised_group in equalised_paragraphs:
+                if shard_size is not None:
+                    shard_writer.write_paragraphs(equalised_group)
+                    continue
+
+                for writer, equalised_para in zip(writers, equalised_group):
+                    writer.write(equalised_para)
+
+            # Whatever is left of the longer files still counts towards the original size
+            for reader in readers:
+                while reader.read(buffer_size):
+                    pass
+
+    if shard_size is not None:
+        output_stats = shard_writer.stats
+        chars_written = shard_writer.chars_written
+    else:
+        if index:
+            for path, writer in zip(paths, writers):
+                writer.index.write(index_path(path))
+
+        output_stats = [output.stats for output in outputs]
+        chars_written = [writer.chars_written for writer in writers]
+
+    original_corpus_size = sum(reader.chars_read for reader in readers) / len(paths)
+    equalised_corpus_size = sum(chars_written) / len(paths)
+    corpus_lost = corpus_lost_percentage(original_corpus_size, equalised_corpus_size)
+    input_stats = [path_input.stats for path_input in inputs]
+
+    if stats is not None:
+        record_equalised_files(stats, time.perf_counter() - started, list(zip(paths, input_stats, output_stats)))
+
+    print("Scrubbed {}. Corpus lost: {}%".format(" & ".join(basename(path) for path in paths), corpus_lost))
+    if shard_size is not None:
+        print("Wrote {} aligned shards of each".format(len(shard_writer.shards[0])))
+    print(format_throughput(sum(input_stats[1:], input_stats[0]), sum(output_stats[1:], output_stats[0])))
+
+
 def equalise_file(file_a, file_b, sentence_ratio=DEFAULT_SENTENCE_RATIO, lowercase_glued=DEFAULT_LOWERCASE_GLUED,
-                  stop_chars=DEFAULT_STOP_CHARS):
+                  stop_chars=DEFAULT_STOP_CHARS, stream=False, workers=DEFAULT_WORKERS, engine=DEFAULT_ENGINE,
+                  compression=COMPRESSION_AUTO, encoding=DEFAULT_ENCODING, index=False, stats=None, shard_size=None):
     """
     Performs equalisation process on two files.
+    If stream is set, the files are read paragraph by paragraph instead of being read whole.
+    With more than one worker, paragraphs are equalised across a pool of processes.
+    Compressed files are read and written on the fly, going by their extension unless told otherwise.
+    Neither file is replaced until both have been written out in full.
+    With index set, both files get a sentence index alongside them, where entry i is the same pair in both.
+    With a ShardSize, the output goes to aligned shards as with equalise_files(), always streamed.
     """
-    with open(file_a, "r") as input_file:
-        file_a_contents = input_file.read()
-    with open(file_b, "r") as input_file:
-        file_b_contents = input_file.read()
+    if shard_size is not None:
+        return equalise_files([file_a, file_b], sentence_ratio=sentence_ratio, lowercase_glued=lowercase_glued,
+                              stop_chars=stop_chars, workers=workers, engine=engine, compression=compression,
+                              encoding=encoding, index=index, stats=stats, shard_size=shard_size)
+
+    if stream:
+        return equalise_file_stream(file_a, file_b, sentence_ratio=sentence_ratio, lowercase_glued=lowercase_glued,
+                                    stop_chars=stop_chars, workers=workers, engine=engine, compression=compression,
+                                    encoding=encoding, index=index, stats=stats)
+
+    started = time.perf_counter()
+    a_compression = detect_compression(file_a, compression)
+    b_compression = detect_compression(file_b, compression)
+    if index:
+        check_indexable(encoding, a_compression)
+        check_indexable(encoding, b_compression)
+
+    with open_reader(file_a, encoding, compression=a_compression, translate_newlines=True) as a_input:
+        file_a_contents = a_input.read()
+    with open_reader(file_b, encoding, compression=b_compression, translate_newlines=True) as b_input:
+        file_b_contents = b_input.read()
 
     original_corpus_size = (len(file_a_contents) + len(file_b_contents)) / 2
 
     equalised_a, equalised_b = equalise(file_a_contents, file_b_contents, sentence_ratio=sentence_ratio,
-                                        lowercase_glued=lowercase_glued, stop_chars=stop_chars)
+                                        lowercase_glued=lowercase_glued, stop_chars=stop_chars, workers=workers,
+                                        engine=engine, stats=stats)
+
+    with AtomicWriter(file_a, encoding, compression=a_compression) as a_output, \
+            AtomicWriter(file_b, encoding, compression=b_compression) as b_output:
+        if index:
+            # The index needs to know where every sentence went, so write them a paragraph at a time
+            a_writer = ParagraphWriter(a_output, index=True)
+            b_writer = ParagraphWriter(b_output, index=True)
+            for equalised_a_para, equalised_b_para in zip(equalised_a, equalised_b):
+                a_writer.write(equalised_a_para)
+                b_writer.write(equalised_b_para)
 
-    equalised_a = merge(equalised_a)
-    equalised_b = merge(equalised_b)
+            equalised_corpus_size = (a_writer.chars_written + b_writer.chars_written) / 2
+        else:
+            equalised_a = merge(equalised_a)
+            equalised_b = merge(equalised_b)
+            a_output.write(equalised_a)
+            b_output.write(equalised_b)
 
-    with open(file_a, "w") as output_file:
-        output_file.write(equalised_a)
-    with open(file_b, "w") as output_file:
-        output_file.write(equalised_b)
+            equalised_corpus_size = (len(equalised_a) + len(equalised_b)) / 2
 
-    equalised_corpus_size = (len(equalised_a) + len(equalised_b)) / 2
-    corpus_lost = int((1.0 - float(equalised_corpus_size) / original_corpus_size) * 100)
+    if index:
+        a_writer.index.write(index_path(file_a))
+        b_writer.index.write(index_path(file_b))
+
+    corpus_lost = corpus_lost_percentage(original_corpus_size, equalised_corpus_size)
+
+    if stats is not None:
+        record_equalised_files(stats, time.perf_counter() - started, [(file_a, a_input.stats, a_output.stats),
+                                                                      (file_b, b_input.stats, b_output.stats)])
 
     print("Scrubbed {} & {}. Corpus lost: {}%".format(basename(file_a), basename(file_b), corpus_lost))
+    print(format_throughput(a_input.stats + b_input.stats, a_output.stats + b_output.stats))
+
+
+def find_parallel_files(directories):
+    """
+    Groups the files found at the same relative path inside every one of directories, as lists of paths in the
+    order of directories, sorted by that path. Files missing from any of the directories are left out.
+    """
+    relative_paths = None
+
+    for directory in directories:
+        found_paths = set()
+        for walked_directory, directory_names, file_names in os.walk(directory):
+            for file_name in file_names:
+                found_paths.add(relpath(join(walked_directory, file_name), directory))
+
+        relative_paths = found_paths if relative_paths is None else relative_paths & found_paths
+
+    return [[join(directory, relative_path) for directory in directories] for relative_path in sorted(relative_paths)]
+
+
+def _equalise_group_job(paths, stream=False, **equalise_options):
+    """
+    Equalises one group of a batch, returning an error message instead of raising so the batch carries on.
+    """
+    try:
+        if len(paths) == 2:
+            equalise_file(paths[0], paths[1], stream=stream, **equalise_options)
+        else:
+            equalise_files(paths, **equalise_options)
+    except Exception as error:
+        return "{}: {}".format(type(error).__name__, error)
+
+    return None
+
+
+def equalise_groups(groups, sentence_ratio=DEFAULT_SENTENCE_RATIO, lowercase_glued=DEFAULT_LOWERCASE_GLUED,
+                    stop_chars=DEFAULT_STOP_CHARS, stream=False, workers=DEFAULT_WORKERS, engine=DEFAULT_ENGINE,
+                    compression=COMPRESSION_AUTO, encoding=DEFAULT_ENCODING, index=False, stats=None,
+                    shard_size=None, queue=None):
+    """
+    Equalises a batch of groups of parallel files one group after another, as equalise_file() does pairs and
+    equalise_files() bigger groups. Returns a list of (group, error message) pairs for the groups that failed.
+    With a WorkQueue, the groups are shared out with every other run using it, and the failures returned are
+    those of the whole run. Equalising a group twice can merge its sentences further, so a group finished
+    before a crash is left alone when the run is started again.
+    """
+    equalise_options = dict(sentence_ratio=sentence_ratio, lowercase_glued=lowercase_glued, stop_chars=stop_chars,
+                            workers=workers, engine=engine, compression=compression, encoding=encoding, index=index,
+                            stats=stats, shard_size=shard_size)
+
+    if queue is not None:
+        settings = cache_settings(sentence_ratio=sentence_ratio, lowercase_glued=lowercase_glued,
+                                  stop_chars=stop_chars, compression=compression, encoding=encoding, index=index,
+                                  shard_size=shard_size.as_dict() if shard_size is not None else None)
+        queue.open([{"paths": [abspath(path) for path in paths]} for paths in groups], settings)
+
+        def equalise_item(item):
+            error = _equalise_group_job(item["paths"], stream=stream, **equalise_options)
+            return error, (item["paths"], error)
+
+        results = queue.run(equalise_item)
+    else:
+        results = [(paths, _equalise_group_job(paths, stream=stream, **equalise_options)) for paths in groups]
+
+    failures = [(paths, error) for paths, error in results if error is not None]
+
+    if queue is not None:
+        print("Equalised {} of {} groups here, {} in the whole run".format(len(results) - len(failures), len(groups),
+                                                                          queue.status()["done"]))
+        failures = [(item["paths"], error) for item, error in queue.failures()]
+    else:
+        print("Equalised {} of {} groups".format(len(results) - len(failures), len(groups)))
+
+    for paths, error in failures:
+        print("Failed to equalise {}: {}".format(" & ".join(paths), error))
+
+    return failures
 
 
 def create_arg_parser():
@@ -179,9 +1006,13 @@ def create_arg_parser():
     parser = ArgumentParser(description=description)
 
     parser.add_argument("file_a", type=str,
-                        help="Input file A. Order is irrelevant.")
+                        help="Input file A. Order is irrelevant. Given directories, the files at the same path inside "
+                             "each are equalised together.")
     parser.add_argument("file_b", type=str,
                         help="Input file B. Order is irrelevant.")
+    parser.add_argument("more_files", metavar="file", type=str, nargs="*",
+                        help="Any further parallel files, e.g. other languages, to keep aligned with A and B. "
+                             "More than two files are always equalised in one streaming pass.")
 
     parser.add_argument("-r, --ratio", dest="ratio", type=float, default=DEFAULT_SENTENCE_RATIO,
                         help=" ".join([
@@ -196,19 +1027,86 @@ def create_arg_parser():
     parser.add_argument("-k, --keep-case", dest="keep_case", default=False,
                         action="store_true", help="Don't lowercase the first char of the second sentence in a merge.")
 
+    parser.add_argument("--stream", dest="stream", default=False, action="store_true",
+                        help="Equalise paragraph by paragraph instead of loading both files into memory.")
+
+    parser.add_argument("-j", "--jobs", dest="jobs", type=int, default=DEFAULT_WORKERS,
+                        help="How many processes to equalise paragraphs across. Default: {}".format(DEFAULT_WORKERS))
+
+    parser.add_argument("--compression", dest="compression", type=str, choices=COMPRESSIONS, default=COMPRESSION_AUTO,
+                        help="How the files are compressed. Default: {}, going by file extension".format(
+                            COMPRESSION_AUTO))
+
+    parser.add_argument("--stats", metavar="stats-path", type=str, dest="stats",
+                        help="Write what happened to the sentences and paragraphs, and per-file figures, as JSON.")
+
+    parser.add_argument("--encoding", metavar="encoding", type=str, dest="encoding", default=DEFAULT_ENCODING,
+                        help="What encoding the files are in. Default: {}".format(DEFAULT_ENCODING))
+
+    parser.add_argument("--index", dest="index", default=False, action="store_true",
+                        help="Write a sentence index next to each file, for random access to its sentences.")
+
+    add_shard_arguments(parser)
+    add_queue_arguments(parser)
+
+    parser.add_argument("--engine", dest="engine", type=str, choices=ENGINES, default=DEFAULT_ENGINE,
+                        help=" ".join([
+                            "How to plan merges. '{}' needs NumPy, and falls back to '{}' without it and for "
+                            "paragraphs under {} sentences.".format(ENGINE_NUMPY, ENGINE_PYTHON, NUMPY_MIN_SENTENCES),
+                            "Default: {}".format(DEFAULT_ENGINE)
+                        ]))
+
     return parser
 
 
-if __name__ == "__main__":
+def main(arguments=None):
     arg_parser = create_arg_parser()
-    args = arg_parser.parse_args()
+    args = arg_parser.parse_args(arguments)
 
     user_stop_chars = list(args.stop)
     user_lowercase_glued = not args.keep_case
 
     ensure_arg(exists(args.file_a), "File A doesn't exist.", arg_parser)
     ensure_arg(exists(args.file_b), "File B doesn't exist.", arg_parser)
+    for more_file in args.more_files:
+        ensure_arg(exists(more_file), "File {} doesn't exist.".format(more_file), arg_parser)
     ensure_arg(len(user_stop_chars) != 0, "Stop characters are invalid.", arg_parser)
+    ensure_arg(args.jobs > 0, "Job count must be positive.", arg_parser)
+    check_shard_arguments(args, arg_parser)
+    check_queue_arguments(args, arg_parser)
 
-    equalise_file(args.file_a, args.file_b, sentence_ratio=args.ratio, stop_chars=user_stop_chars,
-                  lowercase_glued=user_lowercase_glued)
+    all_paths = [args.file_a, args.file_b] + args.more_files
+    batch = all(isdir(path) for path in all_paths)
+    ensure_arg(batch or all(isfile(path) for path in all_paths), "Give either all files or all directories.",
+               arg_parser)
+
+    run_stats = RunStats() if args.stats is not None else None
+    shard_size = create_shard_size(args)
+    work_queue = create_work_queue(args)
+
+    if batch or work_queue is not None:
+        groups = find_parallel_files(all_paths) if batch else [all_paths]
+        failed_groups = equalise_groups(groups, sentence_ratio=args.ratio, stop_chars=user_stop_chars,
+                                        lowercase_glued=user_lowercase_glued, stream=args.stream, workers=args.jobs,
+                                        engine=args.engine, compression=args.compression, encoding=args.encoding,
+                                        index=args.index, stats=run_stats, shard_size=shard_size, queue=work_queue)
+    elif len(args.more_files) != 0:
+        equalise_files([args.file_a, args.file_b] + args.more_files, sentence_ratio=args.ratio,
+                       stop_chars=user_stop_chars, lowercase_glued=user_lowercase_glued, workers=args.jobs,
+                       engine=args.engine, compression=args.compression, encoding=args.encoding, index=args.index,
+                       stats=run_stats, shard_size=shard_size)
+    else:
+        equalise_file(args.file_a, args.file_b, sentence_ratio=args.ratio, stop_chars=user_stop_chars,
+                      lowercase_glued=user_lowercase_glued, stream=args.stream, workers=args.jobs,
+                      engine=args.engine, compression=args.compression, encoding=args.encoding, index=args.index,
+                      stats=run_stats, shard_size=shard_size)
+
+    if run_stats is not None:
+        run_stats.write_json(args.stats)
+
+    if (batch or work_queue is not None) and len(failed_groups) != 0:
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
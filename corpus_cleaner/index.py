@@ -0,0 +1,332 @@
+import io
+import mmap
+import struct
+import sys
+from array import array
+from bisect import bisect_right
+from os.path import getsize
+
+from corpus_cleaner.shared import AtomicWriter
+
+INDEX_SUFFIX = ".idx"
+INDEX_MAGIC = b"CCSIDX01"
+# Magic, size of the indexed file in bytes, then how many sentences, paragraphs and lines it has
+INDEX_HEADER = struct.Struct("<8sQQQQ")
+# Offsets are stored little-endian, as unsigned 64-bit ints
+OFFSET_TYPE = "Q"
+OFFSET_SIZE = 8
+
+
+def index_path(path):
+    """
+    Where the index of the file at path goes.
+    """
+    return path + INDEX_SUFFIX
+
+
+def check_indexable(encoding, compression=None):
+    """
+    Raises a ValueError unless files written with this encoding and compression can be indexed, i.e. they're
+    uncompressed so byte offsets can be seeked to, and line-breaks are plain "\\n" bytes.
+    """
+    if compression is not None:
+        raise ValueError("Can't index {} compressed output, only uncompressed files have usable offsets".format(
+            compression))
+    if "\n\n".encode(encoding) != b"\n\n":
+        raise ValueError("Can't index output encoded as {}, line-breaks have to be plain bytes".format(encoding))
+
+
+def _offsets_to_bytes(offsets):
+    if sys.byteorder != "little":
+        offsets = array(OFFSET_TYPE, offsets)
+        offsets.byteswap()
+
+    return offsets.tobytes()
+
+
+class IndexBuilder(object):
+    """
+    Builds the sentence index of a file as it's written: the byte range of every sentence, the first sentence
+    of every paragraph and the line count. Either feed() it everything written, which indexes the file the
+    way equaliser.split() would read it, or add_paragraph() it one encoded paragraph at a time.
+    """
+
+    def __init__(self):
+        self.sentence_starts = array(OFFSET_TYPE)
+        self.sentence_ends = array(OFFSET_TYPE)
+        self.paragraph_starts = array(OFFSET_TYPE)
+        self.byte_count = 0
+        self.newline_count = 0
+
+        self._sentence_start = 0
+        self._pending_newline = None
+        self._paragraph_open = False
+
+    def _add_sentence(self, start, end):
+        if not self._paragraph_open:
+            self.paragraph_starts.append(len(self.sentence_starts))
+            self._paragraph_open = True
+
+        self.sentence_starts.append(start)
+        self.sentence_ends.append(end)
+
+    def _line_break(self, position, paragraph_break):
+        self._add_sentence(self._sentence_start, position)
+        self._sentence_start = position + (2 if paragraph_break else 1)
+        self._paragraph_open = self._paragraph_open and not paragraph_break
+
+    def feed(self, data):
+        """
+        Indexes the next bytes written to the file. A "\\n" ends a sentence and "\\n\\n" a paragraph.
+        """
+        base = self.byte_count
+        position = 0
+
+        if self._pending_newline is not None and len(data) != 0:
+            # The last block ended on a line-break, so only now can we tell which kind it was
+            self._line_break(self._pending_newline, data[:1] == b"\n")
+            position = 1 if data[:1] == b"\n" else 0
+            self._pending_newline = None
+
+        newline = data.find(b"\n", position)
+        while newline != -1:
+            if newline + 1 == len(data):
+                self._pending_newline = base + newline
+                break
+
+            paragraph_break = data[newline + 1:newline + 2] == b"\n"
+            self._line_break(base + newline, paragraph_break)
+            newline = data.find(b"\n", newline + (2 if paragraph_break else 1))
+
+        self.byte_count += len(data)
+        self.newline_count += data.count(b"\n")
+
+    def skip(self, data):
+        """
+        Accounts for bytes written between paragraphs, e.g. the "\\n\\n" separating them.
+        """
+        self.byte_count += len(data)
+        self.newline_count += data.count(b"\n")
+
+    def add_paragraph(self, data, sentence_count):
+        """
+        Indexes one encoded paragraph of sentence_count sentences, which has just been written. Paragraphs whose
+        sentences are all empty may not have been written at all, in which case data is empty and the sentences
+        are indexed as empty ranges, so entries still line up with another file's.
+        """
+        self._paragraph_open = False
+        start = self.byte_count
+
+        if len(data) == 0:
+            for _ in range(sentence_count):
+                self._add_sentence(start, start)
+            return
+
+        newline = data.find(b"\n")
+        while newline != -1:
+            self._add_sentence(start, self.byte_count + newline)
+            start = self.byte_count + newline + 1
+            newline = data.find(b"\n", newline + 1)
+        self._add_sentence(start, self.byte_count + len(data))
+
+        self.byte_count += len(data)
+        self.newline_count += data.count(b"\n")
+
+    def finish(self):
+        """
+        Indexes the last sentence of a file given to feed(), once it's all been written.
+        An empty file has no sentences at all.
+        """
+        if self.byte_count == 0:
+            return
+
+        if self._pending_newline is not None:
+            self._line_break(self._pending_newline, False)
+            self._pending_newline = None
+
+        self._add_sentence(self._sentence_start, self.byte_count)
+
+    def write(self, path):
+        """
+        Saves the index to path, which is usually index_path() of the indexed file.
+        """
+        line_count = self.newline_count + 1 if self.byte_count != 0 else 0
+        paragraph_starts = array(OFFSET_TYPE, self.paragraph_starts)
+        paragraph_starts.append(len(self.sentence_starts))
+
+        with AtomicWriter(path) as index_file:
+            index_file.write_bytes(INDEX_HEADER.pack(INDEX_MAGIC, self.byte_count, len(self.sentence_starts),
+                                                     len(self.paragraph_starts), line_count))
+            for offsets in [self.sentence_starts, self.sentence_ends, paragraph_starts]:
+                index_file.write_bytes(_offsets_to_bytes(offsets))
+
+
+class IndexedWriter(object):
+    """
+    Wraps an AtomicWriter, feeding everything written through it to an IndexBuilder.
+    """
+
+    def __init__(self, output_file):
+        self.output_file = output_file
+        self.index = IndexBuilder()
+
+    def write(self, text):
+        self.write_bytes(self.output_file.encoder.encode(text))
+
+    def write_bytes(self, data):
+        self.output_file.write_bytes(data)
+        self.index.feed(data)
+
+
+def _map_file(path):
+    binary_file = io.open(path, "rb")
+    # Empty files can't be mapped
+    mapped_file = mmap.mmap(binary_file.fileno(), 0, access=mmap.ACCESS_READ) if getsize(path) != 0 else b""
+
+    return binary_file, mapped_file
+
+
+class SentenceIndex(object):
+    """
+    Random access to the sentences and paragraphs of an indexed file. Both the file and its index are memory
+    mapped, so opening one is cheap whatever its size, and any sentence can be read without scanning for it.
+    Sentences are numbered from 0 across the whole file, and paragraphs by the range of sentences they hold.
+    """
+
+    def __init__(self, path, encoding="utf-8", errors="strict", index_file_path=None):
+        self.path = path
+        self.encoding = encoding
+        self.errors = errors
+        self._views = []
+
+        index_file_path = index_file_path if index_file_path is not None else index_path(path)
+        self._index_file, self._index_map = _map_file(index_file_path)
+        self._data_file, self._data_map = _map_file(path)
+
+        if len(self._index_map) < INDEX_HEADER.size or self._index_map[:len(INDEX_MAGIC)] != INDEX_MAGIC:
+            self.close()
+            raise ValueError("{} isn't a sentence index".format(index_file_path))
+
+        magic, byte_count, sentence_count, paragraph_count, line_count = INDEX_HEADER.unpack_from(self._index_map, 0)
+        if byte_count != len(self._data_map):
+            self.close()
+            raise ValueError("The index of {} is out of date".format(path))
+
+        self.sentence_count = sentence_count
+        self.paragraph_count = paragraph_count
+        self.line_count = line_count
+
+        offset = INDEX_HEADER.size
+        self.sentence_starts = self._load_offsets(offset, sentence_count)
+        offset += sentence_count * OFFSET_SIZE
+        self.sentence_ends = self._load_offsets(offset, sentence_count)
+        offset += sentence_count * OFFSET_SIZE
+        # Has one more entry than there are paragraphs, so paragraph i is the sentences from entry i to entry i + 1
+        self.paragraph_starts = self._load_offsets(offset, paragraph_count + 1)
+
+    def _load_offsets(self, offset, count):
+        data = memoryview(self._index_map)[offset:offset + count * OFFSET_SIZE]
+        self._views.append(data)
+
+        if sys.byteorder == "little":
+            offsets = data.cast(OFFSET_TYPE)
+            self._views.append(offsets)
+            return offsets
+
+        offsets = array(OFFSET_TYPE, data.tobytes())
+        offsets.byteswap()
+        return offsets
+
+    def __len__(self):
+        return self.sentence_count
+
+    def __getitem__(self, sentence_index):
+        return self.sentence(sentence_index)
+
+    def __iter__(self):
+        return self.iter_sentences()
+
+    def sentence_bytes(self, sentence_index):
+        if not 0 <= sentence_index < self.sentence_count:
+            raise IndexError("Sentence {} is out of range".format(sentence_index))
+
+        return self._data_map[self.sentence_starts[sentence_index]:self.sentence_ends[sentence_index]]
+
+    def sentence(self, sentence_index):
+        return self.sentence_bytes(sentence_index).decode(self.encoding, self.errors)
+
+    def paragraph_range(self, paragraph_index):
+        """
+        The (start, end) range of sentence indices making up a paragraph.
+        """
+        if not 0 <= paragraph_index < self.paragraph_count:
+            raise IndexError("Paragraph {} is out of range".format(paragraph_index))
+
+        return self.paragraph_starts[paragraph_index], self.paragraph_starts[paragraph_index + 1]
+
+    def paragraph(self, paragraph_index):
+        """
+        The sentences of a paragraph, as a list.
+        """
+        return list(self.iter_sentences(*self.paragraph_range(paragraph_index)))
+
+    def paragraph_of(self, sentence_index):
+        """
+        Which paragraph a sentence is in.
+        """
+        if not 0 <= sentence_index < self.sentence_count:
+            raise IndexError("Sentence {} is out of range".format(sentence_index))
+
+        return bisect_right(self.paragraph_starts, sentence_index, 0, self.paragraph_count) - 1
+
+    def iter_sentences(self, start=0, end=None):
+        """
+        Yields the sentences from index start up to end, or the end of the file.
+        """
+        end = self.sentence_count if end is None else min(end, self.sentence_count)
+
+        for sentence_index in range(start, end):
+            yield self.sentence(sentence_index)
+
+    def shard_range(self, shard_index, shard_count):
+        """
+        The (start, end) range of sentence indices in one of shard_count roughly equal shards. The shards
+        cover every sentence once, so shard_count workers can each take one without reading the others.
+        """
+        if not 0 <= shard_index < shard_count:
+            raise IndexError("Shard {} of {} is out of range".format(shard_index, shard_count))
+
+        return (self.sentence_count * shard_index // shard_count,
+                self.sentence_count * (shard_index + 1) // shard_count)
+
+    def iter_shard(self, shard_index, shard_count):
+        return self.iter_sentences(*self.shard_range(shard_index, shard_count))
+
+    def close(self):
+        # The maps can't be closed while anything still points into them
+        for view in reversed(self._views):
+            view.release()
+        self._views = []
+
+        for mapped_file, binary_file in [(self._data_map, self._data_file), (self._index_map, self._index_file)]:
+            if not isinstance(mapped_file, bytes):
+                mapped_file.close()
+            binary_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def check_aligned(*indexes):
+    """
+    Raises a ValueError unless the indexes line up sentence for sentence and paragraph for paragraph,
+    as they do for files equalised together.
+    """
+    for other in indexes[1:]:
+        if other.sentence_count != indexes[0].sentence_count or \
+                other.paragraph_count != indexes[0].paragraph_count or \
+                bytes(other.paragraph_starts) != bytes(indexes[0].paragraph_starts):
+            raise ValueError("{} and {} aren't aligned".format(indexes[0].path, other.path))
@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+
+import os
+import time
+from argparse import ArgumentParser
+from os.path import basename, exists, isfile
+
+from corpus_cleaner import scrubber, equaliser
+from corpus_cleaner.abbreviations import load_abbreviations
+from corpus_cleaner.index import check_indexable, index_path
+from corpus_cleaner.shards import ShardWriter, add_shard_arguments, check_shard_arguments, create_shard_size
+from corpus_cleaner.dedup import add_dedup_arguments, check_dedup_arguments, create_deduplicator, \
+    deduplicate_paragraph_pairs, removed_count
+from corpus_cleaner.shared import DEFAULT_STOP_CHARS, COMPRESSION_AUTO, COMPRESSIONS, ensure_arg, \
+    detect_compression, open_reader, AtomicWriter, create_temporary_path, format_throughput, RunStats, ENCODING_AUTO, \
+    DEFAULT_FALLBACK_ENCODINGS, DECODE_STRICT, DECODE_ERROR_POLICIES, resolve_encoding, format_decoding, \
+    is_known_encoding
+
+
+def scrubbed_paragraphs(input_file, stop_chars=DEFAULT_STOP_CHARS, reorder_chars=scrubber.DEFAULT_REORDER_CHARS,
+                        buffer_size=scrubber.DEFAULT_BUFFER_SIZE, engine=scrubber.DEFAULT_ENGINE, stats=None,
+                        abbreviations=None):
+    """
+    Scrubs an open file a paragraph block at a time, yielding the scrubbed paragraphs as the
+    equaliser would read them back from the scrubbed file. The scrubbed text is split into paragraphs again
+    in memory, and the equaliser splits those into sentences, so nothing goes through a file in between.
+    """
+    scrubbed_text = scrubber.scrub_stream(input_file, stop_chars=stop_chars, reorder_chars=reorder_chars,
+                                          buffer_size=buffer_size, engine=engine, stats=stats,
+                                          abbreviations=abbreviations)
+    return equaliser.split_paragraphs(_translate_newlines(scrubbed_text))
+
+
+def _translate_newlines(pieces):
+    # The equaliser reads scrubbed files with "\r\n" and "\r" translated, so scrubbed text gets the same here
+    pending_carriage_return = ""
+
+    for text in pieces:
+        text = pending_carriage_return + text
+        pending_carriage_return = ""
+
+        # The next piece might start with the "\n" that goes with it
+        if text.endswith("\r"):
+            pending_carriage_return = "\r"
+            text = text[:-1]
+
+        yield text.replace("\r\n", "\n").replace("\r", "\n")
+
+    if len(pending_carriage_return) != 0:
+        yield "\n"
+
+
+def clean_paragraphs(a_paragraphs, b_paragraphs, sentence_ratio=equaliser.DEFAULT_SENTENCE_RATIO,
+                     lowercase_glued=equaliser.DEFAULT_LOWERCASE_GLUED, stop_chars=DEFAULT_STOP_CHARS,
+                     workers=equaliser.DEFAULT_WORKERS, engine=equaliser.DEFAULT_ENGINE, stats=None):
+    """
+    Equalises two streams of scrubbed paragraphs, yielding pairs of equalised sentence lists.
+    Same as equalise_stream(), named for its place in the pipeline.
+    """
+    return equaliser.equalise_stream(a_paragraphs, b_paragraphs, sentence_ratio=sentence_ratio,
+                                     lowercase_glued=lowercase_glued, stop_chars=stop_chars, workers=workers,
+                                     engine=engine, stats=stats)
+
+
+class _PairWriter(object):
+    """
+    Writes a pair of whole output files, in the same way as a ShardWriter of two.
+    """
+
+    def __init__(self, output_a, output_b, encoding, compressions, mode_paths, index):
+        self.paths = [output_a, output_b]
+        self.output_files = [AtomicWriter(path, encoding, compression=compression, mode_path=mode_path)
+                             for path, compression, mode_path in zip(self.paths, compressions, mode_paths)]
+        self.writers = [equaliser.ParagraphWriter(output_file, index=index) for output_file in self.output_files]
+        self.index = index
+
+    @property
+    def stats(self):
+        return [output_file.stats for output_file in self.output_files]
+
+    def write_paragraphs(self, paragraphs):
+        for writer, sentences in zip(self.writers, paragraphs):
+            writer.write(sentences)
+
+    def close(self):
+        """
+        Replaces the outputs only once both are written in full. If B can't be replaced, A is put back as it
+        was, so a new A is never left next to an old B.
+        """
+        output_a, output_b = self.output_files
+
+        try:
+            output_a.finish()
+            output_b.finish()
+        except BaseException:
+            self.discard()
+            raise
+
+        # The old A is moved aside rather than replaced straight away, so it can be put back
+        backup_path = create_temporary_path(output_a.path) if exists(output_a.path) else None
+        moved_aside = False
+        a_replaced = False
+
+        try:
+            if backup_path is not None:
+                os.replace(output_a.path, backup_path)
+                moved_aside = True
+            output_a.replace()
+            a_replaced = True
+            output_b.replace()
+        except BaseException:
+            for output_file in self.output_files:
+                if exists(output_file.temporary_path):
+                    os.remove(output_file.temporary_path)
+
+            if moved_aside:
+                os.replace(backup_path, output_a.path)
+            elif backup_path is not None:
+                os.remove(backup_path)
+            elif a_replaced:
+                # There was no A before
+                os.remove(output_a.path)
+            raise
+
+        if backup_path is not None:
+            os.remove(backup_path)
+
+        if self.index:
+            for path, writer in zip(self.paths, self.writers):
+                writer.index.write(index_path(path))
+
+    def discard(self):
+        for output_file in self.output_files:
+            output_file.discard()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+
+def clean_pair(file_a, file_b, output_a=None, output_b=None, stop_chars=DEFAULT_STOP_CHARS,
+               reorder_chars=scrubber.DEFAULT_REORDER_CHARS, input_encoding=scrubber.DEFAULT_INPUT_ENCODING,
+               output_encoding=scrubber.DEFAULT_OUTPUT_ENCODING, sentence_ratio=equaliser.DEFAULT_SENTENCE_RATIO,
+               lowercase_glued=equaliser.DEFAULT_LOWERCASE_GLUED, workers=equaliser.DEFAULT_WORKERS,
+               scrub_engine=scrubber.DEFAULT_ENGINE, equalise_engine=equaliser.DEFAULT_ENGINE,
+               input_compression=COMPRESSION_AUTO, output_compression=COMPRESSION_AUTO, index=False, stats=None,
+               dedup=None, abbreviations=None, shard_size=None, input_errors=DECODE_STRICT,
+               fallback_encodings=DEFAULT_FALLBACK_ENCODINGS):
+    """
+    Scrubs a parallel pair of files and equalises them in one go, reading each input once and writing each
+    output once. Gives the same result as running scrub_file() on both and then equalise_file(), including
+    for inputs with "\r\n" or "\r" line-breaks.
+    Overwrites the inputs if no outputs are given, but only once both outputs are complete.
+    With index set, both outputs get a sentence index alongside them, where entry i is the same pair in both.
+    With a Deduplicator as dedup, equalised sentence pairs it has seen before are removed from both outputs.
+    With Abbreviations, sentences aren't split after the ones on the list.
+    With a ShardSize, the outputs are written as aligned shards with a manifest each, rather than whole files.
+    The input encoding and input_errors work as for scrubber.scrub_file(), with each input detected on its own.
+    """
+    started = time.perf_counter()
+    output_a = output_a if output_a is not None else file_a
+    output_b = output_b if output_b is not None else file_b
+
+    scrub_options = dict(stop_chars=stop_chars, reorder_chars=reorder_chars, engine=scrub_engine, stats=stats,
+                         abbreviations=abbreviations)
+
+    a_input_compression = detect_compression(file_a, input_compression)
+    b_input_compression = detect_compression(file_b, input_compression)
+    a_output_compression = detect_compression(output_a, output_compression)
+    b_output_compression = detect_compression(output_b, output_compression)
+    a_input_encoding = resolve_encoding(file_a, input_encoding, a_input_compression,
+                                        fallback_encodings=fallback_encodings)
+    b_input_encoding = resolve_encoding(file_b, input_encoding, b_input_compression,
+                                        fallback_encodings=fallback_encodings)
+    if index:
+        check_indexable(output_encoding, a_output_compression)
+        check_indexable(output_encoding, b_output_compression)
+
+    if shard_size is not None:
+        outputs = ShardWriter([output_a, output_b], shard_size, output_encoding,
+                              compressions=[a_output_compression, b_output_compression], mode_paths=[file_a, file_b],
+                              index=index)
+    else:
+        outputs = _PairWriter(output_a, output_b, output_encoding, [a_output_compression, b_output_compression],
+                              [file_a, file_b], index)
+
+    # Neither output replaces anything until both are done, and the inputs are closed
+    with outputs:
+        with open_reader(file_a, a_input_encoding, errors=input_errors, compression=a_input_compression) as a_input, \
+                open_reader(file_b, b_input_encoding, errors=input_errors, compression=b_input_compression) as b_input:
+            a_paragraphs = scrubbed_paragraphs(a_input, **scrub_options)
+            b_paragraphs = scrubbed_paragraphs(b_input, **scrub_options)
+
+            equalised_paragraphs = clean_paragraphs(a_paragraphs, b_paragraphs, sentence_ratio=sentence_ratio,
+                                                    lowercase_glued=lowercase_glued, stop_chars=stop_chars,
+                                                    workers=workers, engine=equalise_engine, stats=stats)
+            if dedup is not None:
+                dedup_stats = RunStats()
+                equalised_paragraphs = deduplicate_paragraph_pairs(equalised_paragraphs, dedup, stats=dedup_stats)
+
+            for equalised_pair in equalised_paragraphs:
+                outputs.write_paragraphs(equalised_pair)
+
+    if stats is not None:
+        if dedup is not None:
+            stats.merge(dedup_stats.as_dict())
+        equaliser.record_equalised_files(stats, time.perf_counter() - started,
+                                         [(file_a, a_input.stats, outputs.stats[0]),
+                                          (file_b, b_input.stats, outputs.stats[1])])
+        for path, input_file in [(file_a, a_input), (file_b, b_input)]:
+            scrubber.record_decoding(stats, path, input_file.encoding, input_file.error_count,
+                                     input_file.skipped_line_count)
+
+    print("Cleaned {} & {} to {} & {}".format(basename(file_a), basename(file_b), output_a, output_b))
+    if shard_size is not None:
+        print("Wrote {} aligned shards of each".format(len(outputs.shards[0])))
+    print(format_throughput(a_input.stats + b_input.stats, outputs.stats[0] + outputs.stats[1]))
+    if input_encoding == ENCODING_AUTO or input_errors != DECODE_STRICT:
+        for path, input_file in [(file_a, a_input), (file_b, b_input)]:
+            print("{}: {}".format(basename(path), format_decoding(input_file.encoding, input_errors,
+                                                                  input_file.error_count,
+                                                                  input_file.skipped_line_count)))
+    if dedup is not None:
+        print("Duplicate pairs removed: {}".format(removed_count(dedup_stats)))
+
+
+def create_arg_parser():
+    description = "Scrubs a parallel pair of corpus files and equalises them in one pass."
+    parser = ArgumentParser(description=description)
+
+    parser.add_argument("file_a", type=str,
+                        help="Input file A. Order is irrelevant.")
+    parser.add_argument("file_b", type=str,
+                        help="Input file B. Order is irrelevant.")
+
+    parser.add_argument("--output-a", metavar="output-path", type=str, dest="output_a",
+                        help="Where to write the cleaned version of file A. Default: overwrite it")
+    parser.add_argument("--output-b", metavar="output-path", type=str, dest="output_b",
+                        help="Where to write the cleaned version of file B. Default: overwrite it")
+
+    parser.add_argument("--input-encoding", metavar="encoding", type=str, dest="input_encoding",
+                        default=scrubber.DEFAULT_INPUT_ENCODING,
+                        help="What encoding the input files are in, or '{}' to detect it for each. Default: {}".format(
+                            ENCODING_AUTO, scrubber.DEFAULT_INPUT_ENCODING))
+    parser.add_argument("--input-errors", dest="input_errors", type=str, choices=DECODE_ERROR_POLICIES,
+                        default=DECODE_STRICT,
+                        help="What to do with bytes that don't decode: stop, replace them with U+FFFD or skip "
+                             "the lines they're on. Default: {}".format(DECODE_STRICT))
+    parser.add_argument("--fallback-encodings", metavar="encoding", type=str, nargs="+", dest="fallback_encodings",
+                        default=DEFAULT_FALLBACK_ENCODINGS,
+                        help="Encodings to try in order when detecting one and a file isn't UTF-8. Default: {}".format(
+                            " ".join(DEFAULT_FALLBACK_ENCODINGS)))
+    parser.add_argument("--output-encoding", metavar="encoding", type=str, dest="output_encoding",
+                        default=scrubber.DEFAULT_OUTPUT_ENCODING,
+                        help="What encoding to save the output files as. Default: {}".format(
+                            scrubber.DEFAULT_OUTPUT_ENCODING))
+
+    parser.add_argument("--input-compression", dest="input_compression", type=str, choices=COMPRESSIONS,
+                        default=COMPRESSION_AUTO,
+                        help="How the input files are compressed. Default: {}, going by file extension".format(
+                            COMPRESSION_AUTO))
+    parser.add_argument("--output-compression", dest="output_compression", type=str, choices=COMPRESSIONS,
+                        default=COMPRESSION_AUTO,
+                        help="How to compress the output files. Default: {}, going by file extension".format(
+                            COMPRESSION_AUTO))
+
+    default_stop_chars = "".join(DEFAULT_STOP_CHARS)
+    parser.add_argument("-s, --stop-chars", metavar="stop-chars", dest="stop", type=str, default=default_stop_chars,
+                        help="Chars defining sentence boundaries. Default: {}".format(default_stop_chars))
+
+    default_reorder_chars = "".join(scrubber.DEFAULT_REORDER_CHARS)
+    parser.add_argument("-r, --reorder", metavar="reorderable", dest="reorder", type=str,
+                        default=default_reorder_chars,
+                        help="Chars which can be swapped with stop chars. Default: {}".format(default_reorder_chars))
+
+    parser.add_argument("--abbreviations", metavar="abbreviations-path", type=str, dest="abbreviations",
+                        help="File of abbreviations not to split sentences after, one per line, e.g. Dr. or e.g.")
+
+    parser.add_argument("--ratio", dest="ratio", type=float, default=equaliser.DEFAULT_SENTENCE_RATIO,
+                        help=" ".join([
+                            "How close in word-count sentences have to be to be considered equivalent as a 0 to 1 ratio",
+                            "Default: {}".format(equaliser.DEFAULT_SENTENCE_RATIO)
+                        ]))
+
+    parser.add_argument("-k, --keep-case", dest="keep_case", default=False,
+                        action="store_true", help="Don't lowercase the first char of the second sentence in a merge.")
+
+    parser.add_argument("-j", "--jobs", dest="jobs", type=int, default=equaliser.DEFAULT_WORKERS,
+                        help="How many processes to equalise paragraphs across. Default: {}".format(
+                            equaliser.DEFAULT_WORKERS))
+
+    parser.add_argument("--scrub-engine", dest="scrub_engine", type=str, choices=scrubber.ENGINES,
+                        default=scrubber.DEFAULT_ENGINE,
+                        help="How to run the scrub stages. Default: {}".format(scrubber.DEFAULT_ENGINE))
+    parser.add_argument("--equalise-engine", dest="equalise_engine", type=str, choices=equaliser.ENGINES,
+                        default=equaliser.DEFAULT_ENGINE,
+                        help="How to plan merges. Default: {}".format(equaliser.DEFAULT_ENGINE))
+
+    parser.add_argument("--index", dest="index", default=False, action="store_true",
+                        help="Write a sentence index next to each output, for random access to its sentences.")
+
+    add_shard_arguments(parser)
+
+    parser.add_argument("--dedup", dest="dedup", default=False, action="store_true",
+                        help="Remove equalised sentence pairs already seen, from both outputs together.")
+    add_dedup_arguments(parser)
+
+    parser.add_argument("--stats", metavar="stats-path", type=str, dest="stats",
+                        help="Write per-stage timings, equaliser counters and per-file figures to this file as JSON.")
+
+    return parser
+
+
+def main(arguments=None):
+    arg_parser = create_arg_parser()
+    args = arg_parser.parse_args(arguments)
+
+    user_stop_chars = list(args.stop)
+
+    ensure_arg(exists(args.file_a), "File A doesn't exist.", arg_parser)
+    ensure_arg(exists(args.file_b), "File B doesn't exist.", arg_parser)
+    ensure_arg(len(user_stop_chars) != 0, "Stop characters are invalid.", arg_parser)
+    ensure_arg(args.jobs > 0, "Job count must be positive.", arg_parser)
+    ensure_arg(args.input_encoding == ENCODING_AUTO or is_known_encoding(args.input_encoding),
+               "Unknown input encoding {}.".format(args.input_encoding), arg_parser)
+    for encoding in args.fallback_encodings:
+        ensure_arg(is_known_encoding(encoding), "Unknown fallback encoding {}.".format(encoding), arg_parser)
+    ensure_arg(args.abbreviations is None or isfile(args.abbreviations), "Abbreviations file doesn't exist.",
+               arg_parser)
+    check_dedup_arguments(args, arg_parser)
+    check_shard_arguments(args, arg_parser)
+
+    run_stats = RunStats() if args.stats is not None else None
+    abbreviations = load_abbreviations(args.abbreviations) if args.abbreviations is not None else None
+
+    clean_pair(args.file_a, args.file_b, args.output_a, args.output_b, stop_chars=user_stop_chars,
+               reorder_chars=list(args.reorder), input_encoding=args.input_encoding,
+               output_encoding=args.output_encoding, sentence_ratio=args.ratio, lowercase_glued=not args.keep_case,
+               workers=args.jobs, scrub_engine=args.scrub_engine, equalise_engine=args.equalise_engine,
+               input_compression=args.input_compression, output_compression=args.output_compression,
+               index=args.index, stats=run_stats, dedup=create_deduplicator(args) if args.dedup else None,
+               abbreviations=abbreviations, shard_size=create_shard_size(args), input_errors=args.input_errors,
+               fallback_encodings=args.fallback_encodings)
+
+    if run_stats is not None:
+        run_stats.write_json(args.stats)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,26 +1,62 @@
 #!/usr/bin/env python
 
 import codecs
+import glob
+import mmap
+import os
 import re
+import time
 from argparse import ArgumentParser
-from os.path import exists
-
-from corpus_cleaner.shared import DEFAULT_STOP_CHARS, join_regex, ensure_arg
+from functools import partial
+from multiprocessing import Pool, cpu_count
+from os.path import abspath, dirname, basename, exists, getsize, isdir, isfile, join, relpath
+
+from corpus_cleaner.shared import DEFAULT_STOP_CHARS, COMPRESSION_AUTO, COMPRESSIONS, join_regex, ensure_arg, \
+    imap_bounded, detect_compression, compress_bytes, open_reader, AtomicWriter, format_throughput, RunStats, \
+    run_stage, ENCODING_AUTO, DEFAULT_FALLBACK_ENCODINGS, DECODE_STRICT, DECODE_ERROR_POLICIES, resolve_encoding, \
+    decode_bytes, format_decoding, is_known_encoding
+from corpus_cleaner.abbreviations import load_abbreviations
+from corpus_cleaner.cache import DEFAULT_CACHE_SIZE, ScrubCache, cache_settings, chunk_blocks
+from corpus_cleaner.index import IndexedWriter, check_indexable, index_path
+from corpus_cleaner.shards import ShardWriter, add_shard_arguments, check_shard_arguments, create_shard_size
+from corpus_cleaner.dedup import add_dedup_arguments, check_dedup_arguments, create_deduplicator, deduplicate_text, \
+    removed_count
+from corpus_cleaner.workqueue import add_queue_arguments, check_queue_arguments, create_work_queue
 
 
 DEFAULT_REORDER_CHARS = ["\"", "'", ")", "]", "}"]
 DEFAULT_INPUT_ENCODING = "utf-8"
 DEFAULT_OUTPUT_ENCODING = "utf-8"
+DEFAULT_BUFFER_SIZE = 1024 * 1024
+DEFAULT_CHUNK_SIZE = 16 * 1024 * 1024
+
+ENGINE_REFERENCE = "reference"
+ENGINE_FUSED = "fused"
+ENGINES = [ENGINE_REFERENCE, ENGINE_FUSED]
+DEFAULT_ENGINE = ENGINE_REFERENCE
+
+# A run of 2+ line-breaks that is known to be complete, i.e. followed by something else
+PARAGRAPH_BREAK_PATTERN = re.compile(r"\n\n+(?=[^\n])")
+PARAGRAPH_BREAK_BYTES_PATTERN = re.compile(br"\n\n+(?=[^\n])")
+
+# Fused engine patterns that don't depend on the stop or reorder chars
+EXCESSIVE_LINE_BREAKS_PATTERN = re.compile(r"\n\n\n+")
+SPACES_PATTERN = re.compile(r"  +")
 
+# Sentence patterns for the fused engine, keyed by (stop chars, reorder chars)
+_sentence_pattern_cache = {}
 
-def remove_excessive_whitespace(text):
+
+def remove_excessive_whitespace(text, document_start=True):
     """
-    Ensures that there aren't too many linebreaks.
+    Ensures that there aren't too many linebreaks. Pass document_start=False when the text
+    is a continuation of an earlier block, so its leading whitespace isn't treated as the document's.
     """
     # limit blank lines to 2
     text = re.sub(r"\n\n+", r"\n\n", text)
     # remove whitespace at the start of the document
-    text = re.sub(r"^\s*([^\s])", r"\1", text)
+    if document_start:
+        text = re.sub(r"^\s*([^\s])", r"\1", text)
     # remove spaces at the start and end of lines
     text = re.sub(r" *\n *", r"\n", text)
     # limit consecutive spaces to 0
@@ -57,66 +93,741 @@ def reorder_stop_chars(input_text, stop_chars=DEFAULT_STOP_CHARS, reorder_chars=
     ), r"\2\1", input_text)
 
 
-def split_as_one_sentence_per_line(input_text, stop_chars=DEFAULT_STOP_CHARS):
+def _stop_char(match):
+    return match.group(1)
+
+
+def _reordered_stop_char(match):
+    return match.group(2) + match.group(1)
+
+
+def _split_sentences(text, stop_chars=DEFAULT_STOP_CHARS, abbreviations=None):
+    if abbreviations is None:
+        return re.sub(r"({}) *".format(join_regex(stop_chars)), r"\1\n", text)
+
+    return abbreviations.split(re.compile(r"({})( *)".format(join_regex(stop_chars))), text, _stop_char)
+
+
+def split_as_one_sentence_per_line(input_text, stop_chars=DEFAULT_STOP_CHARS, abbreviations=None):
     """
-    Splits paragraphs into one-sentence-per-line.
+    Splits paragraphs into one-sentence-per-line. Stop chars ending one of the Abbreviations given don't split.
     """
-    sentence_per_line = re.sub(r"({}) *".format(join_regex(stop_chars)), r"\1\n", input_text)
+    sentence_per_line = _split_sentences(input_text, stop_chars, abbreviations)
     # Remove last line break
     return re.sub(r"\n$", "", sentence_per_line)
 
 
-def scrub(text, stop_chars=DEFAULT_STOP_CHARS, reorder_chars=DEFAULT_REORDER_CHARS):
+def scrub(text, stop_chars=DEFAULT_STOP_CHARS, reorder_chars=DEFAULT_REORDER_CHARS, engine=DEFAULT_ENGINE,
+          stats=None, abbreviations=None):
     """
     Scrub text. Runs the relevant functions in an appropriate order.
+    Each stage is timed into stats if given.
+    """
+    if engine == ENGINE_FUSED:
+        return scrub_fused(text, stop_chars=stop_chars, reorder_chars=reorder_chars, stats=stats,
+                           abbreviations=abbreviations)
+
+    text = run_stage(stats, "reorder_stop_chars", reorder_stop_chars, text, stop_chars=stop_chars,
+                     reorder_chars=reorder_chars)
+    text = run_stage(stats, "remove_columns", remove_columns, text)
+    text = run_stage(stats, "split_as_one_sentence_per_line", split_as_one_sentence_per_line, text,
+                     stop_chars=stop_chars, abbreviations=abbreviations)
+    text = run_stage(stats, "remove_excessive_whitespace", remove_excessive_whitespace, text)
+
+    return text
+
+
+def _split_block(text, stop_chars=DEFAULT_STOP_CHARS, document_start=True, document_end=True, abbreviations=None):
     """
-    text = reorder_stop_chars(text, stop_chars=stop_chars, reorder_chars=reorder_chars)
-    text = remove_columns(text)
-    text = split_as_one_sentence_per_line(text, stop_chars=stop_chars)
-    text = remove_excessive_whitespace(text)
+    split_as_one_sentence_per_line() for a block of a larger document.
+    """
+    text = _split_sentences(text, stop_chars, abbreviations)
+
+    if document_end:
+        text = re.sub(r"\n$", "", text)
+    if not document_start:
+        # The previous block's paragraph break already swallowed these
+        text = text.lstrip(" ")
 
     return text
 
 
+def scrub_block(text, stop_chars=DEFAULT_STOP_CHARS, reorder_chars=DEFAULT_REORDER_CHARS,
+                document_start=True, document_end=True, stats=None, abbreviations=None):
+    """
+    Runs the scrub() stages on a block of a larger document. The flags say whether the block is
+    at the start and end of the document, since some of the stages only apply there.
+    """
+    text = run_stage(stats, "reorder_stop_chars", reorder_stop_chars, text, stop_chars=stop_chars,
+                     reorder_chars=reorder_chars)
+    text = run_stage(stats, "remove_columns", remove_columns, text)
+    text = run_stage(stats, "split_as_one_sentence_per_line", _split_block, text, stop_chars=stop_chars,
+                     document_start=document_start, document_end=document_end, abbreviations=abbreviations)
+
+    return run_stage(stats, "remove_excessive_whitespace", remove_excessive_whitespace, text,
+                     document_start=document_start)
+
+
+def compile_sentence_pattern(stop_chars, reorder_chars):
+    """
+    Compiles the fused engine's pattern for reordering and splitting sentences in one go, caching it
+    per set of chars. Returns None if the chars can't be handled by the fused engine.
+    """
+    key = (tuple(stop_chars), tuple(reorder_chars))
+
+    if key not in _sentence_pattern_cache:
+        fusable = len(key[0]) != 0 and len(set(key[0]) & set(key[1])) == 0 and \
+            all(len(char) == 1 and not char.isspace() for char in key[0] + key[1])
+
+        if fusable:
+            stop_class = "[{}]".format("".join(map(re.escape, key[0])))
+            reorder_class = "[{}]?".format("".join(map(re.escape, key[1]))) if len(key[1]) != 0 else ""
+            # A stop char, then a reorderable char if there is one, then the spaces following them
+            _sentence_pattern_cache[key] = re.compile(r"({})({})( *)".format(stop_class, reorder_class))
+        else:
+            _sentence_pattern_cache[key] = None
+
+    return _sentence_pattern_cache[key]
+
+
+def scrub_fused(text, stop_chars=DEFAULT_STOP_CHARS, reorder_chars=DEFAULT_REORDER_CHARS,
+                document_start=True, document_end=True, stats=None, abbreviations=None):
+    """
+    Same as scrub_block(), but folds the stages into as few passes over the text as possible, using
+    patterns compiled once per set of chars. Stop and reorder chars must be distinct single non-whitespace
+    chars, otherwise this falls back to the stage-by-stage implementation.
+    With no separate stages to tell apart, the whole thing is timed into stats as one.
+    """
+    sentence_pattern = compile_sentence_pattern(stop_chars, reorder_chars)
+
+    if sentence_pattern is None:
+        return scrub_block(text, stop_chars=stop_chars, reorder_chars=reorder_chars,
+                           document_start=document_start, document_end=document_end, stats=stats,
+                           abbreviations=abbreviations)
+
+    return run_stage(stats, "scrub_fused", _scrub_fused, text, sentence_pattern=sentence_pattern,
+                     document_start=document_start, document_end=document_end, abbreviations=abbreviations)
+
+
+def _scrub_fused(text, sentence_pattern, document_start=True, document_end=True, abbreviations=None):
+    if document_start:
+        # Nothing else touches leading whitespace, so it can go first rather than last
+        stripped = text.lstrip()
+        text = stripped if len(stripped) != 0 else text
+
+    # Same as remove_columns(), without going through the regex engine
+    text = "\n\n".join([paragraph.replace("\n", " ") for paragraph in text.split("\n\n")])
+    if abbreviations is None:
+        text = sentence_pattern.sub(r"\2\1\n", text)
+    else:
+        text = abbreviations.split(sentence_pattern, text, _reordered_stop_char)
+
+    if document_end:
+        # Same as removing r"\n$", which also matches before a final line-break
+        if text.endswith("\n\n"):
+            text = text[:-2]
+        elif text.endswith("\n"):
+            text = text[:-1]
+    if not document_start:
+        text = text.lstrip(" ")
+
+    text = EXCESSIVE_LINE_BREAKS_PATTERN.sub("\n\n", text)
+
+    # Strip the spaces touching each line-break, but not the ones at the very start and end of the text
+    lines = text.split("\n")
+    if len(lines) > 1:
+        lines = [lines[0].rstrip(" ")] + [line.strip(" ") for line in lines[1:-1]] + [lines[-1].lstrip(" ")]
+        text = "\n".join(lines)
+
+    text = SPACES_PATTERN.sub(" ", text)
+
+    return text.replace("\t", "")
+
+
+def paragraphs_are_independent(stop_chars, reorder_chars):
+    """
+    Whether paragraphs can be scrubbed separately. Whitespace stop or reorder chars can move text
+    across paragraph breaks, in which case the whole text has to be scrubbed at once.
+    """
+    return re.search(r"\s", "".join(list(stop_chars) + list(reorder_chars))) is None
+
+
+def read_paragraph_blocks(input_file, buffer_size=DEFAULT_BUFFER_SIZE):
+    """
+    Reads a file incrementally, yielding blocks that each end in the complete run of line-breaks
+    following a paragraph. Only the final block may lack one. Joining the blocks gives back the file.
+    """
+    pending = []
+    # Line-breaks at the end of the pending block, which may turn out to be the start of a paragraph break
+    newline_tail = 0
+
+    while True:
+        data = input_file.read(buffer_size)
+        if not data:
+            break
+
+        window = "\n" * newline_tail + data
+        block_start = 0
+
+        for match in PARAGRAPH_BREAK_PATTERN.finditer(window):
+            yield "".join(pending) + window[block_start:match.end()]
+            pending = []
+            block_start = match.end()
+
+        rest = window[block_start:]
+        newline_tail = len(rest) - len(rest.rstrip("\n"))
+        pending.append(rest[:len(rest) - newline_tail])
+
+    last_block = "".join(pending) + "\n" * newline_tail
+    if len(last_block) != 0:
+        yield last_block
+
+
+def position_blocks(blocks, stop_chars=DEFAULT_STOP_CHARS, reorder_chars=DEFAULT_REORDER_CHARS):
+    """
+    Yields (block, document start, document end) for paragraph blocks as produced by read_paragraph_blocks,
+    which is what scrub_block() needs to know to scrub each of them separately.
+    """
+    if not paragraphs_are_independent(stop_chars, reorder_chars):
+        blocks = ["".join(blocks)]
+
+    block_iterator = iter(blocks)
+    document_start = True
+    current_block = next(block_iterator, None)
+
+    while current_block is not None:
+        next_block = next(block_iterator, None)
+
+        # Leading whitespace is stripped across paragraphs, so hold on until there's something else
+        if document_start and next_block is not None and len(current_block.strip()) == 0:
+            current_block += next_block
+            continue
+
+        yield current_block, document_start, next_block is None
+
+        document_start = False
+        current_block = next_block
+
+
+def scrub_blocks(blocks, stop_chars=DEFAULT_STOP_CHARS, reorder_chars=DEFAULT_REORDER_CHARS, engine=DEFAULT_ENGINE,
+                 stats=None, abbreviations=None):
+    """
+    Scrubs paragraph blocks as produced by read_paragraph_blocks one at a time. Joining the results
+    gives the same text as running scrub() on the joined blocks.
+    """
+    scrub_function = scrub_fused if engine == ENGINE_FUSED else scrub_block
+
+    for block, document_start, document_end in position_blocks(blocks, stop_chars, reorder_chars):
+        yield scrub_function(block, stop_chars=stop_chars, reorder_chars=reorder_chars,
+                             document_start=document_start, document_end=document_end, stats=stats,
+                             abbreviations=abbreviations)
+
+
+def scrub_stream(input_file, stop_chars=DEFAULT_STOP_CHARS, reorder_chars=DEFAULT_REORDER_CHARS,
+                 buffer_size=DEFAULT_BUFFER_SIZE, engine=DEFAULT_ENGINE, stats=None, abbreviations=None):
+    """
+    Scrub an open file paragraph by paragraph, yielding scrubbed text as it goes. Memory use is bounded
+    by the largest paragraph rather than by the file.
+    """
+    return scrub_blocks(read_paragraph_blocks(input_file, buffer_size=buffer_size),
+                        stop_chars=stop_chars, reorder_chars=reorder_chars, engine=engine, stats=stats,
+                        abbreviations=abbreviations)
+
+
+def scrub_stream_cached(input_file, cache, stop_chars=DEFAULT_STOP_CHARS, reorder_chars=DEFAULT_REORDER_CHARS,
+                        input_encoding=DEFAULT_INPUT_ENCODING, buffer_size=DEFAULT_BUFFER_SIZE,
+                        engine=DEFAULT_ENGINE, stats=None, abbreviations=None):
+    """
+    Same as scrub_stream(), but in chunks of paragraphs which are looked up in a ScrubCache first,
+    so only the chunks that changed since an earlier run get scrubbed again.
+    """
+    settings = cache_settings(stop_chars=stop_chars, reorder_chars=reorder_chars, input_encoding=input_encoding,
+                              abbreviations=abbreviations.fingerprint if abbreviations is not None else None)
+    scrub_function = scrub_fused if engine == ENGINE_FUSED else scrub_block
+    chunks = chunk_blocks(read_paragraph_blocks(input_file, buffer_size=buffer_size))
+
+    for chunk, document_start, document_end in position_blocks(chunks, stop_chars, reorder_chars):
+        key = cache.chunk_key(settings, chunk, document_start, document_end)
+        scrubbed_chunk = cache.get(key)
+
+        if stats is not None:
+            stats.increment("cache_hits" if scrubbed_chunk is not None else "cache_misses")
+
+        if scrubbed_chunk is None:
+            scrubbed_chunk = scrub_function(chunk, stop_chars=stop_chars, reorder_chars=reorder_chars,
+                                            document_start=document_start, document_end=document_end, stats=stats,
+                                            abbreviations=abbreviations)
+            cache.put(key, scrubbed_chunk)
+
+        yield scrubbed_chunk
+
+
+def find_chunk_boundaries(mapped_file, chunk_size=DEFAULT_CHUNK_SIZE, input_encoding=DEFAULT_INPUT_ENCODING):
+    """
+    Picks byte offsets at which a memory-mapped file can be cut into chunks of roughly chunk_size,
+    always just after a paragraph break. Returns the offsets including the start and end of the file.
+    """
+    file_size = len(mapped_file)
+
+    # Leading whitespace is stripped across paragraphs, so the first chunk must hold some actual text. Bytes that
+    # don't decode are left to the chunk they end up in
+    decoder = codecs.getincrementaldecoder(input_encoding)("replace")
+    first_text_end = 0
+    while first_text_end < file_size:
+        decoded = decoder.decode(mapped_file[first_text_end:first_text_end + DEFAULT_BUFFER_SIZE])
+        first_text_end = min(first_text_end + DEFAULT_BUFFER_SIZE, file_size)
+        if len(decoded.strip()) != 0:
+            break
+    else:
+        return [0, file_size]
+
+    boundaries = [0]
+    position = max(chunk_size, first_text_end)
+
+    while position < file_size:
+        match = PARAGRAPH_BREAK_BYTES_PATTERN.search(mapped_file, position)
+        if match is None:
+            break
+
+        boundaries.append(match.end())
+        position = match.end() + chunk_size
+
+    boundaries.append(file_size)
+    return boundaries
+
+
+def _scrub_chunk_job(chunk, input_path=None, input_encoding=DEFAULT_INPUT_ENCODING, input_errors=DECODE_STRICT,
+                     output_encoding=DEFAULT_OUTPUT_ENCODING, output_compression=None, collect_stats=False,
+                     **scrub_options):
+    """
+    Scrubs one byte range of a file, returning it encoded, compressed and ready to be written,
+    along with the stats for it if they're being collected and the counts from decode_bytes().
+    """
+    start, end, document_start, document_end = chunk
+
+    with open(input_path, "rb") as input_file:
+        mapped_file = mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            text, error_count, skipped_line_count = decode_bytes(mapped_file[start:end], input_encoding,
+                                                                 input_errors)
+        finally:
+            mapped_file.close()
+
+    stats = RunStats() if collect_stats else None
+    scrub_function = scrub_fused if scrub_options.pop("engine") == ENGINE_FUSED else scrub_block
+    scrubbed = scrub_function(text, document_start=document_start, document_end=document_end, stats=stats,
+                              **scrub_options)
+    encoded = scrubbed.encode(output_encoding)
+
+    # Encodings like UTF-16 start every string with a BOM, but it only belongs at the start of the file
+    byte_order_mark = "".encode(output_encoding)
+    if not document_start and len(byte_order_mark) != 0 and encoded.startswith(byte_order_mark):
+        encoded = encoded[len(byte_order_mark):]
+
+    # Compressed streams can be concatenated, so each chunk gets compressed on its own
+    return compress_bytes(encoded, output_compression), stats.as_dict() if stats is not None else None, \
+        (error_count, skipped_line_count)
+
+
+def scrub_file_chunked(input_path, output_path=None, jobs=None, chunk_size=DEFAULT_CHUNK_SIZE,
+                       stop_chars=DEFAULT_STOP_CHARS, reorder_chars=DEFAULT_REORDER_CHARS,
+                       input_encoding=DEFAULT_INPUT_ENCODING, output_encoding=DEFAULT_OUTPUT_ENCODING,
+                       engine=DEFAULT_ENGINE, input_compression=COMPRESSION_AUTO,
+                       output_compression=COMPRESSION_AUTO, index=False, stats=None, cache=None, dedup=None,
+                       abbreviations=None, shard_size=None, input_errors=DECODE_STRICT,
+                       fallback_encodings=DEFAULT_FALLBACK_ENCODINGS):
+    """
+    Scrubs one file across a pool of processes by cutting it into chunks at paragraph breaks.
+    Workers read their chunk straight from a memory map, so the whole file is never held in memory,
+    and the results are written back in order. Output is identical to scrub_file(), as is the index.
+    With a cache, the file is scrubbed by scrub_file() instead, since cached chunks are cut by their content,
+    and likewise with dedup, since sentences have to be checked in order, and for sharded output.
+    """
+    started = time.perf_counter()
+    output_path = output_path if output_path is not None else input_path
+    jobs = jobs if jobs is not None else cpu_count()
+    requested_encoding = input_encoding
+    input_encoding = resolve_encoding(input_path, input_encoding, detect_compression(input_path, input_compression),
+                                      fallback_encodings=fallback_encodings)
+
+    # Chunks can only be cut on line-break bytes if line-breaks are plain bytes in the input encoding,
+    # and compressed input has no byte offsets to cut at
+    if getsize(input_path) == 0 or "\n\n".encode(input_encoding) != b"\n\n" or \
+            not paragraphs_are_independent(stop_chars, reorder_chars) or \
+            detect_compression(input_path, input_compression) is not None or cache is not None or dedup is not None or \
+            shard_size is not None:
+        return scrub_file(input_path, output_path, stop_chars=stop_chars, reorder_chars=reorder_chars,
+                          input_encoding=requested_encoding, output_encoding=output_encoding, stream=True,
+                          engine=engine, input_compression=input_compression,
+                          output_compression=output_compression, index=index, stats=stats, cache=cache,
+                          dedup=dedup, abbreviations=abbreviations, shard_size=shard_size, input_errors=input_errors,
+                          fallback_encodings=fallback_encodings)
+
+    if index:
+        check_indexable(output_encoding, detect_compression(output_path, output_compression))
+
+    with open(input_path, "rb") as input_file:
+        mapped_file = mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            boundaries = find_chunk_boundaries(mapped_file, chunk_size=chunk_size, input_encoding=input_encoding)
+        finally:
+            mapped_file.close()
+
+    chunks = [(start, end, index == 0, index == len(boundaries) - 2)
+              for index, (start, end) in enumerate(zip(boundaries[:-1], boundaries[1:]))]
+    job_function = partial(_scrub_chunk_job, input_path=input_path, input_encoding=input_encoding,
+                           input_errors=input_errors, output_encoding=output_encoding,
+                           output_compression=detect_compression(output_path, output_compression),
+                           stop_chars=stop_chars, reorder_chars=reorder_chars, engine=engine,
+                           abbreviations=abbreviations, collect_stats=stats is not None)
+
+    error_count = 0
+    skipped_line_count = 0
+
+    pool = Pool(max(1, min(jobs, len(chunks))))
+    try:
+        with AtomicWriter(output_path, mode_path=input_path) as output_file:
+            writer = IndexedWriter(output_file) if index else output_file
+            # Only keep a few chunks in flight so finished ones don't pile up in memory
+            for scrubbed_chunk, chunk_stats, decode_counts in imap_bounded(pool, job_function, chunks, jobs * 2):
+                writer.write_bytes(scrubbed_chunk)
+                if chunk_stats is not None:
+                    stats.merge(chunk_stats)
+                error_count += decode_counts[0]
+                skipped_line_count += decode_counts[1]
+    finally:
+        pool.close()
+        pool.join()
+
+    if index:
+        writer.index.finish()
+        writer.index.write(index_path(output_path))
+
+    if stats is not None:
+        stats.increment("chunks", len(chunks))
+        stats.record_file(input_path, seconds=time.perf_counter() - started, bytes_read=getsize(input_path),
+                          bytes_written=output_file.stats.byte_count, write_seconds=output_file.stats.seconds)
+        record_decoding(stats, input_path, input_encoding, error_count, skipped_line_count)
+
+    print("Scrubbed {} to {} in {} chunks".format(input_path, output_path, len(chunks)))
+    print(format_throughput(write_stats=output_file.stats))
+    if requested_encoding == ENCODING_AUTO or input_errors != DECODE_STRICT:
+        print(format_decoding(input_encoding, input_errors, error_count, skipped_line_count))
+
+
+def record_decoding(stats, input_path, encoding, error_count, skipped_line_count):
+    stats.increment("files_decoded_as_{}".format(encoding))
+    stats.increment("decode_errors", error_count)
+    stats.increment("lines_skipped", skipped_line_count)
+    stats.record_file(input_path, decode_errors=error_count, lines_skipped=skipped_line_count)
+
+
 def scrub_file(input_path, output_path=None, stop_chars=DEFAULT_STOP_CHARS, reorder_chars=DEFAULT_REORDER_CHARS,
-               input_encoding=DEFAULT_INPUT_ENCODING, output_encoding=DEFAULT_OUTPUT_ENCODING):
+               input_encoding=DEFAULT_INPUT_ENCODING, output_encoding=DEFAULT_OUTPUT_ENCODING, stream=False,
+               engine=DEFAULT_ENGINE, input_compression=COMPRESSION_AUTO, output_compression=COMPRESSION_AUTO,
+               index=False, stats=None, cache=None, dedup=None, abbreviations=None, shard_size=None,
+               input_errors=DECODE_STRICT, fallback_encodings=DEFAULT_FALLBACK_ENCODINGS):
     """
     Run scrubbing on an entire file's contents. Overwrites if no input is given.
+    If stream is set, the file is scrubbed paragraph by paragraph instead of being read whole.
+    Compressed files are read and written on the fly, going by their extension unless told otherwise.
+    With a ScrubCache, files that haven't changed since they were last scrubbed are skipped, and otherwise
+    only the chunks of paragraphs that aren't in the cache are scrubbed.
+    With index set, a sentence index of the output is written alongside it.
+    With a Deduplicator as dedup, sentences it has seen before, in this file or earlier ones, are removed.
+    With Abbreviations, sentences aren't split after the ones on the list.
+    With a ShardSize, the output is written as numbered shards next to output_path, along with a manifest of them.
+    With ENCODING_AUTO as input_encoding, the encoding is detected by detect_encoding(), trying fallback_encodings
+    after UTF-8. input_errors is one of DECODE_ERROR_POLICIES for bytes that don't decode. Either way, the
+    encoding used and what was replaced or skipped is reported.
     """
+    started = time.perf_counter()
+    requested_encoding = input_encoding
     # Overwrite file if no output path is given
     output_path = output_path if output_path is not None else input_path
 
-    with codecs.open(input_path, "r", input_encoding) as input_file:
-        file_contents = input_file.read()
+    input_compression = detect_compression(input_path, input_compression)
+    output_compression = detect_compression(output_path, output_compression)
+    if index:
+        check_indexable(output_encoding, output_compression)
+
+    if cache is not None:
+        file_settings = cache_settings(stop_chars=stop_chars, reorder_chars=reorder_chars,
+                                       input_encoding=input_encoding, input_errors=input_errors,
+                                       fallback_encodings=fallback_encodings, output_encoding=output_encoding,
+                                       input_compression=input_compression, output_compression=output_compression,
+                                       abbreviations=abbreviations.fingerprint if abbreviations is not None else None)
+
+        # Skipping a file would keep its sentences from the deduplicator, and shards aren't tracked
+        if cache.file_is_unchanged(input_path, output_path, file_settings) and dedup is None and \
+                shard_size is None and \
+                (not index or exists(index_path(output_path))):
+            if stats is not None:
+                stats.increment("files_unchanged")
+
+            print("Skipped {}, unchanged since it was scrubbed to {}".format(input_path, output_path))
+            return
+
+    # Detection may as well wait until the file is known to need scrubbing
+    input_encoding = resolve_encoding(input_path, input_encoding, input_compression,
+                                      fallback_encodings=fallback_encodings)
+
+    # Written next to the destination first, since it may be the file being read
+    if shard_size is not None:
+        output_file = ShardWriter([output_path], shard_size, output_encoding, compressions=[output_compression],
+                                  mode_paths=[input_path], index=index)
+    else:
+        output_file = AtomicWriter(output_path, output_encoding, compression=output_compression,
+                                   mode_path=input_path)
+
+    with output_file:
+        writer = IndexedWriter(output_file) if index and shard_size is None else output_file
+
+        with open_reader(input_path, input_encoding, errors=input_errors,
+                         compression=input_compression) as input_file:
+            if cache is not None:
+                scrubbed_pieces = scrub_stream_cached(input_file, cache, stop_chars=stop_chars,
+                                                      reorder_chars=reorder_chars, input_encoding=input_encoding,
+                                                      engine=engine, stats=stats, abbreviations=abbreviations)
+            elif stream:
+                scrubbed_pieces = scrub_stream(input_file, stop_chars=stop_chars, reorder_chars=reorder_chars,
+                                               engine=engine, stats=stats, abbreviations=abbreviations)
+            else:
+                scrubbed_pieces = [scrub(input_file.read(), stop_chars=stop_chars, reorder_chars=reorder_chars,
+                                         engine=engine, stats=stats, abbreviations=abbreviations)]
+
+            if dedup is not None:
+                dedup_stats = RunStats()
+                scrubbed_pieces = deduplicate_text(scrubbed_pieces, dedup, stats=dedup_stats)
+
+            for scrubbed_piece in scrubbed_pieces:
+                writer.write(scrubbed_piece)
+
+    if index and shard_size is None:
+        writer.index.finish()
+        writer.index.write(index_path(output_path))
+
+    if cache is not None and shard_size is None:
+        cache.remember_file(input_path, output_path, file_settings)
+
+    write_stats = output_file.stats[0] if shard_size is not None else output_file.stats
+
+    if stats is not None:
+        if dedup is not None:
+            stats.merge(dedup_stats.as_dict())
+        stats.record_file(input_path, seconds=time.perf_counter() - started, bytes_read=input_file.stats.byte_count,
+                          read_seconds=input_file.stats.seconds, bytes_written=write_stats.byte_count,
+                          write_seconds=write_stats.seconds)
+        record_decoding(stats, input_path, input_encoding, input_file.error_count, input_file.skipped_line_count)
+
+    if shard_size is not None:
+        print("Scrubbed {} to {} in {} shards".format(input_path, output_path, len(output_file.shards[0])))
+    else:
+        print("Scrubbed {} to {}".format(input_path, output_path))
+    print(format_throughput(input_file.stats, write_stats))
+    if requested_encoding == ENCODING_AUTO or input_errors != DECODE_STRICT:
+        print(format_decoding(input_encoding, input_errors, input_file.error_count, input_file.skipped_line_count))
+    if dedup is not None:
+        print("Duplicate sentences removed: {}".format(removed_count(dedup_stats)))
+
+
+def find_input_files(paths):
+    """
+    Expands a list of files, directories and glob patterns into (input path, relative path) pairs,
+    where the relative path says where the file goes inside an output directory.
+    """
+    found_files = []
+
+    for path in paths:
+        if isdir(path):
+            for directory, directory_names, file_names in os.walk(path):
+                directory_names.sort()
+                for file_name in sorted(file_names):
+                    file_path = join(directory, file_name)
+                    found_files.append((file_path, relpath(file_path, path)))
+        elif re.search(r"[*?[]", path):
+            # Keep whatever directories come after the last one without wildcards
+            glob_root = dirname(re.split(r"[*?[]", path)[0])
+            for file_path in sorted(glob.glob(path, recursive=True)):
+                if isfile(file_path):
+                    found_files.append((file_path, relpath(file_path, glob_root or ".")))
+        else:
+            found_files.append((path, basename(path)))
+
+    return found_files
+
+
+def _scrub_file_job(file_paths, chunked=False, collect_stats=False, **scrub_options):
+    """
+    Scrubs one file of a batch, returning an error message instead of raising so the batch carries on,
+    along with the stats for the file if they're being collected.
+    """
+    input_path, output_path = file_paths
+    scrub_function = scrub_file_chunked if chunked else scrub_file
+    stats = RunStats() if collect_stats else None
+
+    try:
+        if output_path is not None and len(dirname(output_path)) != 0:
+            # Other workers may be creating the same directories
+            os.makedirs(dirname(output_path), exist_ok=True)
+
+        scrub_function(input_path, output_path, stats=stats, **scrub_options)
+    except Exception as error:
+        return input_path, "{}: {}".format(type(error).__name__, error), None
 
-    scrubbed_contents = scrub(file_contents, stop_chars=stop_chars, reorder_chars=reorder_chars)
+    return input_path, None, stats.as_dict() if stats is not None else None
 
-    with codecs.open(output_path, "w", output_encoding) as output_file:
-        output_file.write(scrubbed_contents)
 
-    print("Scrubbed {} to {}".format(input_path, output_path))
+def _scrub_queued_file(item, job_function):
+    result = job_function((item["input"], item["output"]))
+    return result[1], result
+
+
+def scrub_files(paths, output_dir=None, jobs=None, stop_chars=DEFAULT_STOP_CHARS,
+                reorder_chars=DEFAULT_REORDER_CHARS, input_encoding=DEFAULT_INPUT_ENCODING,
+                output_encoding=DEFAULT_OUTPUT_ENCODING, stream=False, engine=DEFAULT_ENGINE, parallel_chunks=False,
+                input_compression=COMPRESSION_AUTO, output_compression=COMPRESSION_AUTO, index=False, stats=None,
+                cache=None, dedup=None, abbreviations=None, shard_size=None, queue=None, input_errors=DECODE_STRICT,
+                fallback_encodings=DEFAULT_FALLBACK_ENCODINGS):
+    """
+    Scrubs many files, directories or glob patterns across a pool of processes. Output mirrors the
+    input tree inside output_dir, or overwrites the inputs if it isn't given. Returns a list of
+    (input path, error message) pairs for the files that failed.
+    With parallel_chunks, files are instead scrubbed one after another, each split across the pool.
+    A cache is shared between the workers and trimmed to its size once they're done.
+    With a Deduplicator as dedup, files are scrubbed one at a time so every file is checked against the ones
+    before it.
+    With a WorkQueue, the files are shared out with every other run using it, each worker process claiming
+    one at a time, and the failures returned are those of the whole run.
+    """
+    jobs = jobs if jobs is not None else cpu_count()
+
+    file_jobs = [(input_path, join(output_dir, relative_path) if output_dir is not None else None)
+                 for input_path, relative_path in find_input_files(paths)]
+    # Listed before the files are sorted by size, which changes as they're overwritten, so a re-run finds the
+    # same queue
+    queue_items = [{"input": abspath(input_path), "output": abspath(output_path) if output_path is not None else None}
+                   for input_path, output_path in file_jobs]
+    # Start the biggest files first so one of them doesn't hold up the end of the batch
+    file_jobs.sort(key=lambda file_paths: getsize(file_paths[0]) if isfile(file_paths[0]) else 0, reverse=True)
+
+    if parallel_chunks:
+        job_function = partial(_scrub_file_job, jobs=jobs, stop_chars=stop_chars, reorder_chars=reorder_chars,
+                               input_encoding=input_encoding, output_encoding=output_encoding, engine=engine,
+                               input_compression=input_compression, output_compression=output_compression,
+                               index=index, chunked=True, collect_stats=stats is not None, cache=cache, dedup=dedup,
+                               abbreviations=abbreviations, shard_size=shard_size, input_errors=input_errors,
+                               fallback_encodings=fallback_encodings)
+    else:
+        job_function = partial(_scrub_file_job, stop_chars=stop_chars, reorder_chars=reorder_chars,
+                               input_encoding=input_encoding, output_encoding=output_encoding,
+                               stream=stream, engine=engine, input_compression=input_compression,
+                               output_compression=output_compression, index=index, collect_stats=stats is not None,
+                               cache=cache, dedup=dedup, abbreviations=abbreviations, shard_size=shard_size,
+                               input_errors=input_errors, fallback_encodings=fallback_encodings)
+
+    if queue is not None:
+        settings = cache_settings(stop_chars=stop_chars, reorder_chars=reorder_chars, input_encoding=input_encoding,
+                                  input_errors=input_errors, fallback_encodings=fallback_encodings,
+                                  output_encoding=output_encoding, input_compression=input_compression,
+                                  output_compression=output_compression, index=index,
+                                  abbreviations=abbreviations.fingerprint if abbreviations is not None else None,
+                                  shard_size=shard_size.as_dict() if shard_size is not None else None)
+        queue.open(queue_items, settings)
+        queue_function = partial(_scrub_queued_file, job_function=job_function)
+
+        if jobs <= 1 or parallel_chunks or dedup is not None:
+            results = queue.run(queue_function)
+        else:
+            pool = Pool(jobs)
+            try:
+                # Each process is a worker of its own, claiming files until the queue is finished
+                workers = [pool.apply_async(queue.run, (queue_function,)) for _ in range(jobs)]
+                results = [result for worker in workers for result in worker.get()]
+            finally:
+                pool.close()
+                pool.join()
+    elif jobs <= 1 or len(file_jobs) <= 1 or parallel_chunks or dedup is not None:
+        results = [job_function(file_paths) for file_paths in file_jobs]
+    else:
+        pool = Pool(min(jobs, len(file_jobs)))
+        try:
+            # Hand files out a few at a time to keep messaging down without starving any worker
+            chunk_size = max(1, len(file_jobs) // (jobs * 8))
+            results = list(pool.imap_unordered(job_function, file_jobs, chunk_size))
+        finally:
+            pool.close()
+            pool.join()
+
+    failures = sorted((input_path, error) for input_path, error, file_stats in results if error is not None)
+
+    if cache is not None:
+        cache.evict()
+
+    if stats is not None:
+        stats.increment("files_scrubbed", len(results) - len(failures))
+        stats.increment("files_failed", len(failures))
+        for input_path, error, file_stats in results:
+            if file_stats is not None:
+                stats.merge(file_stats)
+
+    if queue is not None:
+        print("Scrubbed {} of {} files here, {} in the whole run".format(len(results) - len(failures),
+                                                                         len(file_jobs), queue.status()["done"]))
+        failures = sorted((item["input"], error) for item, error in queue.failures())
+    else:
+        print("Scrubbed {} of {} files".format(len(file_jobs) - len(failures), len(file_jobs)))
+
+    for input_path, error in failures:
+        print("Failed to scrub {}: {}".format(input_path, error))
+
+    return failures
 
 
 def create_arg_parser():
     description = "Tidies up natural language files into one-sentence-per-line easily-parsed files."
     parser = ArgumentParser(description=description)
 
-    parser.add_argument("input", type=str,
-                        help="Input file to scrub.")
+    parser.add_argument("input", type=str, nargs="+",
+                        help="Input files, directories or glob patterns to scrub.")
     parser.add_argument("-o, --output", metavar="output-path", type=str, dest="output",
-                        help="Scrubbed version output path.")
+                        help=" ".join([
+                            "Scrubbed version output path.",
+                            "When scrubbing more than one file, the directory to mirror the inputs into."
+                        ]))
 
     parser.add_argument("--input-encoding", metavar="encoding", type=str, dest="input_encoding",
                         default=DEFAULT_INPUT_ENCODING,
                         help=" ".join([
                             "What encoding to interpret the input files as being.",
+                            "'{}' detects it for each file from samples of it.".format(ENCODING_AUTO),
                             "Default: {}".format(DEFAULT_INPUT_ENCODING)
                         ]))
 
+    parser.add_argument("--input-errors", dest="input_errors", type=str, choices=DECODE_ERROR_POLICIES,
+                        default=DECODE_STRICT,
+                        help="What to do with bytes that don't decode: stop, replace them with U+FFFD or skip "
+                             "the lines they're on. Default: {}".format(DECODE_STRICT))
+
+    parser.add_argument("--fallback-encodings", metavar="encoding", type=str, nargs="+", dest="fallback_encodings",
+                        default=DEFAULT_FALLBACK_ENCODINGS,
+                        help="Encodings to try in order when detecting one and a file isn't UTF-8. Default: {}".format(
+                            " ".join(DEFAULT_FALLBACK_ENCODINGS)))
+
     parser.add_argument("--output-encoding", metavar="encoding", type=str, dest="output_encoding",
                         default=DEFAULT_OUTPUT_ENCODING,
                         help="What encoding to save the output files as. Default: {}".format(DEFAULT_OUTPUT_ENCODING))
 
+    parser.add_argument("--input-compression", dest="input_compression", type=str, choices=COMPRESSIONS,
+                        default=COMPRESSION_AUTO,
+                        help="How the input files are compressed. Default: {}, going by file extension".format(
+                            COMPRESSION_AUTO))
+
+    parser.add_argument("--output-compression", dest="output_compression", type=str, choices=COMPRESSIONS,
+                        default=COMPRESSION_AUTO,
+                        help="How to compress the output files. Default: {}, going by file extension".format(
+                            COMPRESSION_AUTO))
+
     default_stop_chars = "".join(DEFAULT_STOP_CHARS)
     parser.add_argument("-s, --stop-chars", metavar="stop-chars", dest="stop", type=str, default=default_stop_chars,
                         help="Chars defining sentence boundaries. Default: {}".format(default_stop_chars))
@@ -126,19 +837,118 @@ def create_arg_parser():
                         default=default_reorder_chars,
                         help="Chars which can be swapped with stop chars. Default: {}".format(default_reorder_chars))
 
+    parser.add_argument("--abbreviations", metavar="abbreviations-path", type=str, dest="abbreviations",
+                        help="File of abbreviations not to split sentences after, one per line, e.g. Dr. or e.g.")
+
+    parser.add_argument("--stream", dest="stream", default=False, action="store_true",
+                        help="Scrub paragraph by paragraph instead of loading the whole file into memory.")
+
+    parser.add_argument("--engine", dest="engine", type=str, choices=ENGINES, default=DEFAULT_ENGINE,
+                        help=" ".join([
+                            "How to run the scrub stages. '{}' folds them into fewer passes.".format(ENGINE_FUSED),
+                            "Default: {}".format(DEFAULT_ENGINE)
+                        ]))
+
+    parser.add_argument("-j", "--jobs", dest="jobs", type=int, default=cpu_count(),
+                        help="How many files or chunks to scrub at once. Default: {}".format(cpu_count()))
+
+    parser.add_argument("--parallel-chunks", dest="parallel_chunks", default=False, action="store_true",
+                        help="Split each file at paragraph breaks and scrub the pieces across --jobs processes.")
+
+    parser.add_argument("--index", dest="index", default=False, action="store_true",
+                        help="Write a sentence index next to each output, for random access to its sentences.")
+
+    add_shard_arguments(parser)
+    add_queue_arguments(parser)
+
+    parser.add_argument("--dedup", dest="dedup", default=False, action="store_true",
+                        help="Remove sentences already seen in this or an earlier file. Scrubs files one at a time.")
+    add_dedup_arguments(parser)
+
+    parser.add_argument("--stats", metavar="stats-path", type=str, dest="stats",
+                        help="Write per-stage timings and per-file figures to this file as JSON.")
+
+    parser.add_argument("--cache-dir", metavar="directory", type=str, dest="cache_dir",
+                        help="Keep scrubbed chunks here, so re-runs only scrub what changed since.")
+
+    default_cache_megabytes = DEFAULT_CACHE_SIZE // (1024 * 1024)
+    parser.add_argument("--cache-size", metavar="megabytes", type=int, dest="cache_size",
+                        default=default_cache_megabytes,
+                        help="How big the cache can get before the least recently used chunks go. Default: {}".format(
+                            default_cache_megabytes))
+
     return parser
 
 
-if __name__ == "__main__":
+def main(arguments=None):
     arg_parser = create_arg_parser()
-    args = arg_parser.parse_args()
+    args = arg_parser.parse_args(arguments)
 
     parsed_stop_chars = list(args.stop)
     parsed_reorder_chars = list(args.reorder)
 
-    ensure_arg(exists(args.input), "Input file doesn't exist.", arg_parser)
+    single_file = len(args.input) == 1 and isfile(args.input[0])
+
+    ensure_arg(single_file or len(find_input_files(args.input)) != 0, "Input files don't exist.", arg_parser)
     ensure_arg(len(parsed_stop_chars) > 0, "Stop characters are invalid", arg_parser)
     ensure_arg(len(parsed_stop_chars) > 0, "Reorderable chars missing.", arg_parser)
+    ensure_arg(args.jobs > 0, "Job count must be positive.", arg_parser)
+    ensure_arg(args.input_encoding == ENCODING_AUTO or is_known_encoding(args.input_encoding),
+               "Unknown input encoding {}.".format(args.input_encoding), arg_parser)
+    for encoding in args.fallback_encodings:
+        ensure_arg(is_known_encoding(encoding), "Unknown fallback encoding {}.".format(encoding), arg_parser)
+    ensure_arg(args.cache_size >= 0, "Cache size can't be negative.", arg_parser)
+    ensure_arg(args.abbreviations is None or isfile(args.abbreviations), "Abbreviations file doesn't exist.",
+               arg_parser)
+    check_dedup_arguments(args, arg_parser)
+    check_shard_arguments(args, arg_parser)
+    check_queue_arguments(args, arg_parser)
+    ensure_arg(args.queue_dir is None or not args.dedup, "Deduplication can't be shared through a queue.",
+               arg_parser)
+    ensure_arg(args.queue_dir is None or not single_file, "A queue shares out the files of a batch, not one file.",
+               arg_parser)
+
+    run_stats = RunStats() if args.stats is not None else None
+    deduplicator = create_deduplicator(args) if args.dedup else None
+    shard_size = create_shard_size(args)
+    abbreviations = load_abbreviations(args.abbreviations) if args.abbreviations is not None else None
+    scrub_cache = ScrubCache(args.cache_dir, args.cache_size * 1024 * 1024) if args.cache_dir is not None else None
+    work_queue = create_work_queue(args)
+
+    if single_file and args.parallel_chunks:
+        scrub_file_chunked(args.input[0], args.output, jobs=args.jobs, stop_chars=parsed_stop_chars,
+                           reorder_chars=parsed_reorder_chars, input_encoding=args.input_encoding,
+                           output_encoding=args.output_encoding, engine=args.engine,
+                           input_compression=args.input_compression, output_compression=args.output_compression,
+                           index=args.index, stats=run_stats, cache=scrub_cache, dedup=deduplicator,
+                           abbreviations=abbreviations, shard_size=shard_size, input_errors=args.input_errors,
+                           fallback_encodings=args.fallback_encodings)
+    elif single_file:
+        scrub_file(args.input[0], args.output, stop_chars=parsed_stop_chars, reorder_chars=parsed_reorder_chars,
+                   input_encoding=args.input_encoding, output_encoding=args.output_encoding, stream=args.stream,
+                   engine=args.engine, input_compression=args.input_compression,
+                   output_compression=args.output_compression, index=args.index, stats=run_stats, cache=scrub_cache,
+                   dedup=deduplicator, abbreviations=abbreviations, shard_size=shard_size,
+                   input_errors=args.input_errors, fallback_encodings=args.fallback_encodings)
+    else:
+        failed_files = scrub_files(args.input, args.output, jobs=args.jobs, stop_chars=parsed_stop_chars,
+                                   reorder_chars=parsed_reorder_chars, input_encoding=args.input_encoding,
+                                   output_encoding=args.output_encoding, stream=args.stream, engine=args.engine,
+                                   parallel_chunks=args.parallel_chunks, input_compression=args.input_compression,
+                                   output_compression=args.output_compression, index=args.index, stats=run_stats,
+                                   cache=scrub_cache, dedup=deduplicator, abbreviations=abbreviations,
+                                   shard_size=shard_size, queue=work_queue, input_errors=args.input_errors,
+                                   fallback_encodings=args.fallback_encodings)
+
+    if single_file and scrub_cache is not None:
+        scrub_cache.evict()
+
+    if run_stats is not None:
+        run_stats.write_json(args.stats)
+
+    if not single_file and len(failed_files) != 0:
+        exit(1)
+
 
-    scrub_file(args.input, args.output, stop_chars=parsed_stop_chars, reorder_chars=parsed_reorder_chars,
-               input_encoding=args.input_encoding, output_encoding=args.output_encoding)
+if __name__ == "__main__":
+    main()
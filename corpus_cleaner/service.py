@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+
+import io
+import json
+import os
+import socket
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stderr, redirect_stdout
+from multiprocessing import cpu_count
+from os.path import exists
+from socketserver import StreamRequestHandler, ThreadingMixIn, UnixStreamServer
+
+from corpus_cleaner import __version__, scrubber, equaliser, pipeline
+from corpus_cleaner.abbreviations import load_abbreviations
+from corpus_cleaner.client import DEFAULT_SOCKET_PATH, COMMAND_SCRUB, COMMAND_EQUALISE, COMMAND_CLEAN, COMMAND_PING, \
+    COMMAND_SHUTDOWN
+from corpus_cleaner.shared import ensure_arg
+
+DEFAULT_WORKERS = cpu_count()
+
+MAIN_FUNCTIONS = {
+    COMMAND_SCRUB: scrubber.main,
+    COMMAND_EQUALISE: equaliser.main,
+    COMMAND_CLEAN: pipeline.main,
+}
+
+# Run through every engine once when a worker starts, so the patterns they use are compiled before the first job
+WARM_UP_TEXT = "Warm up the patterns.\nBefore \"the first\" job (comes in).\n\nSecond paragraph; two  sentences!"
+_warmed_up = False
+
+
+def _warm_up():
+    global _warmed_up
+    if _warmed_up:
+        return
+
+    for engine in scrubber.ENGINES:
+        scrubber.scrub(WARM_UP_TEXT, engine=engine)
+    equaliser.equalise(WARM_UP_TEXT, WARM_UP_TEXT)
+    _warmed_up = True
+
+
+def _run_command(job, response):
+    command = job["command"]
+    arguments = list(job.get("arguments", []))
+
+    if command == COMMAND_SCRUB and "text" in job:
+        # Only the options apply to inline text, so stand in for the input path
+        args = scrubber.create_arg_parser().parse_args(["-"] + arguments)
+        abbreviations = load_abbreviations(args.abbreviations) if args.abbreviations is not None else None
+        response["text"] = scrubber.scrub(job["text"], stop_chars=list(args.stop), reorder_chars=list(args.reorder),
+                                          engine=args.engine, abbreviations=abbreviations)
+    elif command == COMMAND_EQUALISE and "texts" in job:
+        args = equaliser.create_arg_parser().parse_args(["-", "-"] + arguments)
+        equalised = equaliser.equalise_n(job["texts"], sentence_ratio=args.ratio, lowercase_glued=not args.keep_case,
+                                         stop_chars=list(args.stop), engine=args.engine)
+        response["texts"] = [equaliser.merge(paragraphs) for paragraphs in equalised]
+    else:
+        MAIN_FUNCTIONS[command](arguments)
+
+
+def run_job(job):
+    """
+    Runs a scrub, equalise or clean job in a worker process, returning the response for it. Jobs with paths are
+    run like the command-line tool with the same arguments, from the client's working directory. Jobs with
+    inline text return the result instead. The output the tool would have printed comes back with it.
+    """
+    _warm_up()
+
+    output = io.StringIO()
+    response = {}
+    working_directory = os.getcwd()
+
+    with redirect_stdout(output), redirect_stderr(output):
+        try:
+            os.chdir(job.get("cwd", working_directory))
+            _run_command(job, response)
+            exit_code = 0
+        except SystemExit as exit_error:
+            # Bad arguments exit the way they would on the command line
+            exit_code = exit_error.code if isinstance(exit_error.code, int) else int(exit_error.code is not None)
+        except Exception as error:
+            exit_code = 1
+            response["error"] = "{}: {}".format(type(error).__name__, error)
+        finally:
+            os.chdir(working_directory)
+
+    response.update(exit_code=exit_code, output=output.getvalue())
+    return response
+
+
+class _JobHandler(StreamRequestHandler):
+    """
+    Reads jobs from a connection one JSON line at a time, writing a JSON line back for each.
+    """
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                job = json.loads(line.decode("utf-8"))
+                command = job.get("command")
+            except (ValueError, AttributeError):
+                job, command = None, None
+
+            if command == COMMAND_PING:
+                response = {"exit_code": 0, "output": "", "version": __version__}
+            elif command == COMMAND_SHUTDOWN:
+                response = {"exit_code": 0, "output": "Shutting down\n"}
+            elif command in MAIN_FUNCTIONS:
+                response = self.server.executor.submit(run_job, job).result()
+            else:
+                response = {"exit_code": 2, "output": "", "error": "Unknown job: {}".format(line.decode(
+                    "utf-8", "replace").strip())}
+
+            self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+            self.wfile.flush()
+
+            if command == COMMAND_SHUTDOWN:
+                self.server.shutdown()
+                return
+
+
+def socket_in_use(socket_path):
+    """
+    Whether something is already listening on socket_path.
+    """
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_path)
+    except OSError:
+        return False
+    finally:
+        connection.close()
+
+    return True
+
+
+class CorpusService(ThreadingMixIn, UnixStreamServer):
+    """
+    Listens on a Unix socket for jobs from client.py. Each connection gets a thread, and jobs are run across a
+    pool of worker processes which stay up between jobs, so nothing is imported or compiled more than once.
+    Call serve_forever() to start taking jobs, and server_close() once it returns.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path=DEFAULT_SOCKET_PATH, workers=DEFAULT_WORKERS):
+        if exists(socket_path) and not socket_in_use(socket_path):
+            # Left behind by a service that didn't shut down cleanly
+            os.remove(socket_path)
+
+        UnixStreamServer.__init__(self, socket_path, _JobHandler)
+
+        self.socket_path = socket_path
+        self.executor = ProcessPoolExecutor(workers)
+
+    def server_bind(self):
+        # Only the user running the service gets to send it jobs. The socket is created that way, as changing its
+        # mode after binding would leave a moment when anyone could connect
+        old_umask = os.umask(0o177)
+        try:
+            UnixStreamServer.server_bind(self)
+        finally:
+            os.umask(old_umask)
+
+    def server_close(self):
+        UnixStreamServer.server_close(self)
+        self.executor.shutdown()
+
+        if exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+def create_arg_parser():
+    description = "Runs scrub, equalise and clean jobs sent by client.py, without starting up for every one."
+    parser = ArgumentParser(description=description)
+
+    parser.add_argument("--socket", metavar="socket-path", type=str, dest="socket", default=DEFAULT_SOCKET_PATH,
+                        help="Unix socket to listen on. Default: {}".format(DEFAULT_SOCKET_PATH))
+
+    parser.add_argument("-j", "--jobs", dest="jobs", type=int, default=DEFAULT_WORKERS,
+                        help="How many jobs to run at once. Default: {}".format(DEFAULT_WORKERS))
+
+    return parser
+
+
+def main(arguments=None):
+    arg_parser = create_arg_parser()
+    args = arg_parser.parse_args(arguments)
+
+    ensure_arg(args.jobs > 0, "Job count must be positive.", arg_parser)
+    ensure_arg(not socket_in_use(args.socket), "A service is already listening on {}.".format(args.socket), arg_parser)
+
+    service = CorpusService(args.socket, args.jobs)
+    print("Listening on {} with {} workers".format(args.socket, args.jobs))
+
+    try:
+        service.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.server_close()
+
+
+if __name__ == "__main__":
+    main()
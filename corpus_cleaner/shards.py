@@ -0,0 +1,387 @@
+import hashlib
+import io
+import json
+import os
+import threading
+from os.path import basename, exists, getsize, splitext
+from queue import Queue
+
+from corpus_cleaner import __version__
+from corpus_cleaner.index import IndexBuilder, check_indexable, index_path
+from corpus_cleaner.shared import COMPRESSION_EXTENSIONS, DEFAULT_IO_BUFFER_SIZE, ensure_arg, AtomicWriter, IOStats
+
+MANIFEST_SUFFIX = ".manifest.json"
+SHARD_NUMBER_FORMAT = "{:05d}"
+# Paragraphs go to the writer thread in batches, and only this many batches wait for it at once
+DEFAULT_BATCH_PARAGRAPHS = 256
+DEFAULT_QUEUE_SIZE = 16
+CHECKSUM_BLOCK_SIZE = 1024 * 1024
+
+
+def split_paragraphs(pieces):
+    """
+    Joins up pieces of text, e.g. as they're read from a file or scrubbed, yielding the same paragraphs
+    as text.split("\n\n") would on the whole text.
+    """
+    rest = ""
+
+    for data in pieces:
+        # A break may straddle the old and new data, so look again from the last char we had
+        search_start = max(0, len(rest) - 1)
+        rest += data
+
+        paragraph_start = 0
+        break_index = rest.find("\n\n", search_start)
+        while break_index != -1:
+            yield rest[paragraph_start:break_index]
+            paragraph_start = break_index + 2
+            break_index = rest.find("\n\n", paragraph_start)
+
+        rest = rest[paragraph_start:]
+
+    yield rest
+
+
+def read_paragraphs(input_file, buffer_size=DEFAULT_IO_BUFFER_SIZE):
+    """
+    Reads a file incrementally, yielding the same paragraphs as text.split("\n\n") would.
+    """
+    return split_paragraphs(iter(lambda: input_file.read(buffer_size), ""))
+
+
+class ParagraphWriter(object):
+    """
+    Writes paragraphs one at a time, in the same format as merge(). With index set, also builds a sentence
+    index of the output, which takes an AtomicWriter. Every sentence written gets an entry, even when merge()
+    leaves out a paragraph of empty sentences, so the indexes of equalised files line up entry for entry.
+    """
+
+    def __init__(self, output_file, index=False):
+        self.output_file = output_file
+        self.chars_written = 0
+        self.index = IndexBuilder() if index else None
+
+    def write(self, sentences):
+        paragraph = "\n".join(sentences)
+        if len(paragraph) == 0:
+            if self.index is not None and len(sentences) != 0:
+                self.index.add_paragraph(b"", len(sentences))
+            return
+
+        separator = "\n\n" if self.chars_written != 0 else ""
+
+        if self.index is None:
+            self.output_file.write(separator + paragraph)
+        else:
+            data = self.output_file.encoder.encode(separator + paragraph)
+            self.output_file.write_bytes(data)
+            # Indexable encodings write line-breaks as single bytes
+            self.index.skip(data[:len(separator)])
+            self.index.add_paragraph(data[len(separator):], len(sentences))
+
+        self.chars_written += len(separator) + len(paragraph)
+
+
+def shard_path(path, shard_number):
+    """
+    Where shard number shard_number of the output at path goes, e.g. corpus.txt.00003, or corpus.txt.00003.gz
+    so compressed shards keep their extension.
+    """
+    root, extension = splitext(path)
+    if extension.lower() in COMPRESSION_EXTENSIONS:
+        return "{}.{}{}".format(root, SHARD_NUMBER_FORMAT.format(shard_number), extension)
+
+    return "{}.{}".format(path, SHARD_NUMBER_FORMAT.format(shard_number))
+
+
+def manifest_path(path):
+    """
+    Where the manifest of the shards of the output at path goes.
+    """
+    return path + MANIFEST_SUFFIX
+
+
+def file_checksum(path):
+    digest = hashlib.sha256()
+
+    with io.open(path, "rb") as checked_file:
+        for block in iter(lambda: checked_file.read(CHECKSUM_BLOCK_SIZE), b""):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+class ShardSize(object):
+    """
+    How big a shard gets before the next one is started: max_bytes of encoded output before any compression,
+    max_sentences, or whichever comes first if both are given. Shards are only cut between paragraphs, so one
+    goes over by the rest of the paragraph that takes it past the limit.
+    """
+
+    def __init__(self, max_bytes=None, max_sentences=None):
+        self.max_bytes = max_bytes
+        self.max_sentences = max_sentences
+
+    def reached(self, byte_count, sentence_count):
+        return (self.max_bytes is not None and byte_count >= self.max_bytes) or \
+            (self.max_sentences is not None and sentence_count >= self.max_sentences)
+
+    def as_dict(self):
+        return {"bytes": self.max_bytes, "sentences": self.max_sentences}
+
+
+class _Shard(object):
+    """
+    The shard currently being written for one output.
+    """
+
+    def __init__(self, path, encoding, errors, compression, mode_path, index):
+        self.path = path
+        self.output_file = AtomicWriter(path, encoding, errors, compression=compression, mode_path=mode_path)
+        self.writer = ParagraphWriter(self.output_file, index=index)
+        self.paragraph_count = 0
+        self.sentence_count = 0
+        self.committed = False
+
+    def write(self, sentences):
+        self.writer.write(sentences)
+        self.paragraph_count += 1
+        self.sentence_count += len(sentences)
+
+    def commit(self):
+        self.output_file.commit()
+        self.committed = True
+        if self.writer.index is not None:
+            self.writer.index.write(index_path(self.path))
+
+        return {"path": basename(self.path), "paragraphs": self.paragraph_count, "sentences": self.sentence_count,
+                "bytes": getsize(self.path), "sha256": file_checksum(self.path)}
+
+
+class ShardWriter(object):
+    """
+    Writes one or more parallel outputs as numbered shards, each cut at the same paragraph once any of them
+    reaches shard_size, so shard k of every output holds the same paragraphs. Each output gets a JSON manifest
+    listing its shards with their paragraph and sentence counts, sizes and SHA-256 checksums, which is only
+    written once every shard is. Encoding, compressing and writing happen on a background thread, so whatever
+    produces the paragraphs only waits if it gets well ahead of the disk. Used as a context manager, it
+    closes if the block finishes and discards the shard in progress if it raises.
+    """
+
+    def __init__(self, paths, shard_size, encoding="utf-8", errors="strict", compressions=None, mode_paths=None,
+                 index=False, batch_paragraphs=DEFAULT_BATCH_PARAGRAPHS, queue_size=DEFAULT_QUEUE_SIZE):
+        self.paths = list(paths)
+        self.shard_size = shard_size
+        self.encoding = encoding
+        self.errors = errors
+        self.compressions = list(compressions) if compressions is not None else [None] * len(self.paths)
+        self.mode_paths = list(mode_paths) if mode_paths is not None else [None] * len(self.paths)
+        self.index = index
+        self.batch_paragraphs = batch_paragraphs
+
+        if index:
+            for compression in self.compressions:
+                check_indexable(encoding, compression)
+
+        # Filled in by the writer thread, and only safe to read once close() returns
+        self.shards = [[] for _ in self.paths]
+        self.stats = [IOStats() for _ in self.paths]
+        self.chars_written = [0] * len(self.paths)
+
+        self._batch = []
+        self._text_rest = ""
+        self._current = None
+        self._error = None
+        self._discarding = False
+        self._finished = False
+        self._queue = Queue(queue_size)
+        self._thread = threading.Thread(target=self._run, name="ShardWriter")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write_paragraphs(self, paragraphs):
+        """
+        Writes the next paragraph of each output, given as lists of sentences in the order of paths.
+        """
+        self._batch.append(paragraphs)
+
+        if len(self._batch) >= self.batch_paragraphs:
+            self._flush()
+
+    def write(self, text):
+        """
+        Writes text to the only output, e.g. as it's scrubbed, splitting it into paragraphs as it goes.
+        """
+        # A break may straddle the old and new text, so look again from the last char we had
+        search_start = max(0, len(self._text_rest) - 1)
+        rest = self._text_rest + text
+        paragraph_start = 0
+        break_index = rest.find("\n\n", search_start)
+
+        while break_index != -1:
+            self.write_paragraphs([rest[paragraph_start:break_index].split("\n")])
+            paragraph_start = break_index + 2
+            break_index = rest.find("\n\n", paragraph_start)
+
+        self._text_rest = rest[paragraph_start:]
+
+    def _flush(self):
+        if self._error is not None:
+            raise self._error
+
+        self._queue.put(self._batch)
+        self._batch = []
+
+    def _run(self):
+        try:
+            for batch in iter(self._queue.get, None):
+                for paragraphs in batch:
+                    self._write_group(paragraphs)
+            self._finished = True
+
+            if self._current is not None and not self._discarding:
+                self._commit_shard()
+        except BaseException as error:
+            self._error = error
+            # Keep taking batches so the producer never blocks on a full queue, until it notices. Once the end
+            # has been taken there's nothing more coming to wait for
+            if not self._finished:
+                for _ in iter(self._queue.get, None):
+                    pass
+        finally:
+            if self._current is not None:
+                for shard in self._current:
+                    if not shard.committed:
+                        shard.output_file.discard()
+                self._current = None
+
+    def _write_group(self, paragraphs):
+        if self._discarding:
+            return
+
+        if self._current is None:
+            shard_number = len(self.shards[0])
+            self._current = [_Shard(shard_path(path, shard_number), self.encoding, self.errors, compression,
+                                    mode_path, self.index)
+                             for path, compression, mode_path in zip(self.paths, self.compressions, self.mode_paths)]
+
+        for shard, sentences in zip(self._current, paragraphs):
+            shard.write(sentences)
+
+        if any(self.shard_size.reached(shard.output_file.stats.byte_count, shard.sentence_count)
+               for shard in self._current):
+            self._commit_shard()
+
+    def _commit_shard(self):
+        # Left in place until every output's shard is committed, so any that weren't are discarded if one fails
+        for output_number, shard in enumerate(self._current):
+            if len(self.shards[output_number]) == 0 and exists(manifest_path(self.paths[output_number])):
+                # The old manifest would describe shards that are being replaced
+                os.remove(manifest_path(self.paths[output_number]))
+
+            self.shards[output_number].append(shard.commit())
+            self.stats[output_number] += shard.output_file.stats
+            self.chars_written[output_number] += shard.writer.chars_written
+
+        self._current = None
+
+    def _write_manifests(self):
+        manifest_paths = [manifest_path(path) for path in self.paths]
+
+        for output_number, path in enumerate(self.paths):
+            # Shards left over from an earlier run with more of them
+            shard_number = len(self.shards[output_number])
+            while exists(shard_path(path, shard_number)):
+                os.remove(shard_path(path, shard_number))
+                if exists(index_path(shard_path(path, shard_number))):
+                    os.remove(index_path(shard_path(path, shard_number)))
+                shard_number += 1
+
+            shards = self.shards[output_number]
+            manifest = {
+                "version": __version__,
+                "shard_size": self.shard_size.as_dict(),
+                "shards": shards,
+                "paragraphs": sum(shard["paragraphs"] for shard in shards),
+                "sentences": sum(shard["sentences"] for shard in shards),
+                "bytes": sum(shard["bytes"] for shard in shards),
+            }
+            if len(self.paths) > 1:
+                manifest["aligned_with"] = [basename(other_path) for other_path in manifest_paths
+                                            if other_path != manifest_paths[output_number]]
+
+            with AtomicWriter(manifest_paths[output_number]) as manifest_file:
+                manifest_file.write(json.dumps(manifest, indent=2, sort_keys=True))
+
+    def close(self):
+        """
+        Writes whatever is left, waits for the writer thread to finish and writes the manifests.
+        """
+        if len(self._text_rest) != 0:
+            self.write_paragraphs([self._text_rest.split("\n")])
+            self._text_rest = ""
+
+        if len(self._batch) != 0:
+            self._flush()
+
+        self._queue.put(None)
+        self._thread.join()
+
+        if self._error is not None:
+            raise self._error
+
+        self._write_manifests()
+
+    def _stop(self):
+        self._discarding = True
+        self._queue.put(None)
+        self._thread.join()
+
+    def discard(self):
+        """
+        Stops writing, throwing away the shard in progress. Shards already finished are left as they are, but
+        without a manifest. Raises whatever went wrong on the writer thread, if anything did.
+        """
+        self._stop()
+
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # The error the block raised is the one to pass on, even if writing failed as well
+            self._stop()
+
+
+def add_shard_arguments(parser):
+    """
+    Adds the options for writing sharded output to a parser.
+    """
+    parser.add_argument("--shard-size", metavar="megabytes", type=int, dest="shard_size",
+                        help="Write the output as numbered shards of about this many megabytes, cut between "
+                             "paragraphs, with a JSON manifest of them.")
+    parser.add_argument("--shard-sentences", metavar="count", type=int, dest="shard_sentences",
+                        help="Write the output as numbered shards of about this many sentences, cut between "
+                             "paragraphs, with a JSON manifest of them.")
+
+
+def check_shard_arguments(args, parser):
+    ensure_arg(args.shard_size is None or args.shard_size > 0, "Shard size must be positive.", parser)
+    ensure_arg(args.shard_sentences is None or args.shard_sentences > 0, "Shard sentence count must be positive.",
+               parser)
+
+
+def create_shard_size(args):
+    """
+    The ShardSize asked for by the arguments, or None if the output isn't to be sharded.
+    """
+    if args.shard_size is None and args.shard_sentences is None:
+        return None
+
+    return ShardSize(max_bytes=args.shard_size * 1024 * 1024 if args.shard_size is not None else None,
+                     max_sentences=args.shard_sentences)
@@ -1,6 +1,87 @@
+import bz2
+import codecs
+import gzip
+import io
+import json
+import lzma
+import mmap
+import os
 import re
+import threading
+import time
+from collections import deque
+from os.path import abspath, basename, dirname, exists, getsize, splitext
+from shutil import copymode
+from tempfile import mkstemp
 
 DEFAULT_STOP_CHARS = [".", ";", "!", "?"]
+DEFAULT_IO_BUFFER_SIZE = 1024 * 1024
+# Local files at least this big are read through a memory map rather than read() calls
+DEFAULT_MMAP_THRESHOLD = 64 * 1024 * 1024
+
+COMPRESSION_AUTO = "auto"
+COMPRESSION_NONE = "none"
+COMPRESSION_GZIP = "gzip"
+COMPRESSION_BZ2 = "bz2"
+COMPRESSION_XZ = "xz"
+COMPRESSIONS = [COMPRESSION_AUTO, COMPRESSION_NONE, COMPRESSION_GZIP, COMPRESSION_BZ2, COMPRESSION_XZ]
+
+COMPRESSION_EXTENSIONS = {
+    ".gz": COMPRESSION_GZIP,
+    ".bz2": COMPRESSION_BZ2,
+    ".xz": COMPRESSION_XZ,
+}
+
+# Each of these reads concatenated streams back as one, which lets compressed pieces be written separately
+COMPRESSION_MODULES = {
+    COMPRESSION_GZIP: gzip,
+    COMPRESSION_BZ2: bz2,
+    COMPRESSION_XZ: lzma,
+}
+
+ENCODING_AUTO = "auto"
+# Tried in order after UTF-8 when detecting an encoding. Latin-1 decodes anything, so nothing gets past it
+DEFAULT_FALLBACK_ENCODINGS = ["cp1252", "latin-1"]
+# Detection reads this much from the start of a file, and as many blocks again from evenly spread points inside it
+DEFAULT_DETECTION_SAMPLE_SIZE = 64 * 1024
+DEFAULT_DETECTION_BLOCKS = 4
+DEFAULT_DETECTION_BLOCK_SIZE = 16 * 1024
+# UTF-32 first, since its little-endian BOM starts with UTF-16's
+BYTE_ORDER_MARKS = [
+    (codecs.BOM_UTF32_LE, "utf-32"),
+    (codecs.BOM_UTF32_BE, "utf-32"),
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+]
+
+DECODE_STRICT = "strict"
+DECODE_REPLACE = "replace"
+DECODE_SKIP_LINES = "skip-lines"
+DECODE_ERROR_POLICIES = [DECODE_STRICT, DECODE_REPLACE, DECODE_SKIP_LINES]
+REPLACEMENT_CHAR = "\ufffd"
+# Stands in for undecodable bytes until their line is dropped. No decoder gives out lone surrogates otherwise
+_SKIPPED_BYTES_MARKER = "\udfff"
+
+# Undecodable sequences handled by the decode in progress on each thread
+_decode_errors = threading.local()
+
+
+def _counting_error_handler(replacement):
+    def handle_error(error):
+        _decode_errors.count += 1
+        return replacement, error.end
+
+    return handle_error
+
+
+codecs.register_error("corpus_cleaner.replace", _counting_error_handler(REPLACEMENT_CHAR))
+codecs.register_error("corpus_cleaner.skip", _counting_error_handler(_SKIPPED_BYTES_MARKER))
+DECODE_ERROR_HANDLERS = {
+    DECODE_STRICT: "strict",
+    DECODE_REPLACE: "corpus_cleaner.replace",
+    DECODE_SKIP_LINES: "corpus_cleaner.skip",
+}
 
 
 def join_regex(target_list):
@@ -20,3 +101,516 @@ def ensure_arg(condition_met, failure_message, parser):
     print(failure_message)
     parser.print_usage()
     exit()
+
+
+def imap_bounded(pool, function, items, max_pending):
+    """
+    Like Pool.imap(), but only keeps max_pending items in flight. Lazy inputs aren't read all at
+    once and finished results don't pile up while earlier ones are still being worked on.
+    """
+    pending = deque()
+
+    for item in items:
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+        pending.append(pool.apply_async(function, (item,)))
+
+    while len(pending) != 0:
+        yield pending.popleft().get()
+
+
+def detect_compression(path, compression=COMPRESSION_AUTO):
+    """
+    Resolves a compression setting for a path, going by its extension for COMPRESSION_AUTO.
+    Returns None for uncompressed files.
+    """
+    if compression == COMPRESSION_AUTO:
+        return COMPRESSION_EXTENSIONS.get(splitext(path)[1].lower())
+
+    return None if compression == COMPRESSION_NONE else compression
+
+
+def _read_samples(path, compression=None, sample_size=DEFAULT_DETECTION_SAMPLE_SIZE,
+                  block_count=DEFAULT_DETECTION_BLOCKS, block_size=DEFAULT_DETECTION_BLOCK_SIZE):
+    """
+    The start of a file, whether that's all of it, and blocks from inside it. Compressed files can't be
+    sought through without decompressing everything before, so only their start is sampled.
+    """
+    if compression is not None:
+        with COMPRESSION_MODULES[compression].open(path, "rb") as binary_file:
+            prefix = binary_file.read(sample_size + 1)
+        return prefix[:sample_size], len(prefix) <= sample_size, []
+
+    file_size = getsize(path)
+    blocks = []
+
+    with io.open(path, "rb") as binary_file:
+        prefix = binary_file.read(sample_size)
+
+        if file_size > sample_size + block_size:
+            for block_number in range(1, block_count + 1):
+                binary_file.seek(sample_size + (file_size - sample_size - block_size) * block_number // block_count)
+                blocks.append(binary_file.read(block_size))
+
+    return prefix, file_size <= sample_size, blocks
+
+
+def _count_decode_errors(data, encoding, final, inside=False):
+    # A block from inside a file may start part-way through a char, and any block but the last end part-way
+    error_counts = []
+
+    for start in range(4 if inside else 1):
+        _decode_errors.count = 0
+        codecs.getincrementaldecoder(encoding)(DECODE_ERROR_HANDLERS[DECODE_REPLACE]).decode(data[start:], final)
+        error_counts.append(_decode_errors.count)
+
+    return min(error_counts)
+
+
+def detect_encoding(path, compression=None, fallback_encodings=DEFAULT_FALLBACK_ENCODINGS):
+    """
+    Guesses the encoding of a file from its start and a few blocks inside it, without reading the rest.
+    A byte order mark settles it straight away. Otherwise it's UTF-8 if every sample is valid UTF-8, or
+    the first of fallback_encodings that decodes every sample. If none of them does, it's whichever leaves
+    the fewest bytes that don't decode, for the error policy to deal with.
+    """
+    prefix, whole_file, blocks = _read_samples(path, compression)
+
+    for byte_order_mark, encoding in BYTE_ORDER_MARKS:
+        if prefix.startswith(byte_order_mark):
+            return encoding
+
+    best_encoding = None
+    best_error_count = None
+
+    for encoding in ["utf-8"] + list(fallback_encodings):
+        error_count = _count_decode_errors(prefix, encoding, whole_file) + \
+            sum(_count_decode_errors(block, encoding, False, inside=True) for block in blocks)
+        if error_count == 0:
+            return encoding
+
+        if best_error_count is None or error_count < best_error_count:
+            best_encoding, best_error_count = encoding, error_count
+
+    return best_encoding
+
+
+def is_known_encoding(encoding):
+    try:
+        codecs.lookup(encoding)
+    except LookupError:
+        return False
+
+    return True
+
+
+def resolve_encoding(path, encoding, compression=None, fallback_encodings=DEFAULT_FALLBACK_ENCODINGS):
+    """
+    The encoding to read path as, detecting it for ENCODING_AUTO.
+    """
+    if encoding == ENCODING_AUTO:
+        return detect_encoding(path, compression, fallback_encodings=fallback_encodings)
+
+    return encoding
+
+
+def _drop_marked_lines(text):
+    lines = text.split("\n")
+    kept_lines = [line for line in lines if _SKIPPED_BYTES_MARKER not in line]
+
+    return "\n".join(kept_lines), len(lines) - len(kept_lines)
+
+
+def decode_bytes(data, encoding, errors=DECODE_STRICT):
+    """
+    Decodes data in one go with one of DECODE_ERROR_POLICIES, returning the text along with how many
+    undecodable sequences were replaced or skipped, and how many lines were skipped for having them.
+    """
+    _decode_errors.count = 0
+    text = data.decode(encoding, DECODE_ERROR_HANDLERS[errors])
+    error_count = _decode_errors.count
+
+    if errors == DECODE_SKIP_LINES and error_count != 0:
+        text, skipped_line_count = _drop_marked_lines(text)
+        return text, error_count, skipped_line_count
+
+    return text, error_count, 0
+
+
+def format_decoding(encoding, errors, error_count, skipped_line_count):
+    """
+    Says how a file was decoded, e.g. "Decoded as cp1252, 3 undecodable sequences replaced".
+    """
+    if errors == DECODE_SKIP_LINES:
+        return "Decoded as {}, {} lines with undecodable bytes skipped".format(encoding, skipped_line_count)
+
+    return "Decoded as {}, {} undecodable sequences replaced".format(encoding, error_count)
+
+
+def compress_bytes(data, compression=None):
+    """
+    Compresses data as a complete stream on its own, or returns it as it is without a compression.
+    """
+    if compression is None:
+        return data
+
+    return COMPRESSION_MODULES[compression].compress(data)
+
+
+def create_temporary_path(path):
+    """
+    Creates an empty temporary file in the same directory as path, so it can be renamed over it later.
+    """
+    file_descriptor, temporary_path = mkstemp(dir=dirname(abspath(path)), prefix=".{}.".format(basename(path)))
+    os.close(file_descriptor)
+
+    return temporary_path
+
+
+def _default_file_mode():
+    """
+    The permissions a newly created file would get under the current umask.
+    """
+    umask = os.umask(0)
+    os.umask(umask)
+
+    return 0o666 & ~umask
+
+
+class IOStats(object):
+    """
+    Running total of the bytes read or written and the seconds spent doing so.
+    """
+
+    def __init__(self, byte_count=0, seconds=0.0):
+        self.byte_count = byte_count
+        self.seconds = seconds
+
+    def add(self, byte_count, seconds):
+        self.byte_count += byte_count
+        self.seconds += seconds
+
+    def __add__(self, other):
+        return IOStats(self.byte_count + other.byte_count, self.seconds + other.seconds)
+
+    @property
+    def megabytes(self):
+        return self.byte_count / (1024.0 * 1024.0)
+
+    @property
+    def megabytes_per_second(self):
+        if self.seconds == 0:
+            return 0.0
+
+        return self.megabytes / self.seconds
+
+    def __str__(self):
+        return "{:.1f} MB at {:.1f} MB/s".format(self.megabytes, self.megabytes_per_second)
+
+
+def format_throughput(read_stats=None, write_stats=None):
+    """
+    Describes how much was read and written and how quickly, for printing after a file is done.
+    """
+    parts = []
+    if read_stats is not None:
+        parts.append("read {}".format(read_stats))
+    if write_stats is not None:
+        parts.append("wrote {}".format(write_stats))
+
+    description = ", ".join(parts)
+    return description[:1].upper() + description[1:]
+
+
+class MappedFile(object):
+    """
+    Reads a local file through a memory map, so reads are slices of the page cache rather than system calls.
+    """
+
+    def __init__(self, path):
+        self.binary_file = io.open(path, "rb")
+        self.position = 0
+        # Empty files can't be mapped
+        self.mapped_file = mmap.mmap(self.binary_file.fileno(), 0, access=mmap.ACCESS_READ) \
+            if getsize(path) != 0 else b""
+
+    def read(self, size=-1):
+        end = len(self.mapped_file) if size is None or size < 0 else self.position + size
+        data = self.mapped_file[self.position:end]
+        self.position += len(data)
+
+        return data
+
+    def close(self):
+        if not isinstance(self.mapped_file, bytes):
+            self.mapped_file.close()
+        self.binary_file.close()
+
+
+class TextReader(object):
+    """
+    Reads text from a binary file in large blocks, decoding it incrementally. Sizes passed to read() are in bytes
+    rather than chars. With translate_newlines, "\r\n" and "\r" come out as "\n" like in text mode.
+    errors is one of DECODE_ERROR_POLICIES, and what was replaced or skipped is counted as the file is read.
+    """
+
+    def __init__(self, binary_file, encoding, errors=DECODE_STRICT, buffer_size=DEFAULT_IO_BUFFER_SIZE,
+                 translate_newlines=False):
+        self.binary_file = binary_file
+        self.encoding = encoding
+        self.errors = errors
+        self.decoder = codecs.getincrementaldecoder(encoding)(DECODE_ERROR_HANDLERS[errors])
+        self.buffer_size = buffer_size
+        self.translate_newlines = translate_newlines
+        self.pending_carriage_return = ""
+        self.pending_line = ""
+        self.error_count = 0
+        self.skipped_line_count = 0
+        self.stats = IOStats()
+
+    def read(self, size=-1):
+        """
+        Reads and decodes up to size bytes, or the rest of the file if size is negative.
+        Returns an empty string at the end of the file.
+        """
+        while True:
+            started = time.perf_counter()
+            data = self.binary_file.read(size if size is not None and size >= 0 else -1)
+            self.stats.add(len(data), time.perf_counter() - started)
+
+            final = len(data) == 0 or size is None or size < 0
+            _decode_errors.count = 0
+            text = self.decoder.decode(data, final)
+            self.error_count += _decode_errors.count
+
+            if self.translate_newlines:
+                text = self._translate_newlines(text, final)
+
+            if self.errors == DECODE_SKIP_LINES:
+                text = self._skip_lines(text, final)
+
+            # A block may end part-way through a char, so only stop on an empty result at the end of the file
+            if len(text) != 0 or final:
+                return text
+
+    def _translate_newlines(self, text, final):
+        text = self.pending_carriage_return + text
+        self.pending_carriage_return = ""
+
+        # The next block might start with the "\n" that goes with it
+        if not final and text.endswith("\r"):
+            self.pending_carriage_return = "\r"
+            text = text[:-1]
+
+        return text.replace("\r\n", "\n").replace("\r", "\n")
+
+    def _skip_lines(self, text, final):
+        text = self.pending_line + text
+        self.pending_line = ""
+
+        # The last line may carry on into the next block, which could still have bad bytes for it
+        if not final:
+            line_start = text.rfind("\n") + 1
+            self.pending_line = text[line_start:]
+            text = text[:line_start]
+
+        if _SKIPPED_BYTES_MARKER not in text:
+            return text
+
+        text, skipped_line_count = _drop_marked_lines(text)
+        self.skipped_line_count += skipped_line_count
+        return text
+
+    def __iter__(self):
+        while True:
+            text = self.read(self.buffer_size)
+            if len(text) == 0:
+                return
+            yield text
+
+    def close(self):
+        self.binary_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def open_reader(path, encoding, errors=DECODE_STRICT, compression=None, buffer_size=DEFAULT_IO_BUFFER_SIZE,
+                translate_newlines=False, mmap_threshold=DEFAULT_MMAP_THRESHOLD):
+    """
+    Opens a file for reading as text through a TextReader. Compressed files are decompressed on the fly,
+    and local files of at least mmap_threshold bytes are read through a memory map.
+    """
+    if compression is not None:
+        binary_file = COMPRESSION_MODULES[compression].open(path, "rb")
+    elif mmap_threshold is not None and getsize(path) >= mmap_threshold:
+        binary_file = MappedFile(path)
+    else:
+        # Reads are already in large blocks, so another layer of buffering would only add a copy
+        binary_file = io.open(path, "rb", buffering=0)
+
+    return TextReader(binary_file, encoding, errors=errors, buffer_size=buffer_size,
+                      translate_newlines=translate_newlines)
+
+
+class AtomicWriter(object):
+    """
+    Encodes text into a temporary file next to path, which only replaces path once commit() is called.
+    Until then path is left untouched, even if the process dies part-way through. Used as a context manager,
+    it commits if the block finishes and discards the temporary file if it raises.
+    """
+
+    def __init__(self, path, encoding="utf-8", errors="strict", compression=None, mode_path=None,
+                 buffer_size=DEFAULT_IO_BUFFER_SIZE):
+        self.path = path
+        self.mode_path = mode_path
+        self.temporary_path = create_temporary_path(path)
+        self.binary_file = io.open(self.temporary_path, "wb", buffering=buffer_size)
+        self.output_file = COMPRESSION_MODULES[compression].open(self.binary_file, "wb") \
+            if compression is not None else self.binary_file
+        self.encoder = codecs.getincrementalencoder(encoding)(errors)
+        self.stats = IOStats()
+
+    def write(self, text):
+        self.write_bytes(self.encoder.encode(text))
+
+    def write_bytes(self, data):
+        """
+        Writes data that is already encoded, and compressed if the output is.
+        """
+        started = time.perf_counter()
+        self.output_file.write(data)
+        self.stats.add(len(data), time.perf_counter() - started)
+
+    def _close_files(self):
+        if self.output_file is not self.binary_file:
+            self.output_file.close()
+        self.binary_file.close()
+
+    def commit(self):
+        """
+        Finishes writing and moves the temporary file over path, keeping the permissions of mode_path or path.
+        """
+        self.finish()
+        self.replace()
+
+    def finish(self):
+        """
+        The first half of commit(): finishes writing the temporary file and gives it its permissions.
+        """
+        self.write_bytes(self.encoder.encode("", True))
+
+        started = time.perf_counter()
+        self._close_files()
+        self.stats.add(0, time.perf_counter() - started)
+
+        mode_path = self.mode_path if self.mode_path is not None and exists(self.mode_path) else self.path
+        if exists(mode_path):
+            copymode(mode_path, self.temporary_path)
+        else:
+            # mkstemp() only gives the owner access
+            os.chmod(self.temporary_path, _default_file_mode())
+
+    def replace(self):
+        """
+        The second half of commit(): moves the finished temporary file over path.
+        """
+        os.replace(self.temporary_path, self.path)
+
+    def discard(self):
+        """
+        Throws away everything written so far, leaving path as it was.
+        """
+        try:
+            self._close_files()
+        finally:
+            os.remove(self.temporary_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.discard()
+
+
+class RunStats(object):
+    """
+    Per-stage timings, counters and per-file figures for a run. Functions taking a stats argument only record
+    anything when given one. Every update is passed on to the hooks as hook(kind, name, values), where kind
+    is "stage", "counter" or "file", so the numbers can be exported as they come in.
+    """
+
+    def __init__(self, hooks=None):
+        self.stages = {}
+        self.counters = {}
+        self.files = {}
+        self.hooks = list(hooks) if hooks is not None else []
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def _notify(self, kind, name, values):
+        for hook in self.hooks:
+            hook(kind, name, values)
+
+    def record_stage(self, name, seconds, chars_in, chars_out, calls=1):
+        values = {"calls": calls, "seconds": seconds, "chars_in": chars_in, "chars_out": chars_out}
+        stage = self.stages.setdefault(name, {"calls": 0, "seconds": 0.0, "chars_in": 0, "chars_out": 0})
+        for key, value in values.items():
+            stage[key] += value
+
+        self._notify("stage", name, values)
+
+    def increment(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+        self._notify("counter", name, amount)
+
+    def record_file(self, path, **values):
+        file_values = self.files.setdefault(path, {})
+        for key, value in values.items():
+            file_values[key] = file_values.get(key, 0) + value
+
+        self._notify("file", path, values)
+
+    def as_dict(self):
+        return {
+            "stages": {name: dict(values) for name, values in self.stages.items()},
+            "counters": dict(self.counters),
+            "files": {path: dict(values) for path, values in self.files.items()},
+        }
+
+    def merge(self, stats_dict):
+        """
+        Adds in the numbers from another run's as_dict(), e.g. one sent back from a worker process.
+        """
+        for name, values in stats_dict["stages"].items():
+            self.record_stage(name, values["seconds"], values["chars_in"], values["chars_out"], values["calls"])
+        for name, amount in stats_dict["counters"].items():
+            self.increment(name, amount)
+        for path, values in stats_dict["files"].items():
+            self.record_file(path, **values)
+
+    def write_json(self, path):
+        with io.open(path, "w", encoding="utf-8") as stats_file:
+            json.dump(self.as_dict(), stats_file, indent=2, sort_keys=True)
+
+
+def run_stage(stats, name, function, text, **kwargs):
+    """
+    Calls function(text, **kwargs), recording its time and the length of its input and output
+    under name if stats are being kept.
+    """
+    if stats is None:
+        return function(text, **kwargs)
+
+    started = time.perf_counter()
+    result = function(text, **kwargs)
+    stats.record_stage(name, time.perf_counter() - started, len(text), len(result))
+
+    return result
@@ -1,7 +1,20 @@
-from unittest import TestCase, main
+from unittest import TestCase, main, skipIf
+from functools import partial
+from io import StringIO
+from multiprocessing import Process
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+from threading import Thread
+import gzip
+import json
+import os
+import random
 import re
+import time
 
-from corpus_cleaner import scrubber, equaliser
+from corpus_cleaner import scrubber, equaliser, shared, benchmark, cache, pipeline, index, service, client, dedup, \
+    abbreviations, shards, workqueue
 
 
 def prepare_test_string(string):
@@ -67,6 +80,988 @@ class ScrubTest(TestCase):
             """))
         )
 
+    def test_scrub_stream(self):
+        fragments = ["word", "Cap", " ", "  ", "\t", "\n", "\n\n", "\n\n\n", ".", "!", "?", ";", "\"", "'", ")"]
+        generator = random.Random(0)
+
+        for _ in range(2000):
+            text = "".join(generator.choice(fragments) for _ in range(generator.randint(0, 40)))
+
+            for buffer_size in [1, 5, 4096]:
+                streamed = "".join(scrubber.scrub_stream(StringIO(text), buffer_size=buffer_size))
+                self.assertEqual(scrubber.scrub(text), streamed)
+
+
+class FusedScrubTest(TestCase):
+
+    def random_corpus(self, generator, length):
+        fragments = ["word", "Cap", " ", "  ", "\t", "\n", "\n\n", "\n\n\n", ".", "!", "?", ";", "\"", "'", ")", "]"]
+        return "".join(generator.choice(fragments) for _ in range(length))
+
+    def test_matches_reference(self):
+        generator = random.Random(1)
+        char_sets = [
+            (scrubber.DEFAULT_STOP_CHARS, scrubber.DEFAULT_REORDER_CHARS),
+            ([".", "!"], ["]"]),
+            (["."], []),
+            # Not fusable, so these fall back to the reference stages
+            ([".", " "], [")"]),
+            ([".", "..."], ["\""]),
+        ]
+
+        for _ in range(2000):
+            text = self.random_corpus(generator, generator.randint(0, 60))
+
+            for stop_chars, reorder_chars in char_sets:
+                self.assertEqual(
+                    scrubber.scrub(text, stop_chars=stop_chars, reorder_chars=reorder_chars),
+                    scrubber.scrub(text, stop_chars=stop_chars, reorder_chars=reorder_chars,
+                                   engine=scrubber.ENGINE_FUSED)
+                )
+
+    def test_stream_matches_reference(self):
+        generator = random.Random(2)
+
+        for _ in range(500):
+            text = self.random_corpus(generator, generator.randint(0, 60))
+            streamed = scrubber.scrub_stream(StringIO(text), buffer_size=3, engine=scrubber.ENGINE_FUSED)
+            self.assertEqual(scrubber.scrub(text), "".join(streamed))
+
+    def test_pattern_cache(self):
+        first = scrubber.compile_sentence_pattern([".", "!"], ["\""])
+        self.assertIs(first, scrubber.compile_sentence_pattern([".", "!"], ["\""]))
+        self.assertIsNone(scrubber.compile_sentence_pattern(["\t"], ["\""]))
+
+
+class AbbreviationTest(TestCase):
+
+    def setUp(self):
+        self.abbreviations = abbreviations.parse_abbreviations(
+            ["# English", "Dr.", "e.g", "U.S.", "", "No #NUMERIC_ONLY#"])
+
+    def test_parse_abbreviations(self):
+        self.assertEqual(["Dr.", "No.", "U.S.", "e.g."], self.abbreviations.abbreviations)
+        self.assertNotEqual(self.abbreviations.fingerprint, abbreviations.Abbreviations(["Dr."]).fingerprint)
+
+    def test_split(self):
+        text = "Dr. Smith moved to the U.S. last year. Many do, e.g. \"Dr. Who.\" No. Sydr. left.\n\ne.g.Next one."
+
+        for engine in scrubber.ENGINES:
+            self.assertEqual("Dr. Smith moved to the U.S. last year.\nMany do, e.g. \"Dr. Who\".\nNo. Sydr.\nleft."
+                             "\n\ne.g.Next one.",
+                             scrubber.scrub(text, engine=engine, abbreviations=self.abbreviations))
+
+        self.assertEqual(scrubber.scrub(text), scrubber.scrub(text, abbreviations=abbreviations.Abbreviations([])))
+
+    def test_fused_matches_reference(self):
+        generator = random.Random(3)
+        fragments = ["word", "Dr", "e", "g", "U", "S", " ", "  ", "\n", "\n\n", ".", ".", "!", "\"", ")"]
+
+        for _ in range(2000):
+            text = "".join(generator.choice(fragments) for _ in range(generator.randint(0, 60)))
+            self.assertEqual(scrubber.scrub(text, abbreviations=self.abbreviations),
+                             scrubber.scrub(text, engine=scrubber.ENGINE_FUSED, abbreviations=self.abbreviations))
+
+    def test_abbreviations_argument(self):
+        directory = mkdtemp()
+        self.addCleanup(rmtree, directory)
+
+        abbreviations_path = join(directory, "abbreviations.txt")
+        input_path = join(directory, "input.txt")
+        with open(abbreviations_path, "w") as abbreviations_file:
+            abbreviations_file.write("Dr\nProf.\n")
+        with open(input_path, "w") as input_file:
+            input_file.write("Prof. Plum and Dr. Green met. They talked.")
+
+        scrubber.main([input_path, "--abbreviations", abbreviations_path, "--stream"])
+
+        with open(input_path) as input_file:
+            self.assertEqual("Prof. Plum and Dr. Green met.\nThey talked.", input_file.read())
+
+
+class BatchScrubTest(TestCase):
+
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.input_dir = join(self.directory, "input")
+        os.makedirs(join(self.input_dir, "nested"))
+
+        for index, relative_path in enumerate(["first.txt", "second.txt", join("nested", "third.txt")]):
+            with open(join(self.input_dir, relative_path), "w") as test_file:
+                test_file.write("File  {}. Split\nacross lines!".format(index))
+
+        # Not valid UTF-8, so this one should fail without stopping the rest
+        with open(join(self.input_dir, "broken.txt"), "wb") as test_file:
+            test_file.write(b"\xff\xfe\xfa")
+
+    def tearDown(self):
+        rmtree(self.directory)
+
+    def test_jobs_option(self):
+        self.assertEqual(2, scrubber.create_arg_parser().parse_args(["x.txt", "--jobs", "2"]).jobs)
+        self.assertEqual(3, scrubber.create_arg_parser().parse_args(["x.txt", "-j", "3"]).jobs)
+
+    def test_find_input_files(self):
+        self.assertEqual(
+            [join("nested", "third.txt")],
+            [relative_path for _, relative_path in scrubber.find_input_files([join(self.input_dir, "*", "*.txt")])]
+        )
+        self.assertEqual(4, len(scrubber.find_input_files([self.input_dir])))
+
+    def test_scrub_files(self):
+        output_dir = join(self.directory, "output")
+        failures = scrubber.scrub_files([self.input_dir], output_dir, jobs=2)
+
+        self.assertEqual([join(self.input_dir, "broken.txt")], [input_path for input_path, _ in failures])
+
+        with open(join(output_dir, "nested", "third.txt")) as output_file:
+            self.assertEqual("File 2.\nSplit across lines!", output_file.read())
+
+    def test_scrub_file_chunked(self):
+        generator = random.Random(3)
+        fragments = ["word", "Cap", " ", "\t", "\n", "\n\n", "\n\n\n", ".", "!", "\"", "\u00e9"]
+        input_path = join(self.directory, "chunked.txt")
+        output_path = join(self.directory, "chunked.out.txt")
+
+        for _ in range(20):
+            text = "".join(generator.choice(fragments) for _ in range(generator.randint(0, 300)))
+            with open(input_path, "w", encoding="utf-8") as input_file:
+                input_file.write(text)
+
+            scrubber.scrub_file_chunked(input_path, output_path, jobs=2, chunk_size=generator.randint(1, 30))
+
+            with open(output_path, encoding="utf-8", newline="") as output_file:
+                self.assertEqual(scrubber.scrub(text), output_file.read())
+
+
+class CompressionTest(TestCase):
+
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.addCleanup(rmtree, self.directory)
+
+    def write(self, file_name, text):
+        path = join(self.directory, file_name)
+        with shared.AtomicWriter(path, "utf-8", compression=shared.detect_compression(path)) as test_file:
+            test_file.write(text)
+        return path
+
+    def read(self, path):
+        with shared.open_reader(path, "utf-8", compression=shared.detect_compression(path)) as test_file:
+            return test_file.read()
+
+    def test_detect_compression(self):
+        self.assertEqual(shared.COMPRESSION_GZIP, shared.detect_compression("corpus.txt.gz"))
+        self.assertEqual(None, shared.detect_compression("corpus.txt"))
+        self.assertEqual(shared.COMPRESSION_XZ, shared.detect_compression("corpus.txt", shared.COMPRESSION_XZ))
+        self.assertEqual(None, shared.detect_compression("corpus.gz", shared.COMPRESSION_NONE))
+
+    def test_scrub_compressed(self):
+        text = "First  sentence. Second\nline!\n\n\nNext paragraph \"quoted.\"" * 50
+        input_path = self.write("input.txt.gz", text)
+
+        for output_name, stream in [("output.txt.xz", False), ("output.txt.bz2", True), ("output.txt", True)]:
+            output_path = join(self.directory, output_name)
+            scrubber.scrub_file(input_path, output_path, stream=stream)
+            self.assertEqual(scrubber.scrub(text), self.read(output_path))
+
+        # Chunks get compressed separately and written one after the other
+        plain_input_path = self.write("input.txt", text)
+        output_path = join(self.directory, "chunked.txt.gz")
+        scrubber.scrub_file_chunked(plain_input_path, output_path, jobs=2, chunk_size=100)
+        self.assertEqual(scrubber.scrub(text), self.read(output_path))
+
+    def test_equalise_compressed(self):
+        texts = ["One sentence.\nAnother one here.\n\nNew paragraph.", "One longer sentence here.\nAnother.\n\nNew."]
+        expected = [equaliser.merge(paragraphs) for paragraphs in equaliser.equalise(*texts)]
+
+        for stream in [False, True]:
+            paths = [self.write("a.txt.gz", texts[0]), self.write("b.txt.xz", texts[1])]
+            equaliser.equalise_file(paths[0], paths[1], stream=stream)
+            self.assertEqual(expected, [self.read(path) for path in paths])
+
+
+class IOTest(TestCase):
+
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.addCleanup(rmtree, self.directory)
+
+    def test_text_reader(self):
+        text = "Ünïcödé\r\nlines\rand more\r\n\r\n" * 20
+        path = join(self.directory, "input.txt")
+        with open(path, "wb") as input_file:
+            input_file.write(text.encode("utf-8"))
+
+        # Tiny blocks cut through multi-byte chars and "\r\n" pairs
+        for mmap_threshold in [None, 0]:
+            for buffer_size in [1, 2, 3, 7, 1024]:
+                with shared.open_reader(path, "utf-8", mmap_threshold=mmap_threshold) as reader:
+                    self.assertEqual(text, "".join(iter(lambda: reader.read(buffer_size), "")))
+                with shared.open_reader(path, "utf-8", mmap_threshold=mmap_threshold, translate_newlines=True,
+                                        buffer_size=buffer_size) as reader:
+                    self.assertEqual(text.replace("\r\n", "\n").replace("\r", "\n"), "".join(reader))
+                    self.assertEqual(len(text.encode("utf-8")), reader.stats.byte_count)
+
+    def test_atomic_writer(self):
+        path = join(self.directory, "output.txt")
+        with open(path, "w") as output_file:
+            output_file.write("Original.")
+        os.chmod(path, 0o640)
+
+        with self.assertRaises(RuntimeError):
+            with shared.AtomicWriter(path) as writer:
+                writer.write("Half")
+                raise RuntimeError()
+
+        with open(path) as output_file:
+            self.assertEqual("Original.", output_file.read())
+        self.assertEqual(["output.txt"], os.listdir(self.directory))
+
+        with shared.AtomicWriter(path, "utf-16") as writer:
+            writer.write("Replaced.")
+            writer.write(" Twice.")
+
+        with open(path, encoding="utf-16") as output_file:
+            self.assertEqual("Replaced. Twice.", output_file.read())
+        self.assertEqual(0o640, os.stat(path).st_mode & 0o777)
+        self.assertEqual(["output.txt"], os.listdir(self.directory))
+
+
+class DecodingTest(TestCase):
+
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.addCleanup(rmtree, self.directory)
+
+    def write_bytes(self, name, data):
+        path = join(self.directory, name)
+        with open(path, "wb") as test_file:
+            test_file.write(data)
+        return path
+
+    def test_detect_encoding(self):
+        text = "Café crème. “Déjà vu.”\n\n" * 10
+        for name, data, expected in [
+            ("ascii.txt", b"Plain text.", "utf-8"),
+            ("utf8.txt", text.encode("utf-8"), "utf-8"),
+            ("bom8.txt", text.encode("utf-8-sig"), "utf-8-sig"),
+            ("bom16.txt", text.encode("utf-16"), "utf-16"),
+            ("bom32.txt", text.encode("utf-32"), "utf-32"),
+            ("cp1252.txt", text.encode("cp1252"), "cp1252"),
+            # 0x81 isn't a cp1252 char, so only latin-1 will do
+            ("latin1.txt", b"Caf\xe9 \x81", "latin-1"),
+        ]:
+            self.assertEqual(expected, shared.detect_encoding(self.write_bytes(name, data)), name)
+
+        # Only sampled from inside the file, past the start and cut part-way through chars
+        utf8_text = ("Ünïcödé " * 10000).encode("utf-8")
+        self.assertEqual("utf-8", shared.detect_encoding(self.write_bytes("long.txt", utf8_text)))
+        middle = len(utf8_text) // 2
+        self.assertEqual("cp1252", shared.detect_encoding(
+            self.write_bytes("long-mixed.txt", utf8_text[:middle] + "é".encode("cp1252") * 100000 +
+                             utf8_text[middle:])))
+
+        gzip_path = join(self.directory, "cp1252.txt.gz")
+        with gzip.open(gzip_path, "wb") as gzip_file:
+            gzip_file.write(text.encode("cp1252"))
+        self.assertEqual("cp1252", shared.detect_encoding(gzip_path, compression=shared.COMPRESSION_GZIP))
+
+    def test_error_policies(self):
+        data = b"Good line.\nBad \xff line.\nAnother good one.\n\nBad \xfe\xfe too.\nEnd."
+        path = self.write_bytes("broken.txt", data)
+
+        with self.assertRaises(UnicodeDecodeError):
+            shared.decode_bytes(data, "utf-8")
+
+        replaced = data.decode("utf-8", "replace")
+        skipped = "Good line.\nAnother good one.\n\nEnd."
+        self.assertEqual((replaced, 3, 0), shared.decode_bytes(data, "utf-8", shared.DECODE_REPLACE))
+        self.assertEqual((skipped, 3, 2), shared.decode_bytes(data, "utf-8", shared.DECODE_SKIP_LINES))
+
+        # Tiny blocks split the bad lines across reads
+        for buffer_size in [1, 2, 5, 1024]:
+            for errors, expected, skipped_line_count in [(shared.DECODE_REPLACE, replaced, 0),
+                                                         (shared.DECODE_SKIP_LINES, skipped, 2)]:
+                with shared.open_reader(path, "utf-8", errors=errors, buffer_size=buffer_size) as reader:
+                    self.assertEqual(expected, "".join(reader))
+                    self.assertEqual(3, reader.error_count)
+                    self.assertEqual(skipped_line_count, reader.skipped_line_count)
+
+    def test_scrub_file_auto(self):
+        text = "Café  crème. Déjà vu!\n\n" * 1000
+        input_path = self.write_bytes("input.txt", text.encode("cp1252") + b"Bad \x81 byte.")
+        output_path = join(self.directory, "output.txt")
+        stats = shared.RunStats()
+
+        for function in [scrubber.scrub_file, partial(scrubber.scrub_file_chunked, jobs=2, chunk_size=1024)]:
+            function(input_path, output_path, input_encoding=shared.ENCODING_AUTO,
+                     fallback_encodings=["cp1252"], input_errors=shared.DECODE_SKIP_LINES, stats=stats)
+
+            # The last line goes, along with the line-break ending the one before
+            with open(output_path, encoding="utf-8") as output_file:
+                self.assertEqual(scrubber.scrub(text[:-1]), output_file.read())
+
+        self.assertEqual(2, stats.counters["files_decoded_as_cp1252"])
+        self.assertEqual(2, stats.counters["lines_skipped"])
+        self.assertEqual(2, stats.files[input_path]["decode_errors"])
+
+
+class StatsTest(TestCase):
+
+    def test_scrub_stats(self):
+        text = "First  sentence. Second\nline!\n\n\nNext paragraph \"quoted.\"" * 10
+        updates = []
+        stats = shared.RunStats(hooks=[lambda kind, name, values: updates.append((kind, name))])
+
+        self.assertEqual(scrubber.scrub(text), scrubber.scrub(text, stats=stats))
+        self.assertEqual(["reorder_stop_chars", "remove_columns", "split_as_one_sentence_per_line",
+                          "remove_excessive_whitespace"], [name for kind, name in updates])
+        self.assertEqual(len(text), stats.stages["reorder_stop_chars"]["chars_in"])
+        self.assertEqual(len(scrubber.scrub(text)), stats.stages["remove_excessive_whitespace"]["chars_out"])
+
+        stats = shared.RunStats()
+        scrubber.scrub(text, engine=scrubber.ENGINE_FUSED, stats=stats)
+        self.assertEqual(["scrub_fused"], list(stats.stages))
+
+        # Stages run once per block when streaming
+        stats = shared.RunStats()
+        "".join(scrubber.scrub_stream(StringIO(text), buffer_size=7, stats=stats))
+        self.assertEqual(11, stats.stages["remove_columns"]["calls"])
+
+    def test_equalise_stats(self):
+        text_a = "One.\nTwo three.\nFour.\n\nFive six seven eight.\nNine.\n\nExtra paragraph."
+        text_b = "One.\nTwo.\nThree four.\n\nFive six.\nSeven.\nEight nine ten eleven."
+
+        counters = []
+        for engine in equaliser.ENGINES + ["reference"]:
+            stats = shared.RunStats()
+            if engine == "reference":
+                for a_para, b_para in zip(equaliser.split(text_a), equaliser.split(text_b)):
+                    equaliser.equalise_paragraphs_reference(a_para, b_para, stats=stats)
+                stats.increment("paragraphs_paired", 2)
+                stats.increment("paragraphs_skipped")
+            else:
+                equaliser.equalise(text_a, text_b, engine=engine, stats=stats)
+            counters.append(stats.counters)
+
+        self.assertEqual(1, counters[0]["paragraphs_skipped"])
+        self.assertEqual(2, counters[0]["paragraphs_paired"])
+        self.assertEqual(sum(len(sentences) for sentences in equaliser.equalise(text_a, text_b)[0]),
+                         counters[0]["pairs_emitted"])
+        # Every sentence of the paired paragraphs is either in a pair, glued onto one or dropped
+        self.assertEqual(5 + 6, 2 * counters[0]["pairs_emitted"] + counters[0]["sentences_glued"] +
+                         counters[0]["sentences_dropped"])
+        for other_counters in counters[1:]:
+            self.assertEqual(counters[0], other_counters)
+
+    def test_file_stats(self):
+        directory = mkdtemp()
+        self.addCleanup(rmtree, directory)
+
+        paths = []
+        for index in range(3):
+            paths.append(join(directory, "{}.txt".format(index)))
+            with open(paths[-1], "w") as input_file:
+                input_file.write("Some text. More of it.\n\nAnother paragraph." * (index + 1))
+
+        stats = shared.RunStats()
+        scrubber.scrub_files(paths, join(directory, "out"), jobs=2, stats=stats)
+
+        self.assertEqual(3, stats.counters["files_scrubbed"])
+        self.assertEqual(sorted(paths), sorted(stats.files))
+        self.assertEqual(os.path.getsize(paths[2]), stats.files[paths[2]]["bytes_read"])
+        self.assertEqual(3, stats.stages["reorder_stop_chars"]["calls"])
+
+        stats_path = join(directory, "stats.json")
+        stats.write_json(stats_path)
+        merged_stats = shared.RunStats()
+        with open(stats_path) as stats_file:
+            merged_stats.merge(json.load(stats_file))
+        self.assertEqual(stats.as_dict(), merged_stats.as_dict())
+
+
+class CacheTest(TestCase):
+
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.addCleanup(rmtree, self.directory)
+        self.cache = cache.ScrubCache(join(self.directory, "cache"))
+
+    def test_chunk_blocks(self):
+        blocks = ["Paragraph {}.\n\n".format(index) for index in range(2000)]
+        chunks = list(cache.chunk_blocks(blocks, min_size=100, max_size=1000))
+
+        self.assertEqual("".join(blocks), "".join(chunks))
+        self.assertTrue(all(len(chunk) < 1000 + len(blocks[-1]) for chunk in chunks))
+        # Cuts are made by content, so changing an early block doesn't move the later ones
+        edited_chunks = list(cache.chunk_blocks(["Edited.\n\n"] + blocks[1:], min_size=100, max_size=1000))
+        self.assertEqual(chunks[2:], edited_chunks[2:])
+
+    def test_scrub_file_cached(self):
+        text = "".join(benchmark.generate_corpus(400 * 1024, pool_size=50))
+        input_path = join(self.directory, "input.txt")
+        output_path = join(self.directory, "output.txt")
+
+        def scrub_cached(input_text):
+            with open(input_path, "w", encoding="utf-8", newline="") as input_file:
+                input_file.write(input_text)
+
+            stats = shared.RunStats()
+            scrubber.scrub_file(input_path, output_path, cache=self.cache, stats=stats)
+
+            with open(output_path, encoding="utf-8", newline="") as output_file:
+                self.assertEqual(scrubber.scrub(input_text), output_file.read())
+            return stats.counters
+
+        self.assertEqual(0, scrub_cached(text).get("cache_hits", 0))
+
+        stats = shared.RunStats()
+        scrubber.scrub_file(input_path, output_path, cache=self.cache, stats=stats)
+        self.assertEqual({"files_unchanged": 1}, stats.counters)
+
+        # Only the chunk with the edit in it and the one at the end should need scrubbing again
+        middle = len(text) // 2
+        counters = scrub_cached(text[:middle] + " Edited sentence." + text[middle:] + "Appended.")
+        self.assertTrue(counters["cache_misses"] <= 3)
+        self.assertTrue(counters["cache_hits"] >= 2)
+
+    def test_evict(self):
+        for index in range(10):
+            self.cache.put("{:02d}".format(index) * 32, "x" * 100)
+            os.utime(self.cache._object_path("{:02d}".format(index) * 32), (index, index))
+
+        self.cache.max_size = 450
+        self.assertEqual(6, self.cache.evict())
+        self.assertEqual(None, self.cache.get("05" * 32))
+        self.assertEqual("x" * 100, self.cache.get("06" * 32))
+
+    def test_put_evicts(self):
+        self.cache.max_size = 1000
+
+        for index in range(30):
+            self.cache.put("{:02d}".format(index) * 32, "x" * 100)
+            # Every put is a use, and modification times may be too coarse to tell them apart
+            os.utime(self.cache._object_path("{:02d}".format(index) * 32), (index, index))
+
+            object_paths = [join(directory, file_name) for directory, _, file_names
+                            in os.walk(join(self.directory, "cache", cache.OBJECTS_DIRECTORY)) for file_name in file_names]
+            self.assertTrue(sum(os.path.getsize(path) for path in object_paths) <= 1000)
+
+        self.assertEqual(None, self.cache.get("00" * 32))
+        self.assertEqual("x" * 100, self.cache.get("29" * 32))
+
+
+class ShardTest(TestCase):
+
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.addCleanup(rmtree, self.directory)
+
+    def read_manifest(self, path):
+        with open(shards.manifest_path(path)) as manifest_file:
+            return json.load(manifest_file)
+
+    def read_shard(self, path, shard_number):
+        with open(shards.shard_path(path, shard_number), encoding="utf-8", newline="") as shard_file:
+            return shard_file.read()
+
+    def test_scrub_file_shards(self):
+        text = "".join(benchmark.generate_corpus(100 * 1024, pool_size=50))
+        input_path = join(self.directory, "input.txt")
+        output_path = join(self.directory, "output.txt")
+        with open(input_path, "w", encoding="utf-8", newline="") as input_file:
+            input_file.write(text)
+
+        scrubber.scrub_file(input_path, output_path, shard_size=shards.ShardSize(max_sentences=200), index=True)
+
+        manifest = self.read_manifest(output_path)
+        shard_texts = [self.read_shard(output_path, number) for number in range(len(manifest["shards"]))]
+        self.assertTrue(len(shard_texts) > 1)
+        self.assertEqual(scrubber.scrub(text).strip("\n"), "\n\n".join(shard_texts))
+
+        for shard, shard_text in zip(manifest["shards"], shard_texts):
+            shard_path = join(self.directory, shard["path"])
+            self.assertEqual(shard_text.count("\n\n") + 1, shard["paragraphs"])
+            self.assertEqual(shards.file_checksum(shard_path), shard["sha256"])
+            with index.SentenceIndex(shard_path) as sentences:
+                self.assertEqual(shard["sentences"], len(sentences))
+        self.assertTrue(all(shard["sentences"] >= 200 for shard in manifest["shards"][:-1]))
+        self.assertFalse(os.path.exists(output_path))
+
+        # Fewer shards the second time, so the ones left over go
+        scrubber.scrub_file(input_path, output_path, shard_size=shards.ShardSize(max_bytes=10 ** 9))
+        self.assertEqual(1, len(self.read_manifest(output_path)["shards"]))
+        self.assertFalse(os.path.exists(shards.shard_path(output_path, 1)))
+
+    def test_clean_pair_shards(self):
+        path_a, path_b = join(self.directory, "a.txt"), join(self.directory, "b.txt")
+        benchmark.write_parallel_corpus(path_a, path_b, 100 * 1024)
+        output_a, output_b = join(self.directory, "a.txt.gz"), join(self.directory, "b.txt.gz")
+
+        pipeline.main([path_a, path_b, "--output-a", output_a, "--output-b", output_b, "--shard-size", "1",
+                       "--shard-sentences", "100"])
+
+        manifest_a, manifest_b = self.read_manifest(output_a), self.read_manifest(output_b)
+        self.assertEqual(["b.txt.gz.manifest.json"], manifest_a["aligned_with"])
+        self.assertEqual(len(manifest_a["shards"]), len(manifest_b["shards"]))
+
+        for shard_a, shard_b in zip(manifest_a["shards"], manifest_b["shards"]):
+            self.assertEqual([shard_a["paragraphs"], shard_a["sentences"]],
+                             [shard_b["paragraphs"], shard_b["sentences"]])
+            with gzip.open(join(self.directory, shard_a["path"]), "rt", encoding="utf-8") as shard_file:
+                # Paragraphs are separated by a blank line
+                line_count = len(shard_file.read().split("\n"))
+                self.assertEqual(shard_a["sentences"], line_count - (shard_a["paragraphs"] - 1))
+
+    def test_writer_error(self):
+        output_path = join(self.directory, "output.txt")
+
+        with self.assertRaises(UnicodeEncodeError):
+            with shards.ShardWriter([output_path], shards.ShardSize(max_sentences=2), "ascii",
+                                    batch_paragraphs=1) as shard_writer:
+                for number in range(100):
+                    shard_writer.write_paragraphs([["Café {}.".format(number), "Second."]])
+
+        self.assertEqual([], os.listdir(self.directory))
+
+    def test_commit_error_at_close(self):
+        output_path = join(self.directory, "output.txt")
+        # The last shard is only committed at close, and can't replace a directory
+        os.makedirs(shards.shard_path(output_path, 0))
+        errors = []
+
+        def write_and_close():
+            shard_writer = shards.ShardWriter([output_path], shards.ShardSize(max_sentences=1000))
+            shard_writer.write_paragraphs([["First.", "Second."]])
+            try:
+                shard_writer.close()
+            except OSError as error:
+                errors.append(error)
+
+        writer_thread = Thread(target=write_and_close)
+        writer_thread.daemon = True
+        writer_thread.start()
+        writer_thread.join(10)
+
+        self.assertFalse(writer_thread.is_alive())
+        self.assertEqual(1, len(errors))
+        self.assertFalse(os.path.exists(shards.manifest_path(output_path)))
+        # The shard that couldn't be committed doesn't leave its temporary file behind
+        self.assertEqual([shards.shard_path("output.txt", 0)], os.listdir(self.directory))
+
+
+class WorkQueueTest(TestCase):
+
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.addCleanup(rmtree, self.directory)
+        self.queue_dir = join(self.directory, "queue")
+
+    def create_queue(self):
+        return workqueue.WorkQueue(self.queue_dir, heartbeat_interval=0.05, heartbeat_timeout=1)
+
+    def test_heartbeat_outlasts_missing_lock(self):
+        lock_path = join(self.directory, "item.lock")
+
+        with workqueue._Heartbeat(lock_path, "worker", 0.05):
+            # As when another worker renames the lock away to check it, then gives it back
+            time.sleep(0.2)
+            with open(lock_path, "w") as lock_file:
+                lock_file.write("worker")
+            os.utime(lock_path, (0, 0))
+            time.sleep(0.2)
+
+            self.assertTrue(os.path.getmtime(lock_path) > 0)
+
+            # Taken over for real
+            with open(lock_path, "w") as lock_file:
+                lock_file.write("other")
+            os.utime(lock_path, (0, 0))
+            time.sleep(0.2)
+
+            self.assertEqual(0, os.path.getmtime(lock_path))
+
+    def test_workers_share_files(self):
+        input_dir = join(self.directory, "input")
+        output_dir = join(self.directory, "output")
+        os.makedirs(input_dir)
+        for number in range(12):
+            with open(join(input_dir, "{}.txt".format(number)), "w") as input_file:
+                input_file.write("File  {}. Split\nacross lines!".format(number))
+
+        workers = [Process(target=scrubber.scrub_files, args=([input_dir], output_dir),
+                           kwargs={"jobs": 1, "queue": self.create_queue()}) for _ in range(3)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        for number in range(12):
+            with open(join(output_dir, "{}.txt".format(number))) as output_file:
+                self.assertEqual("File {}.\nSplit across lines!".format(number), output_file.read())
+
+        self.assertEqual([], os.listdir(join(self.queue_dir, workqueue.CLAIMS_DIRECTORY)))
+        self.assertEqual(12, len(os.listdir(join(self.queue_dir, workqueue.DONE_DIRECTORY))))
+
+    def test_stale_claim_taken_over(self):
+        items = [{"name": name} for name in ["a", "b", "c"]]
+        work_queue = self.create_queue().open(items)
+
+        # One worker stopped sending heartbeats a while ago, the other is still going
+        for item_id, age in [("000000", 100), ("000001", 0)]:
+            lock_path = join(self.queue_dir, workqueue.CLAIMS_DIRECTORY, item_id + workqueue.LOCK_SUFFIX)
+            with open(lock_path, "w") as lock_file:
+                lock_file.write("other-worker")
+            os.utime(lock_path, (os.path.getmtime(lock_path) - age,) * 2)
+
+        claimed = sorted(item["name"] for item in iter(work_queue.claim, None))
+        self.assertEqual(["a", "c"], claimed)
+        self.assertEqual({"done": 0, "failed": 0, "claimed": 3, "waiting": 0}, work_queue.status())
+
+    def test_resume(self):
+        items = [{"name": name} for name in ["a", "b", "c"]]
+        work_queue = self.create_queue().open(items)
+        work_queue.complete(work_queue.items[1])
+
+        def process(item):
+            return ("Broken" if item["name"] == "c" else None), item["name"]
+
+        self.assertEqual(["a", "c"], sorted(work_queue.run(process, poll_interval=0)))
+        self.assertEqual([], work_queue.run(process, poll_interval=0))
+        self.assertEqual([("c", "Broken")], [(item["name"], error) for item, error in work_queue.failures()])
+        self.assertEqual({"done": 2, "failed": 1, "claimed": 0, "waiting": 0}, work_queue.status())
+
+        with self.assertRaises(ValueError):
+            self.create_queue().open(items, settings="different")
+
+    def test_equalise_directories(self):
+        for language, text in [("en", "One two three.\nFour five six."), ("fr", "Un deux trois.\nQuatre cinq six.")]:
+            os.makedirs(join(self.directory, language, "nested"))
+            for name in ["first.txt", join("nested", "second.txt")]:
+                with open(join(self.directory, language, name), "w") as text_file:
+                    text_file.write(text)
+        with open(join(self.directory, "en", "unpaired.txt"), "w") as text_file:
+            text_file.write("Left alone.")
+
+        directories = [join(self.directory, "en"), join(self.directory, "fr")]
+        groups = equaliser.find_parallel_files(directories)
+        self.assertEqual([[join(directory, "first.txt") for directory in directories],
+                          [join(directory, "nested", "second.txt") for directory in directories]], groups)
+
+        self.assertEqual([], equaliser.equalise_groups(groups, queue=self.create_queue()))
+        # Equalised groups aren't equalised again when the run is started again
+        with open(groups[0][0], "w") as text_file:
+            text_file.write("Changed. Since.")
+        self.assertEqual([], equaliser.equalise_groups(groups, queue=self.create_queue()))
+
+        with open(groups[0][0]) as text_file:
+            self.assertEqual("Changed. Since.", text_file.read())
+        with open(groups[1][0]) as text_file:
+            self.assertEqual("One two three.\nFour five six.", text_file.read())
+
+
+class PipelineTest(TestCase):
+
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.addCleanup(rmtree, self.directory)
+
+    def write_pair(self, text_a, text_b):
+        paths = [join(self.directory, "a.txt"), join(self.directory, "b.txt")]
+        for path, text in zip(paths, [text_a, text_b]):
+            with open(path, "w", encoding="utf-8", newline="") as test_file:
+                test_file.write(text)
+        return paths
+
+    def read(self, path):
+        with open(path, encoding="utf-8", newline="") as test_file:
+            return test_file.read()
+
+    def test_clean_pair_matches_separate_runs(self):
+        generator = random.Random(0)
+
+        for _ in range(10):
+            texts = ["".join(benchmark.generate_corpus(generator.randint(0, 3000), seed=generator.random(),
+                                                       pool_size=10)) for _ in range(2)]
+            # Line-breaks the scrubber leaves alone, but the equaliser translates
+            line_break = generator.choice(["\n", "\r\n", "\r"])
+            texts = [text.replace("\n", line_break) for text in texts]
+
+            paths = self.write_pair(*texts)
+            for path in paths:
+                scrubber.scrub_file(path)
+            equaliser.equalise_file(*paths)
+            expected = [self.read(path) for path in paths]
+
+            paths = self.write_pair(*texts)
+            outputs = [join(self.directory, "a.out.txt"), join(self.directory, "b.out.txt")]
+            pipeline.clean_pair(paths[0], paths[1], outputs[0], outputs[1],
+                                scrub_engine=generator.choice(scrubber.ENGINES))
+            self.assertEqual(expected, [self.read(path) for path in outputs])
+            self.assertEqual(texts, [self.read(path) for path in paths])
+
+    def test_outputs_replaced_together(self):
+        paths = self.write_pair("One. Two.", "Un. Deux.")
+        output_a = join(self.directory, "a.out.txt")
+        with open(output_a, "w") as output_file:
+            output_file.write("Old A.")
+        # B can't be replaced, as it's a directory
+        output_b = join(self.directory, "b.out.txt")
+        os.makedirs(output_b)
+
+        with self.assertRaises(OSError):
+            pipeline.clean_pair(paths[0], paths[1], output_a, output_b)
+
+        self.assertEqual("Old A.", self.read(output_a))
+        self.assertEqual(["a.out.txt", "a.txt", "b.out.txt", "b.txt"], sorted(os.listdir(self.directory)))
+
+        os.remove(output_a)
+        with self.assertRaises(OSError):
+            pipeline.clean_pair(paths[0], paths[1], output_a, output_b)
+
+        self.assertEqual(["a.txt", "b.out.txt", "b.txt"], sorted(os.listdir(self.directory)))
+
+    def test_jobs_option(self):
+        self.assertEqual(2, pipeline.create_arg_parser().parse_args(["a.txt", "b.txt", "--jobs", "2"]).jobs)
+
+    def test_main(self):
+        texts = ["One sentence. Another one\nhere.\n\nNew paragraph. Second.", "One. Another.\n\nNew. Two."]
+        expected = [equaliser.merge(paragraphs)
+                    for paragraphs in equaliser.equalise(*[scrubber.scrub(text) for text in texts])]
+
+        paths = self.write_pair(*texts)
+        stats_path = join(self.directory, "stats.json")
+        pipeline.main(paths + ["--stats", stats_path])
+
+        self.assertEqual(expected, [self.read(path) for path in paths])
+        with open(stats_path) as stats_file:
+            self.assertEqual(2, json.load(stats_file)["counters"]["paragraphs_paired"])
+
+
+class IndexTest(TestCase):
+
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.addCleanup(rmtree, self.directory)
+
+    def write(self, name, text):
+        path = join(self.directory, name)
+        with open(path, "w", encoding="utf-8", newline="") as test_file:
+            test_file.write(text)
+        return path
+
+    def assertIndexMatches(self, path, paragraphs):
+        with index.SentenceIndex(path) as sentence_index:
+            self.assertEqual([sentence for paragraph in paragraphs for sentence in paragraph], list(sentence_index))
+            self.assertEqual(paragraphs, [sentence_index.paragraph(paragraph_index)
+                                          for paragraph_index in range(sentence_index.paragraph_count)])
+
+    def test_index_builder(self):
+        generator = random.Random(10)
+        fragments = ["Word", "w\u00f6rd.", "\n", "\n\n", "\n\n\n", " "]
+
+        for _ in range(300):
+            text = "".join(generator.choice(fragments) for _ in range(generator.randint(0, 30)))
+            data = text.encode("utf-8")
+            path = self.write("text.txt", text)
+
+            builder = index.IndexBuilder()
+            position = 0
+            while position < len(data):
+                block_size = generator.randint(1, 5)
+                builder.feed(data[position:position + block_size])
+                position += block_size
+            builder.finish()
+            builder.write(index.index_path(path))
+
+            self.assertIndexMatches(path, equaliser.split(text) if len(text) != 0 else [])
+
+            with index.SentenceIndex(path) as sentence_index:
+                self.assertEqual(text.count("\n") + 1 if len(text) != 0 else 0, sentence_index.line_count)
+                for sentence_index_number in range(len(sentence_index)):
+                    paragraph_start, paragraph_end = sentence_index.paragraph_range(
+                        sentence_index.paragraph_of(sentence_index_number))
+                    self.assertTrue(paragraph_start <= sentence_index_number < paragraph_end)
+
+                shard_count = generator.randint(1, 4)
+                self.assertEqual(list(sentence_index), [sentence for shard_index in range(shard_count)
+                                                        for sentence in sentence_index.iter_shard(shard_index,
+                                                                                                  shard_count)])
+
+    def test_scrub_file_index(self):
+        text = "".join(benchmark.generate_corpus(20000, seed=3, pool_size=10))
+        input_path = self.write("input.txt", text)
+        output_path = join(self.directory, "output.txt")
+
+        for scrub_function, options in [(scrubber.scrub_file, {}), (scrubber.scrub_file, {"stream": True}),
+                                        (scrubber.scrub_file_chunked, {"jobs": 2, "chunk_size": 1000})]:
+            scrub_function(input_path, output_path, index=True, **options)
+
+            with open(output_path, encoding="utf-8", newline="") as output_file:
+                self.assertIndexMatches(output_path, equaliser.split(output_file.read()))
+
+        with open(output_path, "a") as output_file:
+            output_file.write("Changed since.")
+        self.assertRaises(ValueError, index.SentenceIndex, output_path)
+        self.assertRaises(ValueError, scrubber.scrub_file, input_path, output_path + ".gz", index=True)
+
+    def test_equalise_file_index(self):
+        # Empty sentences on one side only leave out the whole paragraph on that side
+        texts = ["One two three.\nFour.\n\n\n\nFive six.\n\nSeven eight.", "One.\nTwo.\n\nx\n\nFive.\n\n"]
+
+        for options in [{}, {"stream": True}]:
+            paths = [self.write("a.txt", texts[0]), self.write("b.txt", texts[1])]
+            equaliser.equalise_file(paths[0], paths[1], index=True, **options)
+
+            equalised = equaliser.equalise(*texts)
+            for path, paragraphs in zip(paths, equalised):
+                # Paragraphs left with no sentences at all have nothing to index
+                self.assertIndexMatches(path, [paragraph for paragraph in paragraphs if len(paragraph) != 0])
+
+            with index.SentenceIndex(paths[0]) as a_index, index.SentenceIndex(paths[1]) as b_index:
+                index.check_aligned(a_index, b_index)
+                self.assertEqual(["", "x"], [a_index[1], b_index[1]])
+
+
+class ServiceTest(TestCase):
+
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.addCleanup(rmtree, self.directory)
+
+        self.socket_path = join(self.directory, "service.sock")
+        self.service = service.CorpusService(self.socket_path, workers=1)
+        self.thread = Thread(target=self.service.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        if self.thread.is_alive():
+            client.request({"command": client.COMMAND_SHUTDOWN}, self.socket_path)
+        self.thread.join()
+        self.service.server_close()
+
+    def test_jobs_option(self):
+        self.assertEqual(2, service.create_arg_parser().parse_args(["--jobs", "2"]).jobs)
+
+    def test_socket_private(self):
+        self.assertEqual(0o600, os.stat(self.socket_path).st_mode & 0o777)
+
+        # The umask is only changed while binding
+        old_umask = os.umask(0o022)
+        try:
+            service.CorpusService(join(self.directory, "other.sock"), workers=1).server_close()
+            self.assertEqual(0o022, os.umask(0o022))
+        finally:
+            os.umask(old_umask)
+
+    def test_inline_jobs(self):
+        text = "One sentence. Another one\nhere.\n\nNew paragraph! Second."
+        self.assertEqual(scrubber.scrub(text), client.scrub_text(text, socket_path=self.socket_path))
+        self.assertEqual(scrubber.scrub(text, stop_chars=["!"]),
+                         client.scrub_text(text, ["-s", "!"], socket_path=self.socket_path))
+
+        texts = [scrubber.scrub(text), "One.\nTwo.\n\nThree."]
+        self.assertEqual([equaliser.merge(paragraphs) for paragraphs in equaliser.equalise(*texts, lowercase_glued=False)],
+                         client.equalise_texts(texts[0], texts[1], ["-k"], socket_path=self.socket_path))
+
+    def test_path_jobs(self):
+        input_path = join(self.directory, "input.txt")
+        with open(input_path, "w") as input_file:
+            input_file.write("Some text. Over\ntwo lines.")
+
+        response = client.request({"command": client.COMMAND_SCRUB, "arguments": ["input.txt", "-o", "output.txt"],
+                                   "cwd": self.directory}, self.socket_path)
+        self.assertEqual(0, response["exit_code"])
+        self.assertIn("Scrubbed input.txt to output.txt", response["output"])
+        with open(join(self.directory, "output.txt")) as output_file:
+            self.assertEqual("Some text.\nOver two lines.", output_file.read())
+
+        response = client.request({"command": client.COMMAND_EQUALISE, "arguments": ["--bogus"]}, self.socket_path)
+        self.assertEqual(2, response["exit_code"])
+        self.assertIn("usage", response["output"])
+
+        self.assertEqual(0, client.request({"command": client.COMMAND_PING}, self.socket_path)["exit_code"])
+        client.request({"command": client.COMMAND_SHUTDOWN}, self.socket_path)
+        self.thread.join()
+
+
+class DedupTest(TestCase):
+
+    def test_bloom_filter(self):
+        bloom_filter = dedup.BloomFilter(1000, 0.001)
+        keys = [str(number).encode("ascii") for number in range(1000)]
+
+        self.assertFalse(any(bloom_filter.add(key) for key in keys))
+        self.assertTrue(all(bloom_filter.add(key) for key in keys))
+        self.assertLess(sum(str(-number).encode("ascii") in bloom_filter for number in range(1, 10001)), 30)
+
+    @skipIf(dedup.numpy is None, "NumPy isn't installed")
+    def test_minhash_numpy_matches_python(self):
+        permutations = dedup.minhash_permutations(64)
+        for text in ["", "a", "Some sentence or other.", "Some sentence or another one!"]:
+            hashes = dedup.shingle_hashes(text)
+            self.assertEqual(dedup.minhash_signature(hashes, permutations),
+                             dedup.minhash_signature_numpy(hashes, permutations))
+
+    def test_deduplicate_text(self):
+        text = "Home\nAbout us\nThe quick brown fox jumps over the lazy dog.\n\nHome\nAbout us\n\n" \
+               "Another sentence here.\n\nThe quick brown fox jumps  over the lazy dog!\nThe last one."
+        stats = shared.RunStats()
+
+        deduplicated = "".join(dedup.deduplicate_text([text[:20], text[20:]], dedup.Deduplicator(1000), stats))
+        self.assertEqual("Home\nAbout us\nThe quick brown fox jumps over the lazy dog.\n\nAnother sentence here.\n\n"
+                         "The quick brown fox jumps  over the lazy dog!\nThe last one.", deduplicated)
+        self.assertEqual(2, stats.counters["exact_duplicates_removed"])
+
+        deduplicated = "".join(dedup.deduplicate_text([text], dedup.Deduplicator(1000, near_duplicates=True)))
+        self.assertEqual("Home\nAbout us\nThe quick brown fox jumps over the lazy dog.\n\nAnother sentence here.\n\n"
+                         "The last one.", deduplicated)
+
+        # Nothing to remove leaves the text as it was
+        unique_text = "One.\n\n\nTwo.\nThree.\n"
+        self.assertEqual(unique_text, "".join(dedup.deduplicate_text([unique_text], dedup.Deduplicator(1000))))
+
+    def test_deduplicate_file_pair(self):
+        directory = mkdtemp()
+        self.addCleanup(rmtree, directory)
+
+        paths = [join(directory, "a.txt"), join(directory, "b.txt")]
+        texts = ["Home\nHello.\n\nHome\nBye.", "Accueil\nBonjour.\n\nMaison\nSalut."]
+        for path, text in zip(paths, texts):
+            with open(path, "w") as test_file:
+                test_file.write(text)
+
+        stats = shared.RunStats()
+        dedup.deduplicate_file_pair(paths[0], paths[1], dedup.Deduplicator(1000), stats=stats)
+
+        # Only the pair as a whole counts, so "Home" is kept the second time with a different translation
+        expected = ["Home\nHello.\n\nHome\nBye.", "Accueil\nBonjour.\n\nMaison\nSalut."]
+        for path, expected_text in zip(paths, expected):
+            with open(path) as test_file:
+                self.assertEqual(expected_text, test_file.read())
+
+        pairs = [(["Home", "Hello."], ["Accueil", "Bonjour."]), (["Home", "Bye."], ["Accueil", "Salut."])]
+        self.assertEqual([(["Home", "Hello."], ["Accueil", "Bonjour."]), (["Bye."], ["Salut."])],
+                         list(dedup.deduplicate_paragraph_pairs(pairs, dedup.Deduplicator(1000))))
+
+    def test_scrub_file_dedup(self):
+        directory = mkdtemp()
+        self.addCleanup(rmtree, directory)
+
+        paths = [join(directory, "a.txt"), join(directory, "b.txt")]
+        for path in paths:
+            with open(path, "w") as test_file:
+                test_file.write("Menu. Contact us.\n\nSome text which is only in file {}.".format(paths.index(path)))
+
+        deduplicator = dedup.Deduplicator(1000)
+        stats = shared.RunStats()
+        scrubber.scrub_files(paths, jobs=2, stats=stats, dedup=deduplicator)
+
+        with open(paths[1]) as test_file:
+            self.assertEqual("Some text which is only in file 1.", test_file.read())
+        self.assertEqual(2, stats.counters["exact_duplicates_removed"])
+
 
 class EqualiserTest(TestCase):
 
@@ -156,6 +1151,230 @@ class EqualiserTest(TestCase):
         # The whole point is to have equal sentence counts
         self.assertEqual(len(a_result), len(b_result))
 
+    def test_glue_run(self):
+        self.assertEqual(
+            "I like apples i am lowercase and so am I.",
+            equaliser.glue_run(["I like apples.", "I am lowercase.", "And so am I."])
+        )
+
+    def test_equalise_paragraphs_matches_reference(self):
+        generator = random.Random(6)
+        words = ["I", "word", "Word.", "x!", ".", "", "two words"]
+
+        def random_paragraph():
+            return [" ".join(generator.choice(words) for _ in range(generator.randint(0, 6)))
+                    for _ in range(generator.randint(0, 8))]
+
+        for _ in range(2000):
+            a_para, b_para = random_paragraph(), random_paragraph()
+            options = dict(sentence_ratio=generator.choice([0.3, 0.6, 1.0]),
+                           lowercase_glued=generator.choice([True, False]),
+                           stop_chars=generator.choice([equaliser.DEFAULT_STOP_CHARS, ["..", "."], [" ."]]))
+
+            self.assertEqual(
+                equaliser.equalise_paragraphs_reference(a_para, b_para, **options),
+                equaliser.equalise_paragraphs(a_para, b_para, **options)
+            )
+
+    @skipIf(equaliser.numpy is None, "NumPy isn't installed")
+    def test_plan_merges_numpy_matches_python(self):
+        generator = random.Random(7)
+
+        for _ in range(3000):
+            max_word_count = generator.choice([2, 10, 50])
+            a_counts = [generator.randint(1, max_word_count) for _ in range(generator.randint(0, 40))]
+            b_counts = [generator.randint(1, max_word_count) for _ in range(generator.randint(0, 40))]
+            sentence_ratio = generator.choice([0.0, 0.3, 0.6, 1.0, 1.5])
+
+            self.assertEqual(
+                equaliser.plan_merges(a_counts, b_counts, sentence_ratio=sentence_ratio),
+                equaliser.plan_merges_numpy(a_counts, b_counts, sentence_ratio=sentence_ratio)
+            )
+
+        # Long enough for the widest comparison window, with the odd sentence that forces a merge
+        a_counts = [generator.randint(8, 12) for _ in range(10000)]
+        b_counts = [generator.randint(8, 12) for _ in range(10000)]
+        for index in range(0, 10000, 997):
+            a_counts[index] = 40
+
+        self.assertEqual(equaliser.plan_merges(a_counts, b_counts), equaliser.plan_merges_numpy(a_counts, b_counts))
+
+    def test_numpy_engine_fallback(self):
+        a_para, b_para = ["Short.", "Also short.", "Tiny."], ["This one is a good deal longer than those.", "Tiny."]
+        expected = equaliser.equalise_paragraphs(a_para, b_para)
+
+        self.assertEqual(expected, equaliser.equalise_paragraphs(a_para, b_para, engine=equaliser.ENGINE_NUMPY))
+
+        numpy_module = equaliser.numpy
+        equaliser.numpy = None
+        try:
+            self.assertEqual(expected, equaliser.equalise_paragraphs(a_para, b_para, engine=equaliser.ENGINE_NUMPY))
+        finally:
+            equaliser.numpy = numpy_module
+
+    @skipIf(equaliser.numpy is None, "NumPy isn't installed")
+    def test_numpy_engine_short_paragraphs(self):
+        generator = random.Random(8)
+        words = ["word", "another", "a much longer sentence than most"]
+
+        def paragraph(length):
+            return [" ".join(generator.choice(words) for _ in range(generator.randint(1, 4))) + "."
+                    for _ in range(length)]
+
+        short_paras = [paragraph(equaliser.NUMPY_MIN_SENTENCES - 1), paragraph(equaliser.NUMPY_MIN_SENTENCES + 50)]
+        long_paras = [paragraph(equaliser.NUMPY_MIN_SENTENCES), paragraph(equaliser.NUMPY_MIN_SENTENCES + 50)]
+        long_expected = equaliser.equalise_paragraphs(*long_paras)
+
+        plan_merges_numpy = equaliser.plan_merges_numpy
+        planned = []
+        equaliser.plan_merges_numpy = lambda *args, **kwargs: planned.append(args) or plan_merges_numpy(*args, **kwargs)
+        try:
+            equaliser.equalise_paragraphs(*short_paras, engine=equaliser.ENGINE_NUMPY)
+            self.assertEqual([], planned)
+
+            self.assertEqual(long_expected, equaliser.equalise_paragraphs(*long_paras, engine=equaliser.ENGINE_NUMPY))
+            self.assertEqual(1, len(planned))
+        finally:
+            equaliser.plan_merges_numpy = plan_merges_numpy
+
+    def test_jobs_option(self):
+        self.assertEqual(2, equaliser.create_arg_parser().parse_args(["a.txt", "b.txt", "--jobs", "2"]).jobs)
+        self.assertEqual(3, equaliser.create_arg_parser().parse_args(["a.txt", "b.txt", "-j", "3"]).jobs)
+
+    def test_equalise_workers(self):
+        generator = random.Random(5)
+        fragments = ["Word", "word", ".", "\n", "\n\n", " ", " a much longer sentence"]
+        texts = ["".join(generator.choice(fragments) for _ in range(3000)) for _ in range(2)]
+
+        self.assertEqual(
+            equaliser.equalise(*texts),
+            equaliser.equalise(*texts, workers=3)
+        )
+        self.assertEqual(
+            list(equaliser.equalise_stream(texts[0].split("\n\n"), texts[1].split("\n\n"))),
+            list(equaliser.equalise_paragraph_pairs(zip(*map(equaliser.split, texts)), workers=2, batch_size=50))
+        )
+
+    def test_read_paragraphs(self):
+        text = "P1S1.\nP1S2.\n\nP2S1.\n\n\nP3S1.\n"
+
+        for buffer_size in [1, 2, 3, 100]:
+            self.assertEqual(text.split("\n\n"), list(equaliser.read_paragraphs(StringIO(text), buffer_size)))
+
+    def test_equalise_file_stream(self):
+        directory = mkdtemp()
+        self.addCleanup(rmtree, directory)
+
+        generator = random.Random(4)
+        fragments = ["Word", "word", ".", "\n", "\n\n", "\n\n\n", " ", " a much longer sentence"]
+
+        for _ in range(50):
+            texts = ["".join(generator.choice(fragments) for _ in range(generator.randint(0, 60))) for _ in range(2)]
+            expected = [equaliser.merge(paragraphs) for paragraphs in equaliser.equalise(*texts)]
+
+            paths = [join(directory, "a.txt"), join(directory, "b.txt")]
+            for path, text in zip(paths, texts):
+                with open(path, "w") as test_file:
+                    test_file.write(text)
+
+            equaliser.equalise_file(paths[0], paths[1], stream=True)
+
+            for path, expected_text in zip(paths, expected):
+                with open(path) as test_file:
+                    self.assertEqual(expected_text, test_file.read())
+
+    def test_equalise_paragraphs_n(self):
+        generator = random.Random(8)
+        words = ["I", "word", "Word.", "x!", ".", "", "two words"]
+
+        def random_paragraph():
+            return [" ".join(generator.choice(words) for _ in range(generator.randint(0, 6)))
+                    for _ in range(generator.randint(0, 8))]
+
+        for _ in range(500):
+            options = dict(sentence_ratio=generator.choice([0.3, 0.6, 1.0]),
+                           stop_chars=generator.choice([equaliser.DEFAULT_STOP_CHARS, [" ."]]))
+
+            pair = (random_paragraph(), random_paragraph())
+            self.assertEqual(equaliser.equalise_paragraphs(*pair, **options),
+                             equaliser.equalise_paragraphs_n(pair, **options))
+
+            group = tuple(random_paragraph() for _ in range(generator.randint(3, 5)))
+            equalised_group = equaliser.equalise_paragraphs_n(group, **options)
+            self.assertEqual(len(group), len(equalised_group))
+            self.assertEqual(1, len(set(map(len, equalised_group))))
+
+        # The short sides are both glued up to the long one
+        self.assertEqual(
+            (["One two three four five six.", "Seven."],
+             ["One two three four five six.", "Seven."],
+             ["One two three four five six.", "Seven."]),
+            equaliser.equalise_paragraphs_n((["One two three four five six.", "Seven."],
+                                             ["One two three.", "Four five six.", "Seven."],
+                                             ["One two.", "Three.", "Four five six.", "Seven."]),
+                                            lowercase_glued=True)
+        )
+
+    def test_equalise_files(self):
+        directory = mkdtemp()
+        self.addCleanup(rmtree, directory)
+
+        generator = random.Random(9)
+        fragments = ["Word", "word", ".", "\n", "\n\n", " ", " a much longer sentence"]
+        texts = ["".join(generator.choice(fragments) for _ in range(400)) for _ in range(3)]
+        paths = [join(directory, "{}.txt".format(index)) for index in range(3)]
+
+        for path, text in zip(paths, texts):
+            with open(path, "w") as test_file:
+                test_file.write(text)
+
+        stats = shared.RunStats()
+        equaliser.equalise_files(paths, stats=stats)
+
+        equalised_paragraphs = equaliser.equalise_n(texts)
+        for path, paragraphs in zip(paths, equalised_paragraphs):
+            with open(path) as test_file:
+                self.assertEqual(equaliser.merge(paragraphs), test_file.read())
+
+        for paragraph_group in zip(*equalised_paragraphs):
+            self.assertEqual(1, len(set(map(len, paragraph_group))))
+        self.assertEqual(sum(map(len, equalised_paragraphs[0])), stats.counters["pairs_emitted"])
+
+
+class BenchmarkTest(TestCase):
+
+    def test_generate_corpus(self):
+        corpus = "".join(benchmark.generate_corpus(10000, seed=1, pool_size=20))
+        self.assertEqual(corpus, "".join(benchmark.generate_corpus(10000, seed=1, pool_size=20)))
+        self.assertNotEqual(corpus, "".join(benchmark.generate_corpus(10000, seed=2, pool_size=20)))
+        self.assertTrue(10000 <= len(corpus) < 12000)
+        self.assertNotEqual(corpus, scrubber.scrub(corpus))
+
+    def test_generate_parallel_corpus(self):
+        pieces = list(benchmark.generate_parallel_corpus(10000, seed=1, pool_size=20))
+        text_a = "".join(a_piece for a_piece, b_piece in pieces)
+        text_b = "".join(b_piece for a_piece, b_piece in pieces)
+
+        self.assertEqual(len(equaliser.split(text_a)), len(equaliser.split(text_b)))
+        self.assertEqual(text_a, equaliser.merge(equaliser.split(text_a)))
+
+    def test_join_paragraph_pairs(self):
+        pairs = [(["A."] * 3, ["B."] * 2), (["A."], ["B."] * 4), (["A."] * 5, ["B."]), (["A."], [])]
+        joined_pairs = list(benchmark.join_paragraph_pairs(pairs, 4))
+
+        self.assertEqual([(4, 6), (6, 1)], [(len(a_para), len(b_para)) for a_para, b_para in joined_pairs])
+
+    def test_plan_word_counts(self):
+        for shape in benchmark.PLAN_SHAPES:
+            a_counts, b_counts = benchmark.plan_word_counts(shape, 100)
+            self.assertTrue(min(len(a_counts), len(b_counts)) >= 100)
+
+        results = benchmark.benchmark_plan_merges([4, 8], repeat=1)
+        self.assertEqual([(shape, length) for shape in benchmark.PLAN_SHAPES for length in [4, 8]],
+                         [(shape, length) for shape, length, _, _ in results])
+        self.assertEqual(equaliser.numpy is None, all(numpy_seconds is None for _, _, _, numpy_seconds in results))
+
 
 if __name__ == "__main__":
     main()
+
@@ -0,0 +1,337 @@
+import errno
+import io
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from os.path import exists, getmtime, isdir, join
+
+from corpus_cleaner import __version__
+from corpus_cleaner.shared import AtomicWriter, ensure_arg
+
+# Claims are kept alive this often, and ones left alone for the timeout are handed to another worker
+DEFAULT_HEARTBEAT_INTERVAL = 10.0
+DEFAULT_HEARTBEAT_TIMEOUT = 60.0
+
+MANIFEST_NAME = "queue.json"
+CLAIMS_DIRECTORY = "claims"
+DONE_DIRECTORY = "done"
+FAILED_DIRECTORY = "failed"
+WORKERS_DIRECTORY = "workers"
+LOCK_SUFFIX = ".lock"
+ITEM_ID_FORMAT = "{:06d}"
+
+
+def _try_remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _read_text(path):
+    try:
+        with io.open(path, encoding="utf-8") as text_file:
+            return text_file.read()
+    except (IOError, OSError):
+        return None
+
+
+class _Heartbeat(object):
+    """
+    Touches a claim's lock file every interval from a background thread, for as long as it's still ours.
+    """
+
+    def __init__(self, lock_path, worker_id, interval):
+        self.lock_path = lock_path
+        self.worker_id = worker_id
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="Heartbeat")
+        self._thread.daemon = True
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            owner = _read_text(self.lock_path)
+
+            # Another worker took the claim over, so stop keeping its lock alive for it
+            if owner is not None and owner != self.worker_id:
+                return
+
+            try:
+                os.utime(self.lock_path, None)
+            except OSError:
+                # Gone for a moment while another worker checks whether it's stale, so try again next time
+                continue
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stopped.set()
+        self._thread.join()
+
+
+class WorkQueue(object):
+    """
+    A queue of work items kept in a directory that any number of workers can share, on one machine or across
+    several mounting the same filesystem, with no queue service. The first worker to start writes the items to
+    a manifest and the rest join it. Workers claim an item by creating its lock file with O_EXCL, and keep the
+    claim alive by touching the lock while they work on it. A claim whose lock hasn't been touched for
+    heartbeat_timeout is taken over by renaming the lock away, which only one worker can do. Finished items
+    get a completion marker, so a run that crashed picks up where it left off when started again. Items that
+    fail get a marker in failed/ instead, and aren't retried until it's removed.
+    """
+
+    def __init__(self, directory, heartbeat_interval=DEFAULT_HEARTBEAT_INTERVAL,
+                 heartbeat_timeout=DEFAULT_HEARTBEAT_TIMEOUT):
+        self.directory = directory
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.items = None
+        # Made up in each process, so copies sent to worker processes are workers of their own
+        self._worker_id = None
+
+    @property
+    def worker_id(self):
+        if self._worker_id is None or not self._worker_id.endswith("-{}".format(os.getpid())):
+            self._worker_id = "{}-{}-{}".format(socket.gethostname(), uuid.uuid4().hex[:8], os.getpid())
+
+        return self._worker_id
+
+    def _path(self, *names):
+        return join(self.directory, *names)
+
+    def _lock_path(self, item_id):
+        return self._path(CLAIMS_DIRECTORY, item_id + LOCK_SUFFIX)
+
+    def open(self, items, settings=""):
+        """
+        Starts a run of items, a list of dicts, or joins the one already in the directory. Raises a ValueError
+        if that run has different items or settings, e.g. from other options.
+        """
+        for directory in [CLAIMS_DIRECTORY, DONE_DIRECTORY, FAILED_DIRECTORY, WORKERS_DIRECTORY]:
+            os.makedirs(self._path(directory), exist_ok=True)
+
+        manifest = {"version": __version__, "settings": settings,
+                    "items": [dict(item, id=ITEM_ID_FORMAT.format(number)) for number, item in enumerate(items)]}
+        manifest_path = self._path(MANIFEST_NAME)
+
+        if not exists(manifest_path):
+            with AtomicWriter(manifest_path + ".{}".format(self.worker_id)) as manifest_file:
+                manifest_file.write(json.dumps(manifest, indent=2, sort_keys=True))
+
+            try:
+                # Linking fails if another worker got there first, unlike a rename, which would replace theirs
+                os.link(manifest_path + ".{}".format(self.worker_id), manifest_path)
+            except OSError as error:
+                if error.errno != errno.EEXIST:
+                    raise
+            finally:
+                _try_remove(manifest_path + ".{}".format(self.worker_id))
+
+        with io.open(manifest_path, encoding="utf-8") as manifest_file:
+            existing_manifest = json.load(manifest_file)
+
+        if existing_manifest["items"] != manifest["items"] or existing_manifest["settings"] != manifest["settings"]:
+            raise ValueError("{} already holds a different run. Use another directory, or remove it to "
+                                     "start again.".format(self.directory))
+
+        self.items = existing_manifest["items"]
+        return self
+
+    def is_done(self, item_id):
+        return exists(self._path(DONE_DIRECTORY, item_id)) or exists(self._path(FAILED_DIRECTORY, item_id))
+
+    def _filesystem_time(self):
+        # Lock times are set by the filesystem's clock, which may not agree with this machine's
+        worker_path = self._path(WORKERS_DIRECTORY, self.worker_id)
+        with io.open(worker_path, "a"):
+            pass
+        os.utime(worker_path, None)
+
+        return getmtime(worker_path)
+
+    def _try_lock(self, item_id):
+        try:
+            lock_descriptor = os.open(self._lock_path(item_id), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError as error:
+            if error.errno == errno.EEXIST:
+                return False
+            raise
+
+        with io.open(lock_descriptor, "w", encoding="utf-8") as lock_file:
+            lock_file.write(self.worker_id)
+
+        return True
+
+    def _take_over(self, item_id, now):
+        lock_path = self._lock_path(item_id)
+        try:
+            if now - getmtime(lock_path) < self.heartbeat_timeout:
+                return False
+        except OSError:
+            # Released since we looked
+            return self._try_lock(item_id)
+
+        stale_path = "{}.stale-{}".format(lock_path, self.worker_id)
+        try:
+            os.rename(lock_path, stale_path)
+        except OSError:
+            # Another worker took it over first
+            return False
+
+        # The owner may have sent a heartbeat between checking and renaming, in which case it gets its lock back
+        if now - getmtime(stale_path) < self.heartbeat_timeout:
+            try:
+                os.link(stale_path, lock_path)
+            except OSError:
+                pass
+            _try_remove(stale_path)
+            return False
+
+        _try_remove(stale_path)
+        return self._try_lock(item_id)
+
+    def claim(self):
+        """
+        Claims the next item nobody has finished or is working on, or one whose worker has stopped sending
+        heartbeats. Returns None if there's nothing to claim right now.
+        """
+        now = self._filesystem_time()
+        # Start somewhere different in every worker, so they don't all race for the same items
+        offset = hash(self.worker_id) % max(1, len(self.items))
+
+        for item in self.items[offset:] + self.items[:offset]:
+            if self.is_done(item["id"]):
+                continue
+
+            if self._try_lock(item["id"]) or self._take_over(item["id"], now):
+                # It may have been finished between checking and claiming
+                if self.is_done(item["id"]):
+                    self.release(item)
+                    continue
+                return item
+
+        return None
+
+    def release(self, item):
+        """
+        Gives up the claim on item, if it's still ours.
+        """
+        if _read_text(self._lock_path(item["id"])) == self.worker_id:
+            _try_remove(self._lock_path(item["id"]))
+
+    def complete(self, item, error=None):
+        """
+        Marks item as finished, or failed with an error message, and releases it.
+        """
+        marker_directory = FAILED_DIRECTORY if error is not None else DONE_DIRECTORY
+        marker = {"worker": self.worker_id, "error": error}
+
+        with AtomicWriter(self._path(marker_directory, item["id"])) as marker_file:
+            marker_file.write(json.dumps(marker, sort_keys=True))
+
+        self.release(item)
+
+    def heartbeat(self, item):
+        """
+        Keeps the claim on item alive while the with block runs.
+        """
+        return _Heartbeat(self._lock_path(item["id"]), self.worker_id, self.heartbeat_interval)
+
+    def status(self):
+        """
+        How many items are done, failed, being worked on and waiting, as a dict.
+        """
+        counts = {"done": 0, "failed": 0, "claimed": 0, "waiting": 0}
+
+        for item in self.items:
+            if exists(self._path(DONE_DIRECTORY, item["id"])):
+                counts["done"] += 1
+            elif exists(self._path(FAILED_DIRECTORY, item["id"])):
+                counts["failed"] += 1
+            elif exists(self._lock_path(item["id"])):
+                counts["claimed"] += 1
+            else:
+                counts["waiting"] += 1
+
+        return counts
+
+    def finished(self):
+        return all(self.is_done(item["id"]) for item in self.items)
+
+    def failures(self):
+        """
+        (item, error message) pairs for the items that failed.
+        """
+        failed_items = []
+
+        for item in self.items:
+            marker = _read_text(self._path(FAILED_DIRECTORY, item["id"]))
+            if marker is not None:
+                failed_items.append((item, json.loads(marker)["error"]))
+
+        return failed_items
+
+    def run(self, function, poll_interval=None):
+        """
+        Works through the queue, calling function(item) for every item claimed, until every item is finished.
+        Waits while other workers still hold claims, in case they stop and theirs need taking over.
+        function returns an (error message or None, result) pair, and the results of the calls made by this
+        worker are returned.
+        """
+        poll_interval = poll_interval if poll_interval is not None else self.heartbeat_interval
+        results = []
+
+        while True:
+            item = self.claim()
+
+            if item is None:
+                if self.finished():
+                    break
+                time.sleep(poll_interval)
+                continue
+
+            with self.heartbeat(item):
+                error, result = function(item)
+
+            self.complete(item, error)
+            results.append(result)
+
+        _try_remove(self._path(WORKERS_DIRECTORY, self.worker_id))
+        return results
+
+
+def add_queue_arguments(parser):
+    """
+    Adds the options for sharing a run through a queue directory to a parser.
+    """
+    parser.add_argument("--queue-dir", metavar="directory", type=str, dest="queue_dir",
+                        help="Share the work with every other run given the same directory, e.g. on other machines "
+                             "mounting it, taking one file at a time. Starting the run again resumes it.")
+
+    parser.add_argument("--heartbeat-timeout", metavar="seconds", type=float, dest="heartbeat_timeout",
+                        default=DEFAULT_HEARTBEAT_TIMEOUT,
+                        help="How long a worker can go without a heartbeat before its file is given to another. "
+                             "Default: {:g}".format(DEFAULT_HEARTBEAT_TIMEOUT))
+
+
+def create_work_queue(args):
+    """
+    The WorkQueue asked for by the arguments, or None if the run isn't shared.
+    """
+    if args.queue_dir is None:
+        return None
+
+    return WorkQueue(args.queue_dir, heartbeat_interval=min(DEFAULT_HEARTBEAT_INTERVAL, args.heartbeat_timeout / 4),
+                     heartbeat_timeout=args.heartbeat_timeout)
+
+
+def check_queue_arguments(args, parser):
+    ensure_arg(args.queue_dir is None or not exists(args.queue_dir) or isdir(args.queue_dir),
+               "Queue directory is a file.", parser)
+    ensure_arg(args.heartbeat_timeout > 0, "Heartbeat timeout must be positive.", parser)
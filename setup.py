@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 
-from distutils.core import setup
+from setuptools import setup
 
 setup(name="corpus-cleaner",
       version="0.1.0",
@@ -11,4 +11,7 @@ setup(name="corpus-cleaner",
       url="https://github.com/Eseb/corpus-cleaner",
       download_url="https://github.com/Eseb/corpus-cleaner/tarball/v0.1.0",
       packages=["corpus_cleaner"],
-      scripts=['corpus_cleaner/scrubber.py', 'corpus_cleaner/equaliser.py'])
+      scripts=['corpus_cleaner/scrubber.py', 'corpus_cleaner/equaliser.py', 'corpus_cleaner/dedup.py'],
+      entry_points={"console_scripts": ["corpus-clean = corpus_cleaner.pipeline:main",
+                                        "corpus-clean-service = corpus_cleaner.service:main",
+                                        "corpus-clean-client = corpus_cleaner.client:main"]})